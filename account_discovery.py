@@ -0,0 +1,152 @@
+'''Account Discovery
+
+This module pages through SearchAccounts with the largest page size the API
+allows and keeps several pages in flight once the first page comes back
+full. The pages are handed to the jobs as they arrive, so report shards of
+the first accounts are submitted before the last page is in
+'''
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+# Largest page size accepted by SearchAccounts
+PAGE_SIZE = 1000
+
+class AccountFeed:
+    '''
+    Accounts of the user, filled page by page by discover_accounts() and read
+    by any number of jobs at the same time
+    '''
+
+    def __init__(self):
+        self.error = None
+        self._pages = []
+        self._done = False
+        self._condition = threading.Condition()
+
+    @classmethod
+    def from_accounts(cls, accounts, page_size=PAGE_SIZE):
+        '''
+        Returns a finished feed of a known account list (the account cache)
+        '''
+        feed = cls()
+        for start in range(0, len(accounts), page_size):
+            feed.put(accounts[start:start + page_size])
+        feed.close()
+        return feed
+
+    def put(self, accounts):
+        if not accounts:
+            return
+        with self._condition:
+            self._pages.append(accounts)
+            self._condition.notify_all()
+
+    @property
+    def done(self):
+        '''
+        True once the discovery has finished
+        '''
+        with self._condition:
+            return self._done
+
+    def close(self, error=None):
+        '''
+        Marks the end of the discovery, error is the exception that stopped it
+        '''
+        with self._condition:
+            self._done = True
+            self.error = error
+            self._condition.notify_all()
+
+    def pages(self):
+        '''
+        Yields the pages received so far and then every page as it arrives,
+        returns once the discovery has finished
+        '''
+        index = 0
+        while True:
+            with self._condition:
+                while index >= len(self._pages) and not self._done:
+                    self._condition.wait()
+                if index >= len(self._pages):
+                    return
+                page = self._pages[index]
+            index += 1
+            yield page
+
+    def raise_error(self):
+        '''
+        Raises when the discovery failed, called once pages() is drained so
+        that the accounts of the pages that arrived are not taken for all
+        the accounts of the user
+        '''
+        if self.error is not None:
+            raise RuntimeError(f"account discovery failed, the account list is incomplete: {self.error}") from self.error
+
+    def first_page(self):
+        '''
+        Waits for the first page, raises the error of the discovery when it
+        failed before any account arrived
+        '''
+        for page in self.pages():
+            return page
+        if self.error is not None:
+            raise self.error
+        return []
+
+    def accounts(self):
+        '''
+        Waits for the end of the discovery and returns all the accounts
+        '''
+        return [account for page in self.pages() for account in page]
+
+def discover_accounts(search_page, feed, page_size=PAGE_SIZE, page_concurrency=4, expected_accounts=None):
+    '''
+    Calls search_page(page_index, page_size) for the pages 0, 1, ... until a
+    page comes back short and puts the pages into the feed in order
+
+    SearchAccounts does not return the number of accounts, so page 0 is
+    fetched alone unless expected_accounts (the size of the last known
+    account list) says there are more. After a full page up to
+    page_concurrency pages are in flight, at most page_concurrency - 1 of
+    them past the last page
+    '''
+    page_concurrency = max(1, page_concurrency)
+    if expected_accounts:
+        window = min(page_concurrency, expected_accounts // page_size + 1)
+    else:
+        window = 1
+
+    error = None
+    try:
+        with ThreadPoolExecutor(max_workers=page_concurrency) as executor:
+            in_flight = {}
+            next_index = 0
+            page_index = 0
+            while True:
+                while next_index < page_index + window:
+                    in_flight[next_index] = executor.submit(search_page, next_index, page_size)
+                    next_index += 1
+
+                try:
+                    accounts = in_flight.pop(page_index).result()
+                except BaseException:
+                    for future in in_flight.values():
+                        future.cancel()
+                    raise
+                feed.put(accounts)
+                if len(accounts) < page_size:
+                    break
+
+                page_index += 1
+                window = page_concurrency
+
+            # The pages requested past the last one come back empty
+            for future in in_flight.values():
+                future.cancel()
+    except BaseException as ex:
+        error = ex
+        raise
+    finally:
+        feed.close(error)
@@ -0,0 +1,235 @@
+'''Backfill
+
+This module downloads an arbitrary date range of a job (the last two years
+for example) next to the job's regular window. The range is split into
+chunks of at most 1000 accounts and --chunk-days days, the chunks run with
+bounded concurrency and every finished chunk is upserted into the report
+archive, appended to the target sheet and checkpointed, so an interrupted
+backfill resumes with the chunks that are still missing
+
+Usage: python3 backfill.py <start yyyy-mm-dd> <end yyyy-mm-dd> [--job default]
+    [--chunk-days 31] [--concurrency 4] [--range 'Backfill!A1:P'] [--restart]
+'''
+import os
+import sys
+import logging
+import logger
+import argparse
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+import main as bing_report
+
+from account_discovery import PAGE_SIZE
+from coordination import RunBusyError
+from file_utils import read_json, write_json
+from metrics import configure_metrics, get_metrics
+
+class BackfillCheckpoint:
+    '''
+    The accounts already downloaded for every chunk of a backfill
+    '''
+
+    def __init__(self, checkpoint_path, start_date, end_date, chunk_days):
+        '''
+        A checkpoint of another date range is started over, the chunk size
+        of an existing checkpoint is kept so its chunks still match
+        '''
+        self.checkpoint_path = checkpoint_path
+        self._lock = threading.Lock()
+
+        range = [start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')]
+        saved = read_json(checkpoint_path)
+        if saved and saved.get('range') == range:
+            self.state = saved
+            if saved['chunk_days'] != chunk_days:
+                logger.log_message(f"resuming with the {saved['chunk_days']} day chunks of the checkpoint", level=logging.WARNING)
+        else:
+            self.state = {'range': range, 'chunk_days': chunk_days, 'done': {}}
+
+    @property
+    def chunk_days(self):
+        return self.state['chunk_days']
+
+    @staticmethod
+    def chunk_key(start_date, end_date):
+        return f"{start_date.strftime('%Y-%m-%d')}_{end_date.strftime('%Y-%m-%d')}"
+
+    def pending(self, account_ids, start_date, end_date):
+        '''
+        Returns the accounts of the chunk that are not downloaded yet
+        '''
+        with self._lock:
+            done = set(self.state['done'].get(self.chunk_key(start_date, end_date), []))
+        return [account_id for account_id in account_ids if str(account_id) not in done]
+
+    def mark(self, account_ids, start_date, end_date):
+        with self._lock:
+            done = self.state['done'].setdefault(self.chunk_key(start_date, end_date), [])
+            done.extend(str(account_id) for account_id in account_ids)
+            write_json(self.checkpoint_path, self.state)
+
+def run_backfill(job, start_date, end_date, authorization_data, account_feed, checkpoint, concurrency=4, sheet_range=None, sheets_session=None):
+    '''
+    Downloads the chunks of the range that the checkpoint has not seen yet,
+    the chunks of a page of accounts start as soon as the page arrives
+
+    Returns (finished chunks, failed chunks)
+    '''
+    from jobs import filter_accounts
+    from pivot import sort_report_rows
+    from report_parser import sheet_rows
+    from report_archive import Coverage
+    from gs_interface import sheet_values
+
+    archive = bing_report.get_report_archive(job)
+    # A cube that does not exist yet is built from the report store by the next run
+    cube = bing_report.get_rollup_cube(job)
+    cube = cube if cube.exists() else None
+    coordinator = bing_report.get_run_coordinator()
+    aggregation = job["report"]["aggregation"]
+    write_lock = threading.Lock()
+    sheet_lock = threading.Lock()
+    parent_span = get_metrics().current()
+
+    def backfill_chunk(chunk_index, chunk):
+        chunk_account_ids, chunk_start, chunk_end = chunk
+        chunk_start_date = chunk_start.strftime('%Y-%m-%d')
+        chunk_end_date = chunk_end.strftime('%Y-%m-%d')
+        with get_metrics().attach(parent_span), get_metrics().span('backfill_chunk', chunk=chunk_index):
+            report_request = bing_report.get_ads_report(authorization_data, chunk_account_ids, chunk_start_date, chunk_end_date, aggregation)
+            data = bing_report.download_ads_report(
+                report_request,
+                authorization_data,
+                chunk_start_date,
+                chunk_end_date,
+                aggregation,
+                result_file_name=f"backfill_{job['name']}_{chunk_start_date}_{chunk_end_date}_{chunk_index}.csv",
+                )
+            if data is None:
+                logger.log_message(f"backfill chunk {chunk_start_date} to {chunk_end_date} ({len(chunk_account_ids)} accounts) failed, it is retried on the next backfill", level=logging.ERROR)
+                return False
+
+            coverage = [Coverage(chunk_account_ids, chunk_start, chunk_end)]
+            try:
+                # Under the job's lock, a run of the job in another process
+                # does not write the archive and the cube at the same time
+                with write_lock, coordinator.lock(job["name"]):
+                    archive.upsert(data, coverage)
+                    if cube is not None:
+                        cube.update(data, coverage)
+            except RunBusyError as ex:
+                logger.log_message(f"backfill chunk {chunk_start_date} to {chunk_end_date} ({len(chunk_account_ids)} accounts) not archived, it is retried on the next backfill: {ex}", level=logging.ERROR)
+                return False
+            if sheet_range and not data.empty:
+                rows = sheet_rows(sort_report_rows(data))
+                # One append at a time, the Sheets client is shared
+                with sheet_lock:
+                    sheets_session.apply_formats(job["spreadsheet_id"], [(sheet_range, list(rows.columns))])
+                    sheets_session.append(job["spreadsheet_id"], sheet_range, sheet_values(rows))
+
+        # Only a chunk that is archived and appended is not downloaded again
+        checkpoint.mark(chunk_account_ids, chunk_start, chunk_end)
+        logger.log_message(f"backfill chunk {chunk_start_date} to {chunk_end_date} ({len(chunk_account_ids)} accounts) done: {len(data)} rows")
+        return True
+
+    def run_chunk(chunk_index, chunk):
+        '''
+        Returns True when the chunk is done, a failed chunk does not stop the others
+        '''
+        try:
+            return backfill_chunk(chunk_index, chunk)
+        except Exception:
+            chunk_account_ids, chunk_start, chunk_end = chunk
+            logger.log_message(f"backfill chunk {chunk_start.strftime('%Y-%m-%d')} to {chunk_end.strftime('%Y-%m-%d')} ({len(chunk_account_ids)} accounts) failed, it is retried on the next backfill: {sys.exc_info()}", level=logging.ERROR)
+            return False
+
+    futures = []
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        for page in account_feed.pages():
+            page_accounts = filter_accounts([(account['Id'], account['Name']) for account in page], job["accounts"])
+            page_account_ids = [account_id for account_id, account_name in page_accounts]
+            for account_ids, chunk_start, chunk_end in bing_report.split_report_shards(
+                    page_account_ids, start_date, end_date, shard_accounts=PAGE_SIZE, shard_days=checkpoint.chunk_days):
+                pending_ids = checkpoint.pending(account_ids, chunk_start, chunk_end)
+                if pending_ids:
+                    futures.append(executor.submit(run_chunk, len(futures), (pending_ids, chunk_start, chunk_end)))
+        logger.log_message(f"backfill of job '{job['name']}': {len(futures)} chunk(s) to download with {max(1, concurrency)} worker(s)")
+        results = [future.result() for future in futures]
+
+    try:
+        with coordinator.lock(job["name"]):
+            archive.prune()
+    except RunBusyError as ex:
+        logger.log_message(f"report archive not pruned: {ex}", level=logging.WARNING)
+    if account_feed.error is not None:
+        # The chunks of the pages that did not arrive are not in the checkpoint
+        logger.log_message(f"account discovery failed, the remaining accounts are backfilled on the next backfill: {account_feed.error}", level=logging.ERROR)
+        results.append(False)
+    return sum(1 for result in results if result), sum(1 for result in results if not result)
+
+def main(argv=None):
+    from bingads.authorization import AuthorizationData
+    from gs_interface import get_session
+    from jobs import load_jobs
+
+    environment_info = bing_report.ENVIRONMENT_INFO
+    parser = argparse.ArgumentParser(description="Downloads a date range of a job into the report archive and a sheet")
+    parser.add_argument('start_date')
+    parser.add_argument('end_date')
+    parser.add_argument('--job', default=None, help="name of the job in JOBS (default the first job)")
+    parser.add_argument('--chunk-days', type=int, default=environment_info.get("BACKFILL_CHUNK_DAYS", 31))
+    parser.add_argument('--concurrency', type=int, default=environment_info.get("BACKFILL_CONCURRENCY", environment_info.get("REPORT_MAX_CONCURRENCY", 4)))
+    parser.add_argument('--range', dest='sheet_range', help="sheet range the rows are appended to, they are only archived when omitted")
+    parser.add_argument('--restart', action='store_true', help="ignore the checkpoint and download the whole range again")
+    args = parser.parse_args(argv)
+
+    start_date = bing_report.date_validation(args.start_date)
+    end_date = bing_report.date_validation(args.end_date)
+    if start_date > end_date:
+        parser.error("the start date is after the end date")
+
+    jobs = load_jobs(environment_info)
+    matching_jobs = [job for job in jobs if args.job is None or job["name"] == args.job]
+    if not matching_jobs:
+        parser.error(f"no job named '{args.job}'")
+    job = matching_jobs[0]
+
+    checkpoint_path = os.path.join(bing_report.work_dir, "backfill", f"{job['name']}.json")
+    if args.restart and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    checkpoint = BackfillCheckpoint(checkpoint_path, start_date, end_date, args.chunk_days)
+
+    bing_report.configure_request_limits()
+    # The spans go to the metrics log, the textfile is left to the regular runs
+    metrics_log = environment_info.get("METRICS_LOG", "log/metrics.jsonl")
+    configure_metrics(os.path.join(bing_report.work_dir, metrics_log) if metrics_log else None, None)
+
+    authorization_data = AuthorizationData(
+        account_id=None,
+        customer_id=None,
+        developer_token=bing_report.DEVELOPER_TOKEN,
+        authentication=None,
+    )
+
+    logger.log_message(f"-+-+-+-BEGIN backfill of job '{job['name']}' from {args.start_date} to {args.end_date}")
+    with get_metrics().span('backfill', job=job["name"]):
+        bing_report.authenticate(authorization_data)
+        finished, failed = run_backfill(
+            job,
+            start_date,
+            end_date,
+            authorization_data,
+            bing_report.get_account_feed(authorization_data),
+            checkpoint,
+            concurrency=args.concurrency,
+            sheet_range=args.sheet_range,
+            sheets_session=get_session() if args.sheet_range else None,
+            )
+    logger.log_message(f"-+-+-+-END backfill: {finished} chunk(s) done, {failed} failed")
+    print(f"backfill of job '{job['name']}': {finished} chunk(s) done, {failed} failed")
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,205 @@
+'''Benchmarks
+
+This module times and memory profiles the stages of download_ads_report
+on synthetic reports of several sizes and writes the results to a json
+file. With --baseline the results are compared with an earlier run and
+the exit code is 1 when a stage got slower than the tolerance allows
+
+Usage: python3 bench/run_benchmarks.py [--scales 10x7 100x30] [--repeat 3]
+    [--output bench/results/latest.json] [--baseline results.json] [--tolerance 0.25]
+'''
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import tracemalloc
+
+from statistics import median
+from datetime import datetime, timezone
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(script_dir))
+
+import pandas as pd
+
+from synthetic_report import write_synthetic_report
+from report_parser import read_report_csv, iter_report_csv, sheet_rows, CONVERTED_COLUMNS
+from report_types import get_report_type, DEFAULT_REPORT_TYPE
+from currency_rates import RateTable
+from pivot import DEFAULT_PIVOT, PivotAccumulator, build_pivots, sort_report_rows
+from gs_interface import SheetsSession, sheet_values
+
+# accounts x days
+DEFAULT_SCALES = ['10x7', '100x30', '500x90']
+
+# Same default as STREAMING_CHUNK_ROWS in main.py
+STREAMING_CHUNK_ROWS = 50000
+
+# The report is read with the columns main.py requests, AccountId included
+REPORT_TYPE = get_report_type(DEFAULT_REPORT_TYPE)
+
+def stage_parse(context):
+    return read_report_csv(context['report_path'], columns=REPORT_TYPE['columns'], dtypes=REPORT_TYPE['dtypes'])
+
+def stage_currency(context):
+    return context['rate_table'].convert_columns(context['parsed'].copy(), CONVERTED_COLUMNS)
+
+def stage_pivot(context):
+    # Same steps as main.build_report_frames
+    data = sort_report_rows(context['converted'])
+    pivots = build_pivots(data, [DEFAULT_PIVOT], context={'end_date': data['TimePeriod'].max()})
+    return data, pivots
+
+def stage_payload(context):
+    # Same payloads as SheetsSession.queue_update and flush
+    data, pivots = context['frames']
+    queued = [{'range': 'Sheet1!A1:P', 'values': sheet_values(sheet_rows(data))}]
+    for spec, pivot in pivots:
+        queued.append({'range': 'Sheet6!A1:O', 'values': [pivot.columns.values.tolist()] + sheet_values(pivot)})
+    payload_bytes = 0
+    for batch in context['session']._batches(queued):
+        payload_bytes += len(json.dumps({'valueInputOption': 'RAW', 'data': batch}, default=str))
+    return payload_bytes
+
+def stage_streaming(context):
+    # Same steps as main.run_job_streaming, parse to payload one chunk at a time
+    def report_rows():
+        for data in iter_report_csv(context['report_path'], chunk_rows=STREAMING_CHUNK_ROWS, columns=REPORT_TYPE['columns'], dtypes=REPORT_TYPE['dtypes']):
+            context['rate_table'].convert_columns(data, CONVERTED_COLUMNS)
+            accumulator.add(data)
+            yield from sheet_values(sheet_rows(data))
+
+    accumulator = PivotAccumulator(DEFAULT_PIVOT, context={'end_date': context['parsed']['TimePeriod'].max()})
+    payload_bytes = 0
+    for batch in context['session']._batches([{'range': 'Sheet1!A1:P', 'values': report_rows()}]):
+        payload_bytes += len(json.dumps({'valueInputOption': 'RAW', 'data': batch}, default=str))
+    accumulator.result()
+    return payload_bytes
+
+# (name, function, key the result is kept under for the next stage)
+STAGES = [
+    ('parse', stage_parse, 'parsed'),
+    ('currency', stage_currency, 'converted'),
+    ('pivot', stage_pivot, 'frames'),
+    ('payload', stage_payload, 'payload_bytes'),
+    # parse -> payload in bounded memory, compare its peak with the sum of the stages above
+    ('streaming', stage_streaming, 'streaming_payload_bytes'),
+    ]
+
+def run_stage(function, context, repeat):
+    '''
+    Returns (result, timings in seconds, peak traced memory in bytes), the
+    memory is measured in a separate run as tracing slows the stage down
+    '''
+    timings = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function(context)
+        timings.append(time.perf_counter() - started)
+
+    tracemalloc.start()
+    try:
+        function(context)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return result, timings, peak
+
+def run_scale(scale, work_dir, repeat, rows_per_day):
+    accounts, days = (int(value) for value in scale.split('x'))
+    report_path = os.path.join(work_dir, f"report_{scale}.csv")
+    rows = write_synthetic_report(report_path, accounts, days, rows_per_day=rows_per_day)
+
+    # Rates are looked up once so that the converter load is not timed
+    rate_table = RateTable(os.path.join(work_dir, f"rates_{scale}.json"))
+    context = {
+        'report_path': report_path,
+        'rate_table': rate_table,
+        'session': SheetsSession(credentials_path=None),
+        }
+    rate_table.convert_columns(read_report_csv(report_path), CONVERTED_COLUMNS)
+
+    results = {
+        'accounts': accounts,
+        'days': days,
+        'rows': rows,
+        'file_bytes': os.path.getsize(report_path),
+        'stages': {},
+        }
+    for name, function, key in STAGES:
+        context[key], timings, peak = run_stage(function, context, repeat)
+        results['stages'][name] = {
+            'seconds_min': min(timings),
+            'seconds_median': median(timings),
+            'rows_per_second': rows / median(timings) if median(timings) else None,
+            'peak_memory_bytes': peak,
+            }
+        print(f"{scale:>10} {name:>10}: {median(timings) * 1000:10.1f} ms, peak {peak / 1e6:8.1f} MB")
+
+    results['payload_bytes'] = context['payload_bytes']
+    return results
+
+def compare(results, baseline, tolerance):
+    '''
+    Returns the stages whose median time grew by more than tolerance (as a fraction)
+    '''
+    regressions = []
+    for scale, scale_results in results['scales'].items():
+        baseline_scale = baseline.get('scales', {}).get(scale)
+        if baseline_scale is None:
+            continue
+        for stage, stage_results in scale_results['stages'].items():
+            baseline_stage = baseline_scale['stages'].get(stage)
+            if baseline_stage is None or not baseline_stage['seconds_median']:
+                continue
+            change = stage_results['seconds_median'] / baseline_stage['seconds_median'] - 1
+            if change > tolerance:
+                regressions.append(f"{scale} {stage}: {change:+.0%} ({baseline_stage['seconds_median']:.4f}s -> {stage_results['seconds_median']:.4f}s)")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks the report processing stages on synthetic reports")
+    parser.add_argument('--scales', nargs='+', default=DEFAULT_SCALES, help="accounts x days, for example 100x30")
+    parser.add_argument('--rows-per-day', type=int, default=12, help="report rows per account and day")
+    parser.add_argument('--repeat', type=int, default=3, help="timed runs per stage")
+    parser.add_argument('--output', default=os.path.join(script_dir, "results", "latest.json"))
+    parser.add_argument('--baseline', help="results file to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed slowdown per stage, as a fraction")
+    args = parser.parse_args(argv)
+
+    results = {
+        'created': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'repeat': args.repeat,
+        'rows_per_day': args.rows_per_day,
+        'scales': {},
+        }
+    with tempfile.TemporaryDirectory() as work_dir:
+        for scale in args.scales:
+            results['scales'][scale] = run_scale(scale, work_dir, args.repeat, args.rows_per_day)
+
+    output_dir = os.path.dirname(args.output)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f"results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, 'r') as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
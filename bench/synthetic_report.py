@@ -0,0 +1,105 @@
+'''Synthetic Report
+
+This module writes synthetic Ad Performance report csv files in the layout
+downloaded by download_ads_report (report header, no footer) for the
+benchmarks
+
+Usage: python3 bench/synthetic_report.py <accounts> <days> <output file>
+'''
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+from datetime import date, timedelta
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(script_dir))
+
+from report_parser import REPORT_COLUMNS, ACCOUNT_ID_COLUMN
+
+CURRENCIES = ['GBP', 'USD', 'EUR', 'AUD', 'CAD', 'CHF']
+CAMPAIGN_TYPES = ['Search & content', 'Shopping', 'Performance max', 'Audience']
+NETWORKS = ['Microsoft sites and select traffic', 'Syndicated search partners', 'Audience']
+DEVICE_TYPES = ['Computer', 'Smartphone', 'Tablet']
+
+def synthetic_report(accounts, days, rows_per_day=12, end_date=None, seed=0, account_ids=None):
+    '''
+    Returns a DataFrame of accounts x days x rows_per_day report rows with
+    the values formatted the way the API writes them. accounts is a number
+    of accounts or a list of account names, account_ids their ids (100000
+    onwards when not given)
+    '''
+    random = np.random.default_rng(seed)
+    end_date = end_date or date.today() - timedelta(days=1)
+    account_names = (
+        np.array(accounts, dtype=str) if isinstance(accounts, (list, tuple))
+        else np.char.add('Account ', np.arange(accounts).astype(str))
+        )
+    accounts = len(account_names)
+    account_ids = np.array(account_ids, dtype=np.int64) if account_ids is not None else 100000 + np.arange(accounts)
+    rows = accounts * days * rows_per_day
+
+    account_index = np.repeat(np.arange(accounts), days * rows_per_day)
+    day_index = np.tile(np.repeat(np.arange(days), rows_per_day), accounts)
+    dates = [(end_date - timedelta(days=day)).strftime('%Y-%m-%d') for day in range(days)]
+    # Every account reports in one currency
+    account_currencies = random.choice(CURRENCIES, size=accounts)
+
+    impressions = random.integers(0, 20000, size=rows)
+    clicks = np.minimum(impressions, random.integers(0, 400, size=rows))
+    spend = np.round(clicks * random.uniform(0.05, 3.0, size=rows), 2)
+    conversions = np.round(clicks * random.uniform(0, 0.1, size=rows), 2)
+    ctr = np.divide(clicks, impressions, out=np.zeros(rows), where=impressions > 0) * 100
+    average_cpc = np.divide(spend, clicks, out=np.zeros(rows), where=clicks > 0)
+
+    return pd.DataFrame({
+        'AccountName': account_names[account_index],
+        'TimePeriod': np.take(dates, day_index),
+        'CurrencyCode': account_currencies[account_index],
+        'CampaignType': random.choice(CAMPAIGN_TYPES, size=rows),
+        'Network': random.choice(NETWORKS, size=rows),
+        'DeviceType': random.choice(DEVICE_TYPES, size=rows),
+        'Clicks': clicks,
+        # Large counts are written with thousands separators
+        'Impressions': pd.Series(impressions).map('{:,}'.format),
+        'Ctr': pd.Series(ctr).map('{:.2f}%'.format),
+        'AverageCpc': np.round(average_cpc, 2),
+        'Spend': spend,
+        'Conversions': conversions,
+        'Revenue': np.round(conversions * random.uniform(5, 50, size=rows), 2),
+        ACCOUNT_ID_COLUMN: account_ids[account_index],
+        })[REPORT_COLUMNS + [ACCOUNT_ID_COLUMN]]
+
+def format_report(data):
+    '''
+    Returns the report csv text of the rows, with the report header the API writes
+    '''
+    last_day = data['TimePeriod'].max() if len(data) else ''
+    first_day = data['TimePeriod'].min() if len(data) else ''
+    header = [
+        '"Report Name: Ad Performance"',
+        f'"Report Time: {first_day},{last_day}"',
+        '"Time Zone: (GMT) Greenwich Mean Time : Dublin, Edinburgh, Lisbon, London"',
+        f'"Last Completed Available Day: {last_day}"',
+        '"Potential Incomplete Data: false"',
+        f'"Rows: {len(data)}"',
+        '',
+        ]
+    return '\r\n'.join(header) + '\r\n' + data.to_csv(index=False, lineterminator='\r\n')
+
+def write_synthetic_report(file_path, accounts, days, rows_per_day=12, end_date=None, seed=0):
+    '''
+    Writes a synthetic report csv and returns its number of data rows
+    '''
+    data = synthetic_report(accounts, days, rows_per_day=rows_per_day, end_date=end_date, seed=seed)
+    with open(file_path, 'w', encoding='utf-8-sig', newline='') as file:
+        file.write(format_report(data))
+    return len(data)
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4:
+        print(__doc__)
+        sys.exit(1)
+    rows = write_synthetic_report(sys.argv[3], int(sys.argv[1]), int(sys.argv[2]))
+    print(f"{rows} rows written to {sys.argv[3]}")
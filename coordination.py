@@ -0,0 +1,156 @@
+'''Run Coordination
+
+This module keeps overlapping invocations (a cron run and a manual rerun,
+two daemons) from downloading and uploading the same job twice. A job run
+holds an exclusive lock on cache/runs/<job>.lock, a second invocation waits
+for the in-flight run and reuses its result, and a successful result of the
+same window and job settings is reused for a freshness ttl. A backfill of
+the job holds the same lock while it writes the archive and the rollup cube
+'''
+import os
+import json
+import time
+import fcntl
+import hashlib
+import logging
+import logger
+
+from contextlib import contextmanager
+from file_utils import read_json, write_json
+
+class RunBusyError(RuntimeError):
+    '''
+    The in-flight run of the job did not finish within the wait limit
+    '''
+
+def run_key(job, window_start, window_end):
+    '''
+    Returns the key of a run: the date window and a hash of the job
+    settings, so a changed job does not reuse the result of the old one
+    '''
+    settings = {name: value for name, value in job.items() if name != "schedule"}
+    digest = hashlib.sha1(json.dumps(settings, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:12]
+    return f"{window_start.strftime('%Y-%m-%d')}_{window_end.strftime('%Y-%m-%d')}_{digest}"
+
+class RunCoordinator:
+
+    def __init__(self, runs_dir, ttl_minutes=15, wait_minutes=75, poll_seconds=5):
+        '''
+        runs_dir: folder of the lock and result files of the jobs
+        ttl_minutes: a successful result of the same run key younger than
+            this is reused, 0 only reuses the result of a run waited for
+        wait_minutes: how long to wait for the in-flight run of the job
+        '''
+        self.runs_dir = runs_dir
+        self.ttl_minutes = ttl_minutes
+        self.wait_minutes = wait_minutes
+        self.poll_seconds = poll_seconds
+
+    def result_path(self, job_name):
+        return os.path.join(self.runs_dir, f"{job_name}.json")
+
+    def lock_path(self, job_name):
+        return os.path.join(self.runs_dir, f"{job_name}.lock")
+
+    def last_result(self, job_name):
+        '''
+        Returns the result of the job's last run, None before the first one
+        '''
+        return read_json(self.result_path(job_name))
+
+    def fresh_result(self, job_name, key, not_before):
+        '''
+        Returns the last result if it succeeded for the run key and finished
+        after not_before (a timestamp), None otherwise
+        '''
+        result = self.last_result(job_name)
+        if not result or result.get('key') != key or not result.get('succeeded'):
+            return None
+        if result['finished_at'] < not_before:
+            return None
+        return result
+
+    def _wait_for_lock(self, lock_file, job_name):
+        '''
+        Waits until the in-flight run releases the lock, raises RunBusyError
+        after wait_minutes
+        '''
+        lock_file.seek(0)
+        holder = lock_file.read().strip() or "unknown"
+        logger.log_message(f"job '{job_name}' is running in process {holder}, waiting for it")
+        deadline = time.monotonic() + self.wait_minutes * 60
+        while True:
+            time.sleep(self.poll_seconds)
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except BlockingIOError:
+                if time.monotonic() > deadline:
+                    raise RunBusyError(f"job '{job_name}' is still running in process {holder} after {self.wait_minutes} minute(s)")
+
+    @contextmanager
+    def lock(self, job_name):
+        '''
+        Holds the job's lock, a run or a backfill of the job in another
+        process waits until it is released. Yields True when the lock was
+        held by another process and this call waited for it
+        '''
+        os.makedirs(self.runs_dir, exist_ok=True)
+        with open(self.lock_path(job_name), 'a+') as lock_file:
+            waited = False
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self._wait_for_lock(lock_file, job_name)
+                waited = True
+
+            lock_file.seek(0)
+            lock_file.truncate()
+            lock_file.write(str(os.getpid()))
+            lock_file.flush()
+            yield waited
+            # Closing the file releases the lock
+
+    def run(self, job_name, key, run, force=False):
+        '''
+        Calls run() unless a fresh result of the run key exists or the
+        in-flight run of the job produces one while this call waits for it.
+        run() returning False records a failed run, which is not reused
+
+        force: do not reuse results that finished before this call
+
+        Returns (outcome, result) where outcome is 'ran', 'attached' (the
+        result of the run waited for) or 'reused' (a recent result)
+        '''
+        started_at = time.time()
+        not_before = started_at if force else started_at - self.ttl_minutes * 60
+
+        cached = self.fresh_result(job_name, key, not_before)
+        if cached is not None:
+            logger.log_message(f"job '{job_name}': reusing the result of the run finished at {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(cached['finished_at']))}")
+            return 'reused', cached
+
+        with self.lock(job_name) as attached:
+            # The run waited for, or one that finished between the first
+            # check and the lock, produced the result
+            cached = self.fresh_result(job_name, key, not_before)
+            if cached is not None:
+                if attached:
+                    logger.log_message(f"job '{job_name}': reusing the result of the run waited for")
+                return ('attached' if attached else 'reused'), cached
+            if attached:
+                logger.log_message(f"job '{job_name}': the run waited for did not succeed for this window, running it", level=logging.WARNING)
+
+            succeeded = False
+            try:
+                succeeded = run() is not False
+            finally:
+                result = {
+                    'key': key,
+                    'succeeded': succeeded,
+                    'started_at': started_at,
+                    'finished_at': time.time(),
+                    'pid': os.getpid(),
+                    }
+                write_json(self.result_path(job_name), result)
+        return 'ran', result
@@ -0,0 +1,120 @@
+'''Credential Cache
+
+This module keeps the OAuth access token and the account list of the user
+between runs so that most runs make no OAuth refresh, GetUser or
+SearchAccounts call at all
+'''
+import os
+import time
+import logger
+import threading
+
+from file_utils import read_json, write_json
+
+class TokenCache:
+
+    def __init__(self, cache_path, expiry_margin_seconds=300):
+        '''
+        cache_path: json file the access token is kept in
+        expiry_margin_seconds: the token is not used when it expires sooner than this
+        '''
+        self.cache_path = cache_path
+        self.expiry_margin_seconds = expiry_margin_seconds
+        self._lock = threading.Lock()
+
+    def load(self):
+        '''
+        Returns (access_token, seconds_left) of the cached token, None when
+        there is none or it is about to expire
+        '''
+        with self._lock:
+            cached = read_json(self.cache_path)
+        if not cached:
+            return None
+        seconds_left = cached['expires_at'] - time.time()
+        if seconds_left <= self.expiry_margin_seconds:
+            return None
+        return cached['access_token'], int(seconds_left)
+
+    def save(self, oauth_tokens):
+        '''
+        Keeps the access token of the bingads OAuthTokens
+        '''
+        if not oauth_tokens.access_token or not oauth_tokens.access_token_expires_in_seconds:
+            return
+        with self._lock:
+            write_json(self.cache_path, {
+                'access_token': oauth_tokens.access_token,
+                'expires_at': time.time() + oauth_tokens.access_token_expires_in_seconds,
+                }, private=True)
+
+    def invalidate(self):
+        with self._lock:
+            if os.path.exists(self.cache_path):
+                os.remove(self.cache_path)
+
+class AccountCache:
+
+    def __init__(self, cache_path, ttl_hours=24):
+        '''
+        cache_path: json file the account list is kept in
+        ttl_hours: how long the account list is used before it is fetched again
+        '''
+        self.cache_path = cache_path
+        self.ttl_seconds = ttl_hours * 3600
+        self._lock = threading.Lock()
+
+    def load(self, user_key):
+        '''
+        Returns {'user_id', 'accounts'} when the cached list belongs to the
+        user (see main.account_user_key: the client id, the environment and
+        a hash of the user's refresh token) and is not older than the ttl
+        '''
+        with self._lock:
+            cached = read_json(self.cache_path)
+        if not cached or cached.get('user_key') != user_key:
+            return None
+        if time.time() - cached['fetched_at'] > self.ttl_seconds:
+            return None
+        return cached
+
+    def last_count(self, user_key):
+        '''
+        Returns the number of accounts last cached for the user whatever its
+        age, None when there is none
+        '''
+        with self._lock:
+            cached = read_json(self.cache_path)
+        if not cached or cached.get('user_key') != user_key:
+            return None
+        return len(cached['accounts'])
+
+    def save(self, user_key, user_id, accounts):
+        '''
+        accounts: list of {'Id', 'Name', 'CurrencyCode', 'ParentCustomerId'}
+        '''
+        with self._lock:
+            write_json(self.cache_path, {
+                'user_key': user_key,
+                'fetched_at': time.time(),
+                'user_id': user_id,
+                'accounts': accounts,
+                })
+        logger.log_message(f"account cache updated: {len(accounts)} account(s)")
+
+    def rekey(self, old_user_key, new_user_key):
+        '''
+        Moves the cached list of old_user_key to new_user_key, when the
+        refresh token of the same user is rotated
+        '''
+        with self._lock:
+            cached = read_json(self.cache_path)
+            if cached and cached.get('user_key') == old_user_key and old_user_key != new_user_key:
+                cached['user_key'] = new_user_key
+                write_json(self.cache_path, cached)
+
+    def invalidate(self):
+        with self._lock:
+            if os.path.exists(self.cache_path):
+                os.remove(self.cache_path)
+            logger.log_message("account cache invalidated")
@@ -0,0 +1,135 @@
+'''Currency Rates
+
+This module builds the (currency, date) -> GBP rate table used to convert
+the report cost columns and caches it on disk between runs
+'''
+import json
+import time
+import logger
+import threading
+import pandas as pd
+
+from datetime import datetime
+
+from file_utils import write_json
+
+TARGET_CURRENCY = "GBP"
+
+class RateTable:
+
+    def __init__(self, cache_path, ttl_hours=24, currency_file=None, target_currency=TARGET_CURRENCY):
+        '''
+        cache_path: json file the rates are cached in
+        ttl_hours: how long a rate for a day the ECB has not published yet
+            (a fallback to the closest known rate) stays cached, rates of
+            published days never expire
+        currency_file: rate history file or url passed to CurrencyConverter,
+            the history bundled with the package is used when None
+        '''
+        self.cache_path = cache_path
+        self.ttl_seconds = ttl_hours * 3600
+        self.currency_file = currency_file
+        self.target_currency = target_currency
+        self._converter = None
+        self._lock = threading.Lock()
+        self._rates = self._load_cache()
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_path, 'r') as file:
+                return json.load(file)
+        except (IOError, ValueError):
+            return {}
+
+    def _save_cache(self):
+        write_json(self.cache_path, self._rates)
+
+    def _get_converter(self):
+        # Loading the full rate history is slow, only do it on a cache miss
+        if self._converter is None:
+            from currency_converter import CurrencyConverter
+            options = {'fallback_on_missing_rate': True, 'fallback_on_wrong_date': True}
+            if self.currency_file:
+                options['currency_file'] = self.currency_file
+            self._converter = CurrencyConverter(**options)
+        return self._converter
+
+    def _cached_rate(self, currency_code, rate_date, now):
+        entry = self._rates.get(currency_code, {}).get(rate_date)
+        if entry is None:
+            return None
+        if entry['expires'] is not None and entry['expires'] < now:
+            return None
+        return entry['rate']
+
+    def rates_for(self, pairs):
+        '''
+        Returns {(currency_code, date): rate} for the given (currency_code, date) pairs,
+        dates are 'YYYY-MM-DD' strings
+        '''
+        now = time.time()
+        rates = {}
+        with self._lock:
+            updated = False
+            for currency_code, rate_date in pairs:
+                if currency_code == self.target_currency:
+                    rates[(currency_code, rate_date)] = 1.0
+                    continue
+
+                rate = self._cached_rate(currency_code, rate_date, now)
+                if rate is None:
+                    converter = self._get_converter()
+                    day = datetime.strptime(rate_date, '%Y-%m-%d').date()
+                    rate = converter.convert(1, currency_code, self.target_currency, date=day)
+
+                    # Days after the last published rate use a fallback rate which may still change
+                    published = day <= min(
+                        converter.bounds[currency_code].last_date,
+                        converter.bounds[self.target_currency].last_date,
+                        )
+                    self._rates.setdefault(currency_code, {})[rate_date] = {
+                        'rate': rate,
+                        'expires': None if published else now + self.ttl_seconds,
+                        }
+                    updated = True
+
+                rates[(currency_code, rate_date)] = rate
+
+            if updated:
+                self._save_cache()
+                logger.log_message(f"currency rate cache updated: {self.cache_path}")
+
+        return rates
+
+    def convert_columns(self, data, columns, currency_column='CurrencyCode', date_column='TimePeriod'):
+        '''
+        Adds the converted columns to the frame in place using the rate of
+        each row's currency and date
+
+        columns: {converted column: source column}
+        '''
+        if data.empty:
+            for converted_column, source_column in columns.items():
+                data[converted_column] = data[source_column].astype('float64')
+            return data
+
+        keys = data[[currency_column, date_column]].astype(str)
+        pairs = keys.drop_duplicates().itertuples(index=False, name=None)
+        rates = pd.Series(self.rates_for(pairs), dtype='float64')
+        rate = rates.reindex(pd.MultiIndex.from_frame(keys)).to_numpy()
+
+        for converted_column, source_column in columns.items():
+            data[converted_column] = data[source_column].to_numpy() * rate
+        return data
+
+_rate_tables = {}
+_rate_tables_lock = threading.Lock()
+
+def get_rate_table(cache_path, ttl_hours=24, currency_file=None):
+    '''
+    Returns the process wide rate table for the cache file
+    '''
+    with _rate_tables_lock:
+        if cache_path not in _rate_tables:
+            _rate_tables[cache_path] = RateTable(cache_path, ttl_hours=ttl_hours, currency_file=currency_file)
+        return _rate_tables[cache_path]
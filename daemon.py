@@ -0,0 +1,407 @@
+'''Daemon
+
+This module runs the jobs in one long running process, each on the cron
+schedule of the job. The authentication, the Bing Ads service clients, the
+Sheets session and the currency rates stay in memory between runs, env.json
+is read again when it changes, a job is not started again while its last run
+is still going and GET /health and /status report the state of the jobs
+
+Usage: python3 daemon.py [--host 127.0.0.1] [--port 8377] [--run-now]
+'''
+import os
+import sys
+import json
+import time
+import signal
+import logging
+import logger
+import argparse
+import threading
+
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import main as bing_report
+
+from metrics import configure_metrics, get_metrics
+
+CRON_ALIASES = {
+    "@hourly": "0 * * * *",
+    "@daily": "0 0 * * *",
+    "@weekly": "0 0 * * 0",
+    "@monthly": "0 0 1 * *",
+    }
+
+# (lowest, highest) value of the minute, hour, day, month and weekday fields,
+# weekday 0 and 7 are both Sunday
+CRON_FIELDS = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+# The scheduler is considered stalled when it has not looked at the jobs for this long
+STALLED_SECONDS = 60
+
+def parse_cron_field(text, lowest, highest):
+    '''
+    Returns the set of values of a cron field: *, 5, 1-5, */15, 1-30/2 or
+    a comma separated list of those
+    '''
+    values = set()
+    for part in text.split(','):
+        range_text, separator, step_text = part.partition('/')
+        step = int(step_text) if separator else 1
+        if range_text == '*':
+            start, end = lowest, highest
+        elif '-' in range_text:
+            start, end = (int(value) for value in range_text.split('-', 1))
+        else:
+            start = int(range_text)
+            end = highest if separator else start
+        if step < 1 or start < lowest or end > highest or start > end:
+            raise ValueError(f"cron field '{text}' is out of the range {lowest}-{highest}")
+        values.update(range(start, end + 1, step))
+    return values
+
+class CronSchedule:
+    '''
+    A five field cron expression (minute hour day month weekday) in local time
+    '''
+
+    def __init__(self, expression):
+        self.expression = expression
+        fields = CRON_ALIASES.get(expression.strip(), expression).split()
+        if len(fields) != 5:
+            raise ValueError(f"cron expression '{expression}' does not have 5 fields")
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (
+            parse_cron_field(field, lowest, highest)
+            for field, (lowest, highest) in zip(fields, CRON_FIELDS)
+            )
+        if 7 in self.weekdays:
+            self.weekdays = (self.weekdays - {7}) | {0}
+        # As in cron, a day matches either field when both are restricted,
+        # a field starting with * (*/2 too) does not count as restricted
+        self.any_day = fields[2].startswith('*')
+        self.any_weekday = fields[4].startswith('*')
+
+    def day_matches(self, day):
+        day_match = day.day in self.days
+        weekday_match = day.isoweekday() % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day_match and weekday_match
+        return day_match or weekday_match
+
+    def next_run(self, after):
+        '''
+        Returns the first minute after the datetime that matches the schedule
+        '''
+        moment = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # Every schedule matches within 5 years (the 29th of February on a given weekday)
+        limit = moment + timedelta(days=5 * 366)
+        while moment < limit:
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self.day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment
+        raise ValueError(f"cron expression '{self.expression}' never matches")
+
+def format_time(moment):
+    return moment.isoformat(timespec='seconds') if moment is not None else None
+
+class JobState:
+    '''
+    Schedule and last run of a job, the lock is held while the job runs
+    '''
+
+    def __init__(self, job, schedule, now):
+        self.job = job
+        self.schedule = schedule
+        self.next_run = schedule.next_run(now)
+        self.lock = threading.Lock()
+        self.last_started = None
+        self.last_finished = None
+        self.last_success = None
+        self.last_error = None
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0
+        self.reused = 0
+
+    def status(self):
+        return {
+            'schedule': self.schedule.expression,
+            'running': self.lock.locked(),
+            'next_run': format_time(self.next_run),
+            'last_started': format_time(self.last_started),
+            'last_finished': format_time(self.last_finished),
+            'last_success': self.last_success,
+            'last_error': self.last_error,
+            'runs': self.runs,
+            'failures': self.failures,
+            'skipped': self.skipped,
+            'reused': self.reused,
+            }
+
+class Daemon:
+
+    def __init__(self, authorization_data, env_file=bing_report.ENV_FILE, concurrency=2):
+        '''
+        authorization_data: authenticated AuthorizationData shared by every run
+        env_file: settings file that is read again when it changes
+        concurrency: number of jobs running at the same time
+        '''
+        self.authorization_data = authorization_data
+        self.env_file = env_file
+        self.started_at = datetime.now()
+        self.config_loaded_at = None
+        self.config_error = None
+        self.last_tick = time.monotonic()
+        self.jobs = {}
+        self._config_mtime = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        # Long lived workers keep their service clients between runs
+        self._executor = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="job")
+        # Runs in progress, the metrics totals cover the runs since the last idle moment
+        self._running = 0
+        self._period_started = None
+        self._period_success = True
+
+    def load_config(self):
+        '''
+        Reads the settings file and the jobs again, a file that does not
+        load keeps the current settings
+        '''
+        from jobs import load_jobs
+
+        try:
+            self._config_mtime = os.path.getmtime(self.env_file)
+            with open(self.env_file, 'r') as file:
+                environment_info = json.load(file)
+            jobs = load_jobs(environment_info)
+            schedules = {job["name"]: CronSchedule(job["schedule"]) for job in jobs}
+        except Exception as ex:
+            self.config_error = f"{type(ex).__name__}: {ex}"
+            logger.log_message(f"settings not reloaded, '{self.env_file}' is invalid: {self.config_error}", level=logging.ERROR)
+            return False
+
+        for name in ("CLIENT_ID", "DEVELOPER_TOKEN", "ENVIRONMENT", "JOB_CONCURRENCY"):
+            if environment_info.get(name) != bing_report.ENVIRONMENT_INFO.get(name):
+                logger.log_message(f"{name} changed, it is applied when the daemon is restarted", level=logging.WARNING)
+
+        now = datetime.now()
+        with self._lock:
+            # The settings are read from ENVIRONMENT_INFO when they are used,
+            # the loaded dict replaces it whole so a running job never sees
+            # it half updated, and the new settings apply to the next calls
+            bing_report.ENVIRONMENT_INFO = environment_info
+            bing_report.configure_request_limits()
+
+            jobs_by_name = {}
+            for job in jobs:
+                state = self.jobs.get(job["name"])
+                if state is None or state.schedule.expression != job["schedule"]:
+                    previous = state
+                    state = JobState(job, schedules[job["name"]], now)
+                    if previous is not None:
+                        # The run in progress keeps its lock
+                        state.lock = previous.lock
+                state.job = job
+                jobs_by_name[job["name"]] = state
+            self.jobs = jobs_by_name
+
+        self.config_loaded_at = now
+        self.config_error = None
+        logger.log_message(f"settings loaded: {len(jobs)} job(s), " + ", ".join(
+            f"'{name}' next at {format_time(state.next_run)}" for name, state in jobs_by_name.items()
+            ))
+        return True
+
+    def check_config(self):
+        try:
+            mtime = os.path.getmtime(self.env_file)
+        except OSError:
+            return
+        if mtime != self._config_mtime:
+            self.load_config()
+
+    def run_job(self, state):
+        '''
+        Runs the job unless its last run is still going
+        '''
+        job = state.job
+        if not state.lock.acquire(blocking=False):
+            state.skipped += 1
+            logger.log_message(f"job '{job['name']}' is still running, this run is skipped", level=logging.WARNING)
+            return
+
+        with self._lock:
+            if self._running == 0:
+                get_metrics().reset_totals()
+                self._period_started = time.monotonic()
+                self._period_success = True
+                bing_report.script_start_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            self._running += 1
+
+        state.last_started = datetime.now()
+        state.runs += 1
+        success = False
+        try:
+            logger.log_message(f"job '{job['name']}' started")
+            # The account list follows the account cache ttl between runs
+            bing_report.reset_account_feed()
+            # Another invocation running or having just run the job's window
+            # provides the result
+            outcome = bing_report.run_job_span(
+                job,
+                self.authorization_data,
+                bing_report.get_account_feed(self.authorization_data),
+                bing_report.get_sheets_session(),
+                )
+            if outcome != 'ran':
+                state.reused += 1
+            success = True
+            state.last_error = None
+            logger.log_message(f"job '{job['name']}' finished")
+        except Exception as ex:
+            state.failures += 1
+            state.last_error = f"{type(ex).__name__}: {ex}"
+            logger.log_message(f"job '{job['name']}' failed: {sys.exc_info()}", level=logging.ERROR)
+        finally:
+            state.last_finished = datetime.now()
+            state.last_success = success
+            state.lock.release()
+            with self._lock:
+                self._running -= 1
+                self._period_success = self._period_success and success
+                if self._running == 0:
+                    get_metrics().write_textfile(self._period_success, time.monotonic() - self._period_started)
+
+    def run(self, run_now=False):
+        '''
+        Starts the due jobs until stop() is called, run_now starts every job
+        once right away
+        '''
+        if self.config_loaded_at is None and not self.load_config():
+            raise ValueError(f"the settings file '{self.env_file}' is invalid: {self.config_error}")
+
+        if run_now:
+            for state in list(self.jobs.values()):
+                self._executor.submit(self.run_job, state)
+
+        while not self._stop.is_set():
+            self.last_tick = time.monotonic()
+            self.check_config()
+            now = datetime.now()
+            with self._lock:
+                states = list(self.jobs.values())
+            for state in states:
+                if state.next_run <= now:
+                    state.next_run = state.schedule.next_run(now)
+                    self._executor.submit(self.run_job, state)
+            next_run = min((state.next_run for state in states), default=now + timedelta(minutes=1))
+            # Wake up for the next run and often enough to see the settings change
+            self._stop.wait(min(max((next_run - datetime.now()).total_seconds(), 0.1), 5))
+
+        logger.log_message("daemon stopping, waiting for the running jobs")
+        self._executor.shutdown(wait=True)
+
+    def stop(self):
+        self._stop.set()
+
+    def healthy(self):
+        return time.monotonic() - self.last_tick < STALLED_SECONDS
+
+    def status(self):
+        with self._lock:
+            jobs = {name: state.status() for name, state in self.jobs.items()}
+        return {
+            'status': 'ok' if self.healthy() else 'stalled',
+            'started_at': format_time(self.started_at),
+            'config_loaded_at': format_time(self.config_loaded_at),
+            'config_error': self.config_error,
+            'jobs': jobs,
+            }
+
+class StatusHandler(BaseHTTPRequestHandler):
+    '''
+    GET /health answers 200 while the scheduler is alive, GET /status
+    returns the schedule and the last run of every job
+    '''
+
+    def do_GET(self):
+        daemon = self.server.daemon
+        if self.path == '/health':
+            code, body = (200 if daemon.healthy() else 503), {'status': 'ok' if daemon.healthy() else 'stalled'}
+        elif self.path == '/status':
+            code, body = 200, daemon.status()
+        else:
+            code, body = 404, {'error': f"unknown path '{self.path}'"}
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_status_server(daemon, host, port):
+    server = ThreadingHTTPServer((host, port), StatusHandler)
+    server.daemon_threads = True
+    server.daemon = daemon
+    threading.Thread(target=server.serve_forever, name="status-server", daemon=True).start()
+    logger.log_message(f"status endpoint listening on http://{host}:{server.server_address[1]}/status")
+    return server
+
+def main(argv=None):
+    from bingads.authorization import AuthorizationData
+
+    environment_info = bing_report.ENVIRONMENT_INFO
+    parser = argparse.ArgumentParser(description="Runs the jobs on their schedule in a long running process")
+    parser.add_argument('--host', default=environment_info.get("DAEMON_HEALTH_HOST", "127.0.0.1"))
+    parser.add_argument('--port', type=int, default=environment_info.get("DAEMON_HEALTH_PORT", 8377), help="port of the status endpoint, 0 to not serve it")
+    parser.add_argument('--run-now', action='store_true', help="run every job once at startup")
+    args = parser.parse_args(argv)
+
+    bing_report.timezone = datetime.now(timezone.utc).tzinfo
+    bing_report.configure_request_limits()
+    metrics_log, metrics_textfile = (
+        environment_info.get("METRICS_LOG", "log/metrics.jsonl"),
+        environment_info.get("METRICS_TEXTFILE", "metrics/bing_ads_report.prom"),
+        )
+    configure_metrics(*(os.path.join(bing_report.work_dir, path) if path else None for path in (metrics_log, metrics_textfile)))
+
+    authorization_data = AuthorizationData(
+        account_id=None,
+        customer_id=None,
+        developer_token=bing_report.DEVELOPER_TOKEN,
+        authentication=None,
+    )
+
+    logger.log_message(f"-+-+-+-BEGIN daemon at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} {bing_report.timezone}")
+    # Authenticated once, the SDK refreshes the access token when it expires
+    bing_report.authenticate(authorization_data)
+
+    daemon = Daemon(authorization_data, concurrency=environment_info.get("JOB_CONCURRENCY", 2))
+    daemon.load_config()
+    server = start_status_server(daemon, args.host, args.port) if args.port else None
+
+    for signal_number in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signal_number, lambda signal_number, frame: daemon.stop())
+
+    try:
+        daemon.run(run_now=args.run_now)
+    finally:
+        if server is not None:
+            server.shutdown()
+    logger.log_message("-+-+-+-END daemon")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,61 @@
+'''File Utils
+
+This module writes the cache, store and state files atomically: the
+content is written to a temporary file next to the target and moved over
+it, so a reader never sees a partly written file
+'''
+import os
+import json
+import tempfile
+
+def replace_file(path, write, private=False):
+    '''
+    Calls write(tmp_path) and moves the written file over path, so a reader
+    never sees a partly written file. Every call gets its own temporary file,
+    so processes and threads writing the same path do not overwrite each
+    other's. Private files are only readable by the owner
+    '''
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    # The ".tmp" suffix marks the leftovers of an interrupted write
+    descriptor, tmp_path = tempfile.mkstemp(dir=directory or '.', prefix=os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        # mkstemp creates the file readable by the owner only
+        if not private:
+            os.fchmod(descriptor, 0o644)
+        os.close(descriptor)
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def write_text(path, text, private=False):
+    '''
+    Writes the text file atomically
+    '''
+    def write(tmp_path):
+        with open(tmp_path, 'w') as file:
+            file.write(text)
+    replace_file(path, write, private=private)
+
+def write_json(path, content, private=False):
+    '''
+    Writes the json file atomically
+    '''
+    def write(tmp_path):
+        with open(tmp_path, 'w') as file:
+            json.dump(content, file)
+    replace_file(path, write, private=private)
+
+def read_json(path):
+    '''
+    Returns the content of the json file, None when it is missing or not valid json
+    '''
+    try:
+        with open(path, 'r') as file:
+            return json.load(file)
+    except (IOError, ValueError):
+        return None
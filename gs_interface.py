@@ -6,138 +6,827 @@ update the specified google sheets
 from __future__ import print_function
 
 import os.path
+import re
+import json
+import hashlib
 import logging
 import logger
+import threading
+
+from request_scheduler import get_scheduler
+from metrics import get_metrics
+from file_utils import write_json, write_text
+
+from concurrent.futures import ThreadPoolExecutor
 
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build, build_from_document, DISCOVERY_URI
 from googleapiclient.errors import HttpError
 from google.oauth2 import service_account
 
 # If modifying these scopes, delete the file token.json.
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 
-def update_g_sheet(
-    data, 
-    meta, 
-    spreadsheet_id,
-    range,
-    append_mode = False,
-    log_to_sheet = False,
-    ):
+# Get script path
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Folder the caches are written to, the work folder of main.py
+work_dir = os.environ.get("BING_REPORT_WORK_DIR", script_dir)
+
+# Last values written to each (spreadsheet, range), used by the diff mode
+SNAPSHOT_DIR = os.path.join(work_dir, "cache/sheet_snapshots")
+
+'''LIVE CREDENTIALS'''
+CREDENTIALS_PATH = os.path.join(script_dir, "credentials/service-account-credentials-live.json")
+
+# Discovery documents of the google api client, one file per client version
+DISCOVERY_DIR = os.path.join(work_dir, "cache/discovery")
+
+# Number formats already applied to each (spreadsheet, range)
+FORMATS_PATH = os.path.join(work_dir, "cache/sheet_formats.json")
 
-    creds = None
-    # The file token.json stores the user's access and refresh tokens, and is
-    # created automatically when the authorization flow completes for the first
-    # time.
-    # credentials = service_account.Credentials.from_service_account_file('credentials/service-account-credentials.json', scopes=SCOPES)
+# The values are written as they are (RAW), the display of the report and
+# pivot columns comes from these number formats
+COLUMN_FORMATS = {
+    'TimePeriod': {'type': 'DATE', 'pattern': 'yyyy-mm-dd'},
+    'Clicks': {'type': 'NUMBER', 'pattern': '#,##0'},
+    'Impressions': {'type': 'NUMBER', 'pattern': '#,##0'},
+    'Ctr': {'type': 'PERCENT', 'pattern': '0.00%'},
+    # Amounts in the currency of the account
+    'AverageCpc': {'type': 'NUMBER', 'pattern': '#,##0.00'},
+    'Spend': {'type': 'NUMBER', 'pattern': '#,##0.00'},
+    'Conversions': {'type': 'NUMBER', 'pattern': '#,##0.00'},
+    'Revenue': {'type': 'NUMBER', 'pattern': '#,##0.00'},
+    # Amounts converted to GBP
+    'AverageCpc (converted)': {'type': 'CURRENCY', 'pattern': '[$£-809]#,##0.00'},
+    'Cost (converted)': {'type': 'CURRENCY', 'pattern': '[$£-809]#,##0.00'},
+    'Total conv. value': {'type': 'CURRENCY', 'pattern': '[$£-809]#,##0.00'},
+    }
 
-    # Get script path
-    script_dir = os.path.dirname(os.path.abspath(__file__))
+# Decimals kept of the float values, the formats show at most 4
+SHEET_FLOAT_DECIMALS = 6
 
-    credentials_path = os.path.join(script_dir, "credentials/service-account-credentials-live.json")
-    '''LIVE CREDENTIALS'''
-    credentials = service_account.Credentials.from_service_account_file(credentials_path, scopes=SCOPES)
+# Day 0 of the Sheets date serial numbers
+SHEETS_EPOCH = '1899-12-30'
 
+# host:port of a local stand-in for the Sheets API (see loadtest/), requests
+# are sent there without credentials
+SHEETS_EMULATOR_HOST = os.environ.get("SHEETS_EMULATOR_HOST")
+
+def load_discovery_document(service_name, version):
+    '''
+    Returns the discovery document of the api from the on-disk cache, the
+    cache is filled from the document bundled with the client library or
+    downloaded when the library has none
+    '''
+    from googleapiclient.version import __version__ as client_version
+
+    path = os.path.join(DISCOVERY_DIR, f"{service_name}.{version}.{client_version}.json")
+    if os.path.exists(path):
+        with open(path, 'r') as file:
+            return file.read()
+
+    document = None
     try:
-        service = build('sheets', 'v4', credentials=credentials)
+        from googleapiclient.discovery_cache import get_static_doc
+        document = get_static_doc(service_name, version)
+    except ImportError:
+        pass
+    if document is None:
+        from urllib.request import urlopen
+        url = DISCOVERY_URI.format(api=service_name, apiVersion=version)
+        with urlopen(url) as response:
+            document = response.read().decode('utf-8')
 
-        # Call the Sheets API
-        sheet = service.spreadsheets()
+    write_text(path, document)
+    logger.log_message(f"discovery document cached: {path}")
+    return document
 
-        if not append_mode:
-            # Clear the sheet
-            print("Clearing old values...")
-            sheet.values().clear(
-                spreadsheetId=spreadsheet_id,
-                range=range
-                ).execute()
+def column_to_letters(column_index):
+    '''
+    Converts a 0 based column index to A1 column letters
+    '''
+    letters = ''
+    column_index += 1
+    while column_index > 0:
+        column_index, remainder = divmod(column_index - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
 
-        values = data
-        body = {"values": values}
+def letters_to_column(letters):
+    '''
+    Converts A1 column letters to a 0 based column index
+    '''
+    column_index = 0
+    for letter in letters.upper():
+        column_index = column_index * 26 + ord(letter) - ord('A') + 1
+    return column_index - 1
 
-        if not values:
-            if log_to_sheet:
-                body = {'values': [
-                    ['Status: FAIL'],
-                    ['Reason: no data to upload']
-                ]}
-                result = (
-                    sheet
-                    .values()
-                    .append(
-                        spreadsheetId=spreadsheet_id,
-                        range=range,
-                        valueInputOption='USER_ENTERED',
-                        body=body,
-                    )
-                    .execute()
-                )
+def split_a1_cell(cell):
+    '''
+    Returns (column_index, row_number) of a cell like 'B12', either part may be None
+    '''
+    letters = ''.join(c for c in cell if c.isalpha())
+    digits = ''.join(c for c in cell if c.isdigit())
+    return (
+        letters_to_column(letters) if letters else None,
+        int(digits) if digits else None,
+        )
 
-            print('No data to upload.')
-            logger.log_message('No data to upload.', level=logging.WARNING)
+# Cells of an A1 range, the Sheets column letters go up to ZZZ
+A1_CELLS = re.compile(r'[A-Za-z]{0,3}[0-9]*(:[A-Za-z]{0,3}[0-9]*)?')
+
+def parse_a1_range(range):
+    '''
+    Returns (sheet_name, start_column, start_row, end_column, end_row) of an A1 range
+    like 'Sheet name!A1:P', columns are 0 based and open ends are None. A
+    range that is only a sheet name like 'Sheet1' is the whole sheet from A1
+    '''
+    if '!' in range:
+        sheet_name, cells = range.rsplit('!', 1)
+    elif A1_CELLS.fullmatch(range):
+        sheet_name, cells = None, range
+    else:
+        sheet_name, cells = range, ''
+    if sheet_name and sheet_name.startswith("'") and sheet_name.endswith("'"):
+        sheet_name = sheet_name[1:-1].replace("''", "'")
+    start_cell, end_cell = cells.split(':', 1) if ':' in cells else (cells, cells)
+    start_column, start_row = split_a1_cell(start_cell)
+    end_column, end_row = split_a1_cell(end_cell)
+    return sheet_name, start_column or 0, start_row or 1, end_column, end_row
+
+def a1_range(sheet_name, start_column, start_row, end_column, end_row):
+    '''
+    Builds an A1 range from 0 based columns and 1 based rows
+    '''
+    cells = f"{column_to_letters(start_column)}{start_row}:{column_to_letters(end_column)}{end_row}"
+    if sheet_name is None:
+        return cells
+    return "'" + sheet_name.replace("'", "''") + "'!" + cells
+
+def snapshot_path(spreadsheet_id, range):
+    range_hash = hashlib.sha1(range.encode('utf-8')).hexdigest()
+    return os.path.join(SNAPSHOT_DIR, spreadsheet_id, range_hash + ".json")
+
+def load_snapshot(spreadsheet_id, range):
+    '''
+    Returns the values last written to the range, None if unknown
+    '''
+    try:
+        with open(snapshot_path(spreadsheet_id, range), 'r') as file:
+            return json.load(file)['values']
+    except (IOError, ValueError, KeyError):
+        return None
+
+def save_snapshot(spreadsheet_id, range, values):
+    write_json(snapshot_path(spreadsheet_id, range), {'range': range, 'values': values})
+
+def delete_snapshot(spreadsheet_id, range):
+    if os.path.exists(snapshot_path(spreadsheet_id, range)):
+        os.remove(snapshot_path(spreadsheet_id, range))
+
+def split_into_blocks(values, range, max_rows, max_bytes):
+    '''
+    Yields {'range', 'values'} blocks of at most max_rows rows and about
+    max_bytes of json each, the A1 range of every block is computed from
+    the start of the range
+    '''
+    sheet_name, start_column, start_row, end_column, end_row = parse_a1_range(range)
+    block = []
+    block_bytes = 0
+    block_start_row = start_row
+
+    def make_block():
+        width = max(len(row) for row in block)
+        return {
+            'range': a1_range(
+                sheet_name,
+                start_column,
+                block_start_row,
+                start_column + max(width, 1) - 1,
+                block_start_row + len(block) - 1,
+                ),
+            'values': block,
+            }
+
+    for row in values:
+        row_bytes = len(json.dumps(row, default=str))
+        if block and (len(block) >= max_rows or block_bytes + row_bytes > max_bytes):
+            yield make_block()
+            block_start_row += len(block)
+            block = []
+            block_bytes = 0
+        block.append(row)
+        block_bytes += row_bytes
+
+    if block:
+        yield make_block()
+
+def sheet_values(data):
+    '''
+    Returns the rows of a DataFrame as typed cell values for a RAW write:
+    numbers stay JSON numbers (floats rounded to SHEET_FLOAT_DECIMALS),
+    yyyy-mm-dd texts of the date columns become date serial numbers and
+    missing values are blank
+    '''
+    import pandas as pd
+
+    columns = []
+    for column in data.columns:
+        values = data[column]
+        if COLUMN_FORMATS.get(column, {}).get('type') == 'DATE':
+            # Every distinct date is converted once, texts that are no date (a totals label) are kept
+            texts = values.astype(str)
+            distinct = pd.Series(texts.unique())
+            days = (pd.to_datetime(distinct, format='%Y-%m-%d', errors='coerce') - pd.Timestamp(SHEETS_EPOCH)).dt.days
+            serials = dict(zip(distinct, days.astype('Int64').astype(object).where(days.notna(), distinct)))
+            columns.append(texts.map(serials).tolist())
+            continue
+        if values.dtype.kind == 'f':
+            values = values.round(SHEET_FLOAT_DECIMALS)
+        columns.append(values.astype(object).where(values.notna(), '').tolist())
+
+    return [list(row) for row in zip(*columns)]
+
+def load_formats():
+    try:
+        with open(FORMATS_PATH, 'r') as file:
+            return json.load(file)
+    except (IOError, ValueError):
+        return {}
+
+def save_formats(formats):
+    write_json(FORMATS_PATH, formats)
+
+def format_requests(range, columns, sheet_id):
+    '''
+    Returns the repeatCell requests setting the number format of every
+    column of the range that has one in COLUMN_FORMATS
+    '''
+    sheet_name, start_column, start_row, end_column, end_row = parse_a1_range(range)
+    requests = []
+    for column_index, column in enumerate(columns):
+        if column not in COLUMN_FORMATS:
+            continue
+        grid_range = {
+            'sheetId': sheet_id,
+            'startRowIndex': start_row - 1,
+            'startColumnIndex': start_column + column_index,
+            'endColumnIndex': start_column + column_index + 1,
+            }
+        if end_row is not None:
+            grid_range['endRowIndex'] = end_row
+        requests.append({'repeatCell': {
+            'range': grid_range,
+            'cell': {'userEnteredFormat': {'numberFormat': COLUMN_FORMATS[column]}},
+            'fields': 'userEnteredFormat.numberFormat',
+            }})
+    return requests
+
+def normalize_values(values):
+    '''
+    Returns the values the way they read back from a snapshot
+    '''
+    return json.loads(json.dumps(values, default=str))
+
+def diff_values(old_values, new_values, range):
+    '''
+    Compares the previously written values with the new ones and returns
+    (data, clear_range) where data is the list of changed blocks for a
+    values().batchUpdate and clear_range the trailing rows to clear when
+    the data shrinks (None when it does not)
+    '''
+    sheet_name, start_column, start_row, end_column, end_row = parse_a1_range(range)
+    data = []
+    block = None
+
+    def close_block():
+        if block is None:
             return
-        
-        # Call the Sheets API
-        result = (
-            sheet
+        first_row, last_row, first_column, last_column = block
+        data.append({
+            'range': a1_range(
+                sheet_name,
+                start_column + first_column,
+                start_row + first_row,
+                start_column + last_column,
+                start_row + last_row,
+                ),
+            'values': [
+                (row + [''] * (last_column + 1 - len(row)))[first_column:last_column + 1]
+                for row in padded_rows[first_row:last_row + 1]
+                ],
+            })
+
+    padded_rows = []
+    for row_index, new_row in enumerate(new_values):
+        old_row = old_values[row_index] if row_index < len(old_values) else []
+        # Cells the old row had beyond the new row must be blanked
+        new_row = new_row + [''] * (len(old_row) - len(new_row))
+        padded_rows.append(new_row)
+        changed = [
+            column_index for column_index, cell in enumerate(new_row)
+            if column_index >= len(old_row) or old_row[column_index] != cell
+            ]
+        if not changed:
+            close_block()
+            block = None
+            continue
+        if block is None:
+            block = [row_index, row_index, min(changed), max(changed)]
+        else:
+            block = [block[0], row_index, min(block[2], min(changed)), max(block[3], max(changed))]
+    close_block()
+
+    clear_range = None
+    if len(old_values) > len(new_values):
+        width = max(len(row) for row in old_values[len(new_values):]) if end_column is None else end_column - start_column + 1
+        clear_range = a1_range(
+            sheet_name,
+            start_column,
+            start_row + len(new_values),
+            start_column + max(width, 1) - 1,
+            start_row + len(old_values) - 1,
+            )
+
+    return data, clear_range
+
+class SheetsSession:
+    '''
+    Holds the credentials and the Sheets client for the whole process and
+    gathers the writes queued by each job for each spreadsheet so that they
+    are sent as one batchClear and one batchUpdate on flush. The session is
+    shared by the job threads, every request is sent on the http connection
+    of the calling thread
+    '''
+
+    def __init__(
+        self,
+        credentials_path=CREDENTIALS_PATH,
+        credentials=None,
+        chunk_rows=5000,
+        chunk_bytes=1000000,
+        upload_concurrency=2,
+        upload_retries=3,
+        ):
+        '''
+        chunk_rows, chunk_bytes: size limits of one batchUpdate request,
+            larger writes are split into blocks
+        upload_concurrency: number of blocks uploaded at the same time
+        upload_retries: number of times a failed block is sent again
+        '''
+        self.credentials_path = credentials_path
+        self.chunk_rows = chunk_rows
+        self.chunk_bytes = chunk_bytes
+        self.upload_concurrency = max(1, upload_concurrency)
+        self.upload_retries = upload_retries
+        self._credentials = credentials
+        self._service = None
+        self._pending = {}
+        self._formats = None
+        self._lock = threading.Lock()
+        self._service_lock = threading.Lock()
+        self._thread_http = threading.local()
+
+    @property
+    def credentials(self):
+        if self._credentials is None:
+            # The file token.json stores the user's access and refresh tokens, and is
+            # created automatically when the authorization flow completes for the first
+            # time.
+            # credentials = service_account.Credentials.from_service_account_file('credentials/service-account-credentials.json', scopes=SCOPES)
+            if SHEETS_EMULATOR_HOST:
+                from google.auth.credentials import AnonymousCredentials
+                self._credentials = AnonymousCredentials()
+            else:
+                self._credentials = service_account.Credentials.from_service_account_file(self.credentials_path, scopes=SCOPES)
+        return self._credentials
+
+    @property
+    def service(self):
+        with self._service_lock:
+            if self._service is None:
+                self._service = self._build_service()
+        return self._service
+
+    def _build_service(self):
+        '''
+        Builds the Sheets client, its requests are only built from it and
+        sent on the http of the calling thread (see _http)
+        '''
+        client_options = {'api_endpoint': f"http://{SHEETS_EMULATOR_HOST}/"} if SHEETS_EMULATOR_HOST else None
+        try:
+            return build_from_document(
+                load_discovery_document('sheets', 'v4'),
+                credentials=self.credentials,
+                client_options=client_options,
+                )
+        except (IOError, ValueError) as err:
+            logger.log_message(f"discovery document cache unavailable: {err}", level=logging.WARNING)
+            return build('sheets', 'v4', credentials=self.credentials, client_options=client_options)
+
+    def _http(self):
+        # httplib2 connections are not thread safe, one per thread
+        if not hasattr(self._thread_http, 'http'):
+            import httplib2
+            from google_auth_httplib2 import AuthorizedHttp
+            self._thread_http.http = AuthorizedHttp(self.credentials, http=httplib2.Http())
+        return self._thread_http.http
+
+    def _batches(self, data):
+        '''
+        Groups the queued ranges into size bounded batchUpdate payloads
+        '''
+        batch = []
+        batch_rows = 0
+        batch_bytes = 0
+        for entry in data:
+            for block in split_into_blocks(entry['values'], entry['range'], self.chunk_rows, self.chunk_bytes):
+                block_rows = len(block['values'])
+                block_bytes = len(json.dumps(block['values'], default=str))
+                get_metrics().add(rows=block_rows, bytes=block_bytes)
+                if batch and (batch_rows + block_rows > self.chunk_rows or batch_bytes + block_bytes > self.chunk_bytes):
+                    yield batch
+                    batch = []
+                    batch_rows = 0
+                    batch_bytes = 0
+                batch.append(block)
+                batch_rows += block_rows
+                batch_bytes += block_bytes
+        if batch:
+            yield batch
+
+    def _upload_batch(self, spreadsheet_id, batch):
+        '''
+        Sends one batchUpdate, retrying it when it fails with a transient error
+        '''
+        request = (
+            self.service
+            .spreadsheets()
             .values()
-            .update(
+            .batchUpdate(
                 spreadsheetId=spreadsheet_id,
-                range=range,
-                valueInputOption='USER_ENTERED',
-                body=body,
+                body={
+                    'valueInputOption': 'RAW',
+                    'data': batch,
+                },
             )
-            .execute()
         )
-        # time.sleep(2)
-        if(result):
-            update_range = result["updatedRange"].split('!', 2)[1]
-            update_row_count = result["updatedRows"]
-            logger.log_message(f"google spreadsheet updated")
-            logger.log_message(f"range: {update_range}, rows updated: {update_row_count}")
+        return get_scheduler('sheets').call_with_retries(self.upload_retries, request.execute, http=self._http())
 
-            print("Updating new values...")
-            # time.sleep(2)
-            print("\nUpdate Done!")
-            print("\tUpdated Range: %s" % (update_range))
-            print("\tUpdated Rows: %s" % update_row_count)
-            body = {'values': [
+    def _upload(self, spreadsheet_id, data):
+        '''
+        Uploads the queued ranges, a single request when they fit in one
+        batch and otherwise size bounded blocks with bounded concurrency
+        '''
+        batches = self._batches(data)
+        first_batch = next(batches, None)
+        if first_batch is None:
+            return []
+        second_batch = next(batches, None)
+        if second_batch is None:
+            return self._upload_batch(spreadsheet_id, first_batch).get('responses', [])
+
+        def remaining_batches():
+            yield first_batch
+            yield second_batch
+            yield from batches
+
+        # Retries in the upload threads count towards the caller's span
+        parent_span = get_metrics().current()
+
+        def upload_batch(batch):
+            with get_metrics().attach(parent_span):
+                return self._upload_batch(spreadsheet_id, batch)
+
+        responses = []
+        with ThreadPoolExecutor(max_workers=self.upload_concurrency) as executor:
+            in_flight = []
+            for batch in remaining_batches():
+                # Keep only a few blocks in memory at a time
+                if len(in_flight) >= self.upload_concurrency * 2:
+                    responses.extend(in_flight.pop(0).result().get('responses', []))
+                in_flight.append(executor.submit(upload_batch, batch))
+            for future in in_flight:
+                responses.extend(future.result().get('responses', []))
+        return responses
+
+    def _pending_writes(self, spreadsheet_id, job_name=None):
+        return self._pending.setdefault((job_name, spreadsheet_id), {
+            'clear': [],
+            'data': [],
+            'formats': [],
+            'snapshots': [],
+            'stale_snapshots': [],
+            })
+
+    def apply_formats(self, spreadsheet_id, ranges):
+        '''
+        Sets the number formats of the columns of the ranges in one
+        batchUpdate, a range keeps its formats so they are only sent again
+        when its columns change
+
+        ranges: list of (range, column names)
+        '''
+        with self._lock:
+            if self._formats is None:
+                self._formats = load_formats()
+            applied = self._formats.setdefault(spreadsheet_id, {})
+            missing = [(range, list(columns)) for range, columns in ranges if applied.get(range) != list(columns)]
+        if not missing:
+            return
+
+        sheet = self.service.spreadsheets()
+        request = sheet.get(spreadsheetId=spreadsheet_id, fields='sheets.properties(sheetId,title)')
+        sheet_ids = [
+            (properties['title'], properties['sheetId'])
+            for properties in (entry['properties'] for entry in get_scheduler('sheets').call(request.execute, http=self._http())['sheets'])
+            ]
+        requests = []
+        for range, columns in missing:
+            sheet_name = parse_a1_range(range)[0]
+            # A range without a sheet name is on the first sheet
+            sheet_id = dict(sheet_ids).get(sheet_name) if sheet_name else sheet_ids[0][1]
+            if sheet_id is None:
+                logger.log_message(f"sheet of range '{range}' not found, its number formats are not set", level=logging.WARNING)
+                continue
+            requests.extend(format_requests(range, columns, sheet_id))
+
+        if requests:
+            request = sheet.batchUpdate(spreadsheetId=spreadsheet_id, body={'requests': requests})
+            get_scheduler('sheets').call_with_retries(self.upload_retries, request.execute, http=self._http())
+            logger.log_message(f"number formats set for {len(missing)} range(s)")
+
+        with self._lock:
+            applied.update(missing)
+            save_formats(self._formats)
+
+    def queue_update(
+        self,
+        data,
+        meta,
+        spreadsheet_id,
+        range,
+        append_mode = False,
+        log_to_sheet = False,
+        diff_mode = False,
+        columns = None,
+        job_name = None,
+        ):
+        '''
+        Queues the data for the range, in diff mode only the cells that
+        changed since the last write to the range are queued. Status rows
+        are written below the data when log_to_sheet is set. The values are
+        written as they are (see sheet_values), columns names the columns of
+        the data so that their number formats are set on flush. The writes
+        of a job_name are only sent by the flush of that job
+        '''
+        values = normalize_values(data) if diff_mode else data
+        sheet_name, start_column, start_row, end_column, end_row = parse_a1_range(range)
+
+        if append_mode:
+            # Appending needs the last used row of the sheet, it is not batched
+            if values:
+                self.append(spreadsheet_id, range, values)
+            else:
+                print('No data to upload.')
+                logger.log_message('No data to upload.', level=logging.WARNING)
+            return
+
+        if not values:
+            print('No data to upload.')
+            logger.log_message('No data to upload.', level=logging.WARNING)
+
+        status_rows = None
+        if log_to_sheet and not values:
+            status_rows = [
+                ['Status: FAIL'],
+                ['Reason: no data to upload']
+            ]
+        elif log_to_sheet:
+            status_rows = [
                 # [f'Rows Range: {update_range}'],
                 # [f'Rows Updated: {update_row_count}'],
                 ['Status: SUCCESS'],
                 [f"Script Execution began at: {meta['script_start_time']} {meta['timezone']}"],
-            ]}
-            if log_to_sheet:
-                result = (
-                    sheet
-                    .values()
-                    .append(
-                        spreadsheetId=spreadsheet_id,
-                        range=range,
-                        valueInputOption='USER_ENTERED',
-                        body=body,
-                    )
-                    .execute()
-                )
-        elif log_to_sheet:
-            body = {'values': [
-                ['Status: FAIL'],
-                ['Reason: unable to upload data']
-            ]}
-            result = (
-                sheet
+            ]
+
+        with self._lock:
+            pending = self._pending_writes(spreadsheet_id, job_name)
+            if columns:
+                pending['formats'].append((range, columns))
+            snapshot = load_snapshot(spreadsheet_id, range) if diff_mode and values else None
+
+            if snapshot is not None:
+                changed_data, clear_range = diff_values(snapshot, values, range)
+                if clear_range:
+                    # Only clear the rows the data no longer covers
+                    pending['clear'].append(clear_range)
+                pending['data'].extend(changed_data)
+                logger.log_message(f"range: {range}, blocks queued (diff): {len(changed_data)}, cleared: {clear_range}")
+            else:
+                pending['clear'].append(range)
+                if values:
+                    pending['data'].append({'range': range, 'values': values})
+
+            if status_rows:
+                status_column = start_column + len(values[0]) - 1 if values else start_column
+                pending['data'].append({
+                    'range': a1_range(
+                        sheet_name,
+                        start_column,
+                        start_row + len(values),
+                        max(start_column, status_column),
+                        start_row + len(values) + len(status_rows) - 1,
+                        ),
+                    'values': status_rows,
+                    })
+
+            if diff_mode:
+                if values:
+                    pending['snapshots'].append((range, values))
+                else:
+                    pending['stale_snapshots'].append(range)
+
+    def append(self, spreadsheet_id, range, values):
+        '''
+        Appends the rows after the last row of the range, raises when the
+        append fails
+        '''
+        try:
+            request = (
+                self.service
+                .spreadsheets()
                 .values()
                 .append(
                     spreadsheetId=spreadsheet_id,
                     range=range,
-                    valueInputOption='USER_ENTERED',
-                    body=body,
+                    valueInputOption='RAW',
+                    body={'values': values},
                 )
-                .execute()
             )
-    except HttpError as err:
-        logger.log_message(err, level=logging.ERROR)
-        print(err)
+            result = get_scheduler('sheets').call(request.execute, http=self._http())
+            logger.log_message(f"google spreadsheet appended, range: {result['updates']['updatedRange']}")
+            return result
+        except HttpError as err:
+            logger.log_message(err, level=logging.ERROR)
+            print(err)
+            raise
+
+    def write_stream(self, spreadsheet_id, range, rows, columns=None):
+        '''
+        Clears the range and writes the rows of an iterable to it block by
+        block, only the blocks in flight are held in memory. Nothing is
+        queued, and there is no diff mode or status rows for a stream.
+        columns names the columns of the rows for their number formats
+
+        Returns the number of rows written, raises when a request fails
+        (the range may then be partly written and the rows partly read)
+        '''
+        sheet = self.service.spreadsheets()
+        try:
+            with get_metrics().span('sheets_upload', spreadsheet_id=spreadsheet_id):
+                if columns:
+                    try:
+                        self.apply_formats(spreadsheet_id, [(range, columns)])
+                    except HttpError as err:
+                        logger.log_message(f"number formats not set: {err}", level=logging.WARNING)
+                request = sheet.values().batchClear(spreadsheetId=spreadsheet_id, body={'ranges': [range]})
+                get_scheduler('sheets').call(request.execute, http=self._http())
+                responses = self._upload(spreadsheet_id, [{'range': range, 'values': rows}])
+        except HttpError as err:
+            logger.log_message(err, level=logging.ERROR)
+            print(err)
+            raise
+        finally:
+            # A diff snapshot of the range no longer matches the sheet
+            delete_snapshot(spreadsheet_id, range)
+
+        rows_written = sum(response.get("updatedRows", 0) for response in responses)
+        logger.log_message(f"range: {range}, rows written (streaming): {rows_written}")
+        return rows_written
+
+    def flush(self, spreadsheet_id=None, job_name=None):
+        '''
+        Sends the writes the job queued for the spreadsheet (every queued
+        write when spreadsheet_id is None), one batchClear and one
+        batchUpdate per spreadsheet unless the writes are larger than one
+        chunk. The writes other jobs queued for the spreadsheet are left
+        for their own flush
+
+        Raises the error of the first spreadsheet that failed once the
+        others were sent, the snapshots of the failed writes are dropped
+        '''
+        with self._lock:
+            if spreadsheet_id is None:
+                keys = list(self._pending)
+            else:
+                keys = [(job_name, spreadsheet_id)]
+            batches = [(key[1], self._pending.pop(key)) for key in keys if key in self._pending]
+
+        failure = None
+        for key, pending in batches:
+            sheet = self.service.spreadsheets()
+            try:
+                with get_metrics().span('sheets_upload', spreadsheet_id=key):
+                    self._flush_spreadsheet(sheet, key, pending)
+            except Exception as err:
+                # The sheet may be partly written, do a full write next time
+                for range, values in pending['snapshots']:
+                    delete_snapshot(key, range)
+                logger.log_message(err, level=logging.ERROR)
+                print(err)
+                failure = failure or err
+        if failure is not None:
+            raise failure
+
+    def _flush_spreadsheet(self, sheet, key, pending):
+        '''
+        Sends the queued clears and writes of one spreadsheet
+        '''
+        if pending['formats']:
+            try:
+                self.apply_formats(key, pending['formats'])
+            except HttpError as err:
+                # The values are still written, only their display differs
+                logger.log_message(f"number formats not set: {err}", level=logging.WARNING)
+
+        if pending['clear']:
+            print("Clearing old values...")
+            request = sheet.values().batchClear(
+                spreadsheetId=key,
+                body={'ranges': pending['clear']},
+                )
+            get_scheduler('sheets').call(request.execute, http=self._http())
+
+        if pending['data']:
+            print("Updating new values...")
+            responses = self._upload(key, pending['data'])
+            logger.log_message("google spreadsheet updated")
+            print("\nUpdate Done!")
+            for response in responses:
+                update_range = response["updatedRange"].split('!', 2)[1]
+                update_row_count = response.get("updatedRows", 0)
+                logger.log_message(f"range: {update_range}, rows updated: {update_row_count}")
+                print("\tUpdated Range: %s" % (update_range))
+                print("\tUpdated Rows: %s" % update_row_count)
+
+        for range, values in pending['snapshots']:
+            save_snapshot(key, range, values)
+        for range in pending['stale_snapshots']:
+            delete_snapshot(key, range)
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session(**options):
+    '''
+    Returns the process wide Sheets session, the options are passed to
+    SheetsSession when the session is created
+    '''
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = SheetsSession(**options)
+        return _session
+
+def set_session(session):
+    '''
+    Replaces the process wide Sheets session
+    '''
+    global _session
+    with _session_lock:
+        _session = session
+
+def update_g_sheet(
+    data, 
+    meta, 
+    spreadsheet_id,
+    range,
+    append_mode = False,
+    log_to_sheet = False,
+    diff_mode = False,
+    columns = None,
+    ):
+    '''
+    Writes the data to the range right away, in diff mode only the cells
+    that changed since the last write to the range are sent
+    '''
+    session = get_session()
+    session.queue_update(
+        data,
+        meta,
+        spreadsheet_id,
+        range,
+        append_mode=append_mode,
+        log_to_sheet=log_to_sheet,
+        diff_mode=diff_mode,
+        columns=columns,
+        )
+    try:
+        session.flush(spreadsheet_id)
+    except HttpError:
+        # Logged by flush, the callers of this function do not handle it
+        pass
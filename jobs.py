@@ -0,0 +1,143 @@
+'''Jobs
+
+This module reads the account -> spreadsheet jobs from env.json and runs
+them concurrently in one process
+'''
+import re
+import sys
+import logging
+import logger
+
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_JOB_NAME = "default"
+
+def load_jobs(environment_info):
+    '''
+    Returns the jobs listed in JOBS, or a single job built from
+    DEFAULT_SPREADSHEET_ID/DEFAULT_SPREADSHEET_RANGE when there are none
+
+    A job looks like:
+    {
+        "name": "client-a",
+        "accounts": {"ids": [123], "name_contains": "Client A", "name_regex": "^CA-"},
+        "report": {"aggregation": "daily"},
+        "reports": [{"type": "keyword", "range": "Keywords!A1:T"}],
+        "window": {"days": 7, "end_offset_days": 1},
+        "spreadsheet_id": "...",
+        "range": "Sheet name!A1:P",
+        "summary_range": "Sheet6!A1:O",
+        "pivots": [{"range": "Sheet6!A1:O", "group_by": ["AccountName"]}],
+        "streaming": false,
+        "schedule": "0 * * * *"
+    }
+    every field but name, spreadsheet_id and range is optional. Each pivot
+    is a pivot spec (see pivot.DEFAULT_PIVOT) with the range it is written
+    to, summary_range is a shorthand for the default pivot, a pivot with a
+    period (see rollup.PERIODS) is built from the rollup cube. Each entry of
+    reports is a report type of report_types.REPORT_TYPES fetched alongside
+    the ad performance report and written to its own range. A streaming job
+    writes the report rows to the sheet chunk by chunk as they are read,
+    schedule is the cron expression the daemon runs the job at
+    '''
+    from report_types import get_report_type
+    from rollup import check_period_spec
+
+    jobs = environment_info.get("JOBS")
+    if not jobs:
+        jobs = [{
+            "name": DEFAULT_JOB_NAME,
+            "spreadsheet_id": environment_info["DEFAULT_SPREADSHEET_ID"],
+            "range": environment_info["DEFAULT_SPREADSHEET_RANGE"],
+            "summary_range": "Sheet6!A1:O",
+            "pivots": environment_info.get("PIVOTS"),
+        }]
+
+    names = set()
+    normalized = []
+    for job in jobs:
+        if job["name"] in names:
+            raise ValueError(f"duplicate job name '{job['name']}'")
+        names.add(job["name"])
+        pivots = job.get("pivots")
+        if pivots is None:
+            pivots = [{"range": job["summary_range"]}] if job.get("summary_range") else []
+        for pivot in pivots:
+            if not pivot.get("range"):
+                raise ValueError(f"pivot of job '{job['name']}' has no range")
+            if pivot.get("period"):
+                check_period_spec(pivot)
+        reports = job.get("reports", [])
+        for report in reports:
+            get_report_type(report.get("type"))
+            if not report.get("range"):
+                raise ValueError(f"report '{report['type']}' of job '{job['name']}' has no range")
+        normalized.append({
+            "name": job["name"],
+            "accounts": job.get("accounts", {}),
+            "report": {"aggregation": "daily", **job.get("report", {})},
+            "window": {"days": 7, "end_offset_days": 1, **job.get("window", {})},
+            "spreadsheet_id": job["spreadsheet_id"],
+            "range": job["range"],
+            "summary_range": job.get("summary_range"),
+            "pivots": pivots,
+            "reports": reports,
+            "diff_mode": job.get("diff_mode", environment_info.get("SHEETS_DIFF_MODE", False)),
+            "streaming": job.get("streaming", environment_info.get("STREAMING_MODE", False)),
+            "schedule": job.get("schedule", environment_info.get("DAEMON_SCHEDULE", "0 * * * *")),
+        })
+    return normalized
+
+def filter_accounts(accounts, account_filter):
+    '''
+    Returns the (account_id, account_name) pairs matching the job's account filter
+    '''
+    ids = set(str(account_id) for account_id in account_filter.get("ids", []))
+    name_contains = account_filter.get("name_contains")
+    name_regex = re.compile(account_filter["name_regex"]) if account_filter.get("name_regex") else None
+
+    matching = []
+    for account_id, account_name in accounts:
+        if ids and str(account_id) not in ids:
+            continue
+        if name_contains and name_contains.lower() not in (account_name or '').lower():
+            continue
+        if name_regex and not name_regex.search(account_name or ''):
+            continue
+        matching.append((account_id, account_name))
+    return matching
+
+def job_window(job, today):
+    '''
+    Returns (start_date, end_date) of the job's date window
+    '''
+    end_date = today - timedelta(days=job["window"]["end_offset_days"])
+    start_date = end_date - timedelta(days=job["window"]["days"] - 1)
+    return start_date, end_date
+
+def run_jobs(jobs, run_job, concurrency=2):
+    '''
+    Calls run_job(job) for every job with at most concurrency jobs at the
+    same time, a failing job does not stop the others. A job fails when
+    run_job raises or returns False
+
+    Returns {job name: True if the job succeeded}
+    '''
+    def run(job):
+        logger.log_message(f"job '{job['name']}' started")
+        try:
+            if run_job(job) is False:
+                logger.log_message(f"job '{job['name']}' failed", level=logging.ERROR)
+                return False
+            logger.log_message(f"job '{job['name']}' finished")
+            return True
+        except Exception:
+            logger.log_message(f"job '{job['name']}' failed: {sys.exc_info()}", level=logging.ERROR)
+            print(f"\nJOB {job['name']} : processing Failed : ", sys.exc_info())
+            return False
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        results = list(executor.map(run, jobs))
+
+    return {job["name"]: result for job, result in zip(jobs, results)}
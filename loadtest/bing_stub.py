@@ -0,0 +1,243 @@
+'''Bing Ads Stub
+
+This module is a local stand-in for the Bing Ads CustomerManagementService
+(GetUser, SearchAccounts) and ReportingService (SubmitGenerateReport,
+PollGenerateReport and the zipped report download) used by main.py. The
+SOAP requests are sent here when BING_ADS_EMULATOR_HOST is set
+'''
+import io
+import os
+import sys
+import time
+import uuid
+import zipfile
+import threading
+
+from datetime import date
+from xml.sax.saxutils import escape
+from xml.etree import ElementTree
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(script_dir), "bench"))
+
+from stub_server import StubHandler
+from synthetic_report import synthetic_report, format_report
+
+CUSTOMER_NS = "https://bingads.microsoft.com/Customer/v13"
+ENTITIES_NS = "https://bingads.microsoft.com/Customer/v13/Entities"
+REPORTING_NS = "https://bingads.microsoft.com/Reporting/v13"
+
+ENVELOPE = (
+    '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/">'
+    '<s:Header><TrackingId xmlns="{namespace}">{tracking_id}</TrackingId></s:Header>'
+    '<s:Body>{body}</s:Body>'
+    '</s:Envelope>'
+    )
+
+# Fault returned by the Bing Ads services when the call rate is exceeded
+THROTTLING_FAULT = (
+    '<s:Fault><faultcode>s:Server</faultcode>'
+    '<faultstring>Invalid client data. Check the SOAP fault details for more information.</faultstring>'
+    '<detail><AdApiFaultDetail xmlns="https://adapi.microsoft.com">'
+    '<TrackingId>{tracking_id}</TrackingId>'
+    '<Errors><AdApiError><Code>117</Code><ErrorCode>CallRateExceeded</ErrorCode>'
+    '<Message>You have exceeded the number of calls that you are allowed to make in one minute.</Message>'
+    '</AdApiError></Errors></AdApiFaultDetail></detail></s:Fault>'
+    )
+
+def local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+def find_element(root, name):
+    for element in root.iter():
+        if local_name(element.tag) == name:
+            return element
+    return None
+
+def element_date(element):
+    values = {local_name(child.tag): int(child.text) for child in element}
+    return date(values['Year'], values['Month'], values['Day'])
+
+class BingAdsState:
+    '''
+    The accounts served by SearchAccounts and the submitted reports
+    '''
+
+    def __init__(self, accounts, rows_per_day=12, report_seconds=2.0, report_seconds_per_1000_rows=0.5, user_id=1, customer_id=1):
+        '''
+        accounts: number of accounts
+        report_seconds, report_seconds_per_1000_rows: time a report takes to be ready
+        '''
+        self.accounts = [(100000 + index, f"Load test account {index}") for index in range(accounts)]
+        self.account_names = dict(self.accounts)
+        self.rows_per_day = rows_per_day
+        self.report_seconds = report_seconds
+        self.report_seconds_per_1000_rows = report_seconds_per_1000_rows
+        self.user_id = user_id
+        self.customer_id = customer_id
+        self.reports = {}
+        self._lock = threading.Lock()
+
+    def submit(self, account_ids, start_date, end_date, columns=None):
+        days = (end_date - start_date).days + 1
+        rows = len(account_ids) * days * self.rows_per_day
+        report_id = uuid.uuid4().hex
+        with self._lock:
+            self.reports[report_id] = {
+                'account_ids': account_ids,
+                'start_date': start_date,
+                'end_date': end_date,
+                'rows': rows,
+                'columns': columns,
+                'submitted_at': time.monotonic(),
+                'ready_at': time.monotonic() + self.report_seconds + rows / 1000.0 * self.report_seconds_per_1000_rows,
+                'downloaded_at': None,
+                }
+        return report_id
+
+    def report(self, report_id):
+        with self._lock:
+            return self.reports.get(report_id)
+
+    def report_file(self, report_id):
+        '''
+        Returns the zipped csv of the report
+        '''
+        report = self.report(report_id)
+        account_ids = [account_id for account_id in report['account_ids'] if account_id in self.account_names]
+        data = synthetic_report(
+            [self.account_names[account_id] for account_id in account_ids],
+            (report['end_date'] - report['start_date']).days + 1,
+            rows_per_day=self.rows_per_day,
+            end_date=report['end_date'],
+            seed=int(report_id[:8], 16),
+            account_ids=account_ids,
+            )
+        if report['columns']:
+            # Columns the ad performance report has not are filled with a few distinct values
+            for column in report['columns']:
+                if column not in data.columns:
+                    data[column] = [f"Load test {column} {index % 7}" for index in range(len(data))]
+            data = data[report['columns']]
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr(f"{report_id}.csv", format_report(data).encode('utf-8-sig'))
+        with self._lock:
+            report['downloaded_at'] = time.monotonic()
+        return buffer.getvalue(), len(data)
+
+    def turnaround_seconds(self):
+        '''
+        Returns the submit -> download time of every downloaded report
+        '''
+        with self._lock:
+            return [
+                report['downloaded_at'] - report['submitted_at']
+                for report in self.reports.values()
+                if report['downloaded_at'] is not None
+                ]
+
+class BingAdsHandler(StubHandler):
+
+    def soap_response(self, namespace, body, status=200):
+        envelope = ENVELOPE.format(namespace=namespace, tracking_id=uuid.uuid4(), body=body)
+        self.send(status, envelope.encode('utf-8'), 'text/xml; charset=utf-8')
+
+    def do_POST(self):
+        request = ElementTree.fromstring(self.read_body())
+        operation = (self.headers.get('SOAPAction') or '').strip('"')
+        namespace = REPORTING_NS if self.path.startswith('/ReportingService') else CUSTOMER_NS
+        handlers = {
+            'GetUser': self.get_user,
+            'SearchAccounts': self.search_accounts,
+            'SubmitGenerateReport': self.submit_generate_report,
+            'PollGenerateReport': self.poll_generate_report,
+            }
+        if operation not in handlers:
+            self.send(404, f"unknown operation {operation}".encode('utf-8'), 'text/plain')
+            return
+
+        self.handle_call(
+            operation,
+            lambda: handlers[operation](request),
+            lambda: self.soap_response(namespace, THROTTLING_FAULT.format(tracking_id=uuid.uuid4()), status=500),
+            lambda: self.send(503, b'Service Unavailable', 'text/plain'),
+            )
+
+    def get_user(self, request):
+        state = self.server.state
+        self.soap_response(CUSTOMER_NS, (
+            f'<GetUserResponse xmlns="{CUSTOMER_NS}">'
+            f'<User xmlns:a="{ENTITIES_NS}"><a:CustomerId>{state.customer_id}</a:CustomerId><a:Id>{state.user_id}</a:Id><a:UserName>loadtest</a:UserName></User>'
+            '<CustomerRoles xmlns:i="http://www.w3.org/2001/XMLSchema-instance" i:nil="true"/>'
+            '</GetUserResponse>'
+            ))
+
+    def search_accounts(self, request):
+        state = self.server.state
+        paging = find_element(request, 'PageInfo')
+        index = int(find_element(paging, 'Index').text)
+        size = int(find_element(paging, 'Size').text)
+        page = state.accounts[index * size:(index + 1) * size]
+        accounts = ''.join(
+            '<a:AdvertiserAccount>'
+            f'<a:CurrencyCode>GBP</a:CurrencyCode><a:Id>{account_id}</a:Id><a:Name>{escape(account_name)}</a:Name>'
+            f'<a:ParentCustomerId>{state.customer_id}</a:ParentCustomerId>'
+            '</a:AdvertiserAccount>'
+            for account_id, account_name in page
+            )
+        self.soap_response(CUSTOMER_NS, (
+            f'<SearchAccountsResponse xmlns="{CUSTOMER_NS}">'
+            f'<Accounts xmlns:a="{ENTITIES_NS}">{accounts}</Accounts>'
+            '</SearchAccountsResponse>'
+            ))
+
+    def submit_generate_report(self, request):
+        account_ids = [int(element.text) for element in find_element(request, 'AccountIds')]
+        columns = find_element(request, 'Columns')
+        report_id = self.server.state.submit(
+            account_ids,
+            element_date(find_element(request, 'CustomDateRangeStart')),
+            element_date(find_element(request, 'CustomDateRangeEnd')),
+            columns=[element.text for element in columns] if columns is not None else None,
+            )
+        self.soap_response(REPORTING_NS, (
+            f'<SubmitGenerateReportResponse xmlns="{REPORTING_NS}">'
+            f'<ReportRequestId>{report_id}</ReportRequestId>'
+            '</SubmitGenerateReportResponse>'
+            ))
+
+    def poll_generate_report(self, request):
+        report_id = find_element(request, 'ReportRequestId').text
+        report = self.server.state.report(report_id)
+        if report is None:
+            status, url = 'Error', ''
+        elif time.monotonic() < report['ready_at']:
+            status, url = 'Pending', ''
+        else:
+            host, port = self.server.server_address
+            status, url = 'Success', f"http://{host}:{port}/reports/{report_id}.zip"
+        self.soap_response(REPORTING_NS, (
+            f'<PollGenerateReportResponse xmlns="{REPORTING_NS}">'
+            f'<ReportRequestStatus><ReportDownloadUrl>{url}</ReportDownloadUrl><Status>{status}</Status></ReportRequestStatus>'
+            '</PollGenerateReportResponse>'
+            ))
+
+    def do_GET(self):
+        report_id = os.path.splitext(os.path.basename(self.path))[0]
+        if not self.path.startswith('/reports/') or self.server.state.report(report_id) is None:
+            self.send(404, b'Not Found', 'text/plain')
+            return
+
+        def respond():
+            content, rows = self.server.state.report_file(report_id)
+            self.server.stats.count('report_rows', rows)
+            self.server.stats.count('report_bytes', len(content))
+            self.send(200, content, 'application/zip')
+
+        self.handle_call(
+            'DownloadReport',
+            respond,
+            lambda: self.send(429, b'Too Many Requests', 'text/plain', {'Retry-After': '1'}),
+            lambda: self.send(503, b'Service Unavailable', 'text/plain'),
+            )
@@ -0,0 +1,191 @@
+'''Load Test
+
+This module runs main.py end to end against local stand-ins of the Bing Ads
+and Sheets APIs and reports the throughput and the latency percentiles of
+every operation. Nothing is sent to the real APIs, the run uses its own
+settings file and work folder
+
+Usage: python3 loadtest/run_loadtest.py [--accounts 2000] [--days 7]
+    [--latency-ms 50] [--throttle-rate 0.01] [--failure-rate 0.01]
+    [--set REPORT_SHARD_ACCOUNTS=200 --set REPORT_MAX_CONCURRENCY=8]
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+from datetime import datetime, timezone
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(script_dir)
+
+from stub_server import StubBehaviour, start_server, percentile
+from bing_stub import BingAdsHandler, BingAdsState
+from sheets_stub import SheetsHandler
+
+# Settings of the load test run, --set overrides them
+DEFAULT_SETTINGS = {
+    "CLIENT_ID": "loadtest",
+    "DEVELOPER_TOKEN": "loadtest",
+    "ENVIRONMENT": "production",
+    "DEFAULT_SPREADSHEET_ID": "loadtest",
+    "DEFAULT_SPREADSHEET_RANGE": "Sheet1!A1:P",
+    "REPORT_POLL_MIN_SECONDS": 0.5,
+    "REPORT_POLL_MAX_SECONDS": 5,
+    }
+
+def parse_setting(text):
+    '''
+    Returns (name, value) of a NAME=VALUE setting, the value is read as json when possible
+    '''
+    name, _, value = text.partition('=')
+    try:
+        return name, json.loads(value)
+    except ValueError:
+        return name, value
+
+def sheet_titles(settings):
+    '''
+    Returns {title: sheet id} of the sheets the ranges of the settings write to
+    '''
+    ranges = [settings.get("DEFAULT_SPREADSHEET_RANGE") or ""]
+    for job in settings.get("JOBS") or []:
+        ranges.extend([job.get("range") or "", job.get("summary_range") or ""])
+        ranges.extend(entry.get("range") or "" for entry in (job.get("pivots") or []) + (job.get("reports") or []))
+    titles = {}
+    for range in ranges:
+        if '!' in range:
+            titles.setdefault(range.rsplit('!', 1)[0].strip("'"), len(titles))
+    return titles
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Runs main.py against local stand-ins of the Bing Ads and Sheets APIs")
+    parser.add_argument('--accounts', type=int, default=2000)
+    parser.add_argument('--days', type=int, default=7, help="days of the job window")
+    parser.add_argument('--rows-per-day', type=int, default=4, help="report rows per account and day")
+    parser.add_argument('--latency-ms', type=float, default=50, help="mean latency of every call")
+    parser.add_argument('--jitter-ms', type=float, default=20, help="standard deviation of the latency")
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help="fraction of the calls that are throttled")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="fraction of the calls that fail with a transient error")
+    parser.add_argument('--sheets-latency-ms', type=float, help="mean latency of the Sheets calls (default --latency-ms)")
+    parser.add_argument('--report-seconds', type=float, default=2.0, help="time a report takes to be ready")
+    parser.add_argument('--report-seconds-per-1000-rows', type=float, default=0.5)
+    parser.add_argument('--set', dest='settings', action='append', default=[], metavar='NAME=VALUE', help="env.json setting of the run")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="json file the results are written to")
+    parser.add_argument('--keep-work-dir', action='store_true', help="keep the log, reports and store of the run")
+    args = parser.parse_args(argv)
+
+    bing = start_server(
+        BingAdsHandler,
+        StubBehaviour(args.latency_ms, args.jitter_ms, args.throttle_rate, args.failure_rate, seed=args.seed),
+        state=BingAdsState(
+            args.accounts,
+            rows_per_day=args.rows_per_day,
+            report_seconds=args.report_seconds,
+            report_seconds_per_1000_rows=args.report_seconds_per_1000_rows,
+            ),
+        )
+    sheets = start_server(
+        SheetsHandler,
+        StubBehaviour(
+            args.latency_ms if args.sheets_latency_ms is None else args.sheets_latency_ms,
+            args.jitter_ms,
+            args.throttle_rate,
+            args.failure_rate,
+            seed=args.seed + 1,
+            ),
+        )
+
+    settings = dict(DEFAULT_SETTINGS)
+    settings["JOBS"] = [{
+        "name": "loadtest",
+        "window": {"days": args.days, "end_offset_days": 1},
+        "spreadsheet_id": "loadtest",
+        "range": "Sheet1!A1:P",
+        "summary_range": "Sheet6!A1:O",
+        }]
+    settings.update(parse_setting(text) for text in args.settings)
+    sheets.sheets = sheet_titles(settings)
+
+    work_dir = tempfile.mkdtemp(prefix="bing-ads-loadtest-")
+    env_file = os.path.join(work_dir, "env.json")
+    with open(env_file, 'w') as file:
+        json.dump(settings, file, indent=4)
+
+    environment = dict(
+        os.environ,
+        BING_REPORT_ENV_FILE=env_file,
+        BING_REPORT_WORK_DIR=work_dir,
+        BING_ADS_EMULATOR_HOST="%s:%d" % bing.server_address,
+        SHEETS_EMULATOR_HOST="%s:%d" % sheets.server_address,
+        )
+
+    print(f"running main.py for {args.accounts} accounts x {args.days} days, work folder {work_dir}")
+    started = time.monotonic()
+    with open(os.path.join(work_dir, "main.out"), 'w') as output:
+        process = subprocess.run(
+            [sys.executable, os.path.join(repo_dir, "main.py")],
+            cwd=repo_dir,
+            env=environment,
+            stdout=output,
+            stderr=subprocess.STDOUT,
+            stdin=subprocess.DEVNULL,
+            )
+    seconds = time.monotonic() - started
+
+    bing_summary = bing.stats.summary()
+    sheets_summary = sheets.stats.summary()
+    turnaround = bing.state.turnaround_seconds()
+    report_rows = bing_summary['counters'].get('report_rows', 0)
+    results = {
+        'created': datetime.now(timezone.utc).isoformat(),
+        'arguments': vars(args),
+        'settings': settings,
+        'exit_code': process.returncode,
+        'seconds': seconds,
+        'accounts_per_second': args.accounts / seconds,
+        'report_rows': report_rows,
+        'report_rows_per_second': report_rows / seconds,
+        'reports': len(turnaround),
+        'report_turnaround': {
+            'p50_seconds': percentile(turnaround, 0.50),
+            'p90_seconds': percentile(turnaround, 0.90),
+            'p99_seconds': percentile(turnaround, 0.99),
+            },
+        'bing': bing_summary,
+        'sheets': sheets_summary,
+        }
+
+    print(f"exit code {process.returncode} after {seconds:.1f}s, {results['accounts_per_second']:.1f} accounts/s, {results['report_rows_per_second']:.0f} report rows/s")
+    if turnaround:
+        print(f"{len(turnaround)} reports, turnaround p50 {results['report_turnaround']['p50_seconds']:.2f}s p90 {results['report_turnaround']['p90_seconds']:.2f}s p99 {results['report_turnaround']['p99_seconds']:.2f}s")
+    for api, summary in (('bing', bing_summary), ('sheets', sheets_summary)):
+        for operation, stats in summary['operations'].items():
+            print(
+                f"{api:>6} {operation:>22}: {stats['calls']:6d} calls ({stats['throttled']} throttled, {stats['failed']} failed)"
+                f"  p50 {stats['p50_ms']:7.1f} ms  p90 {stats['p90_ms']:7.1f} ms  p99 {stats['p99_ms']:7.1f} ms"
+                )
+        for name, value in summary['counters'].items():
+            print(f"{api:>6} {name:>22}: {value}")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+        print(f"results written to {args.output}")
+
+    if args.keep_work_dir or process.returncode != 0:
+        print(f"log and output of the run kept in {work_dir}")
+    else:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    bing.shutdown()
+    sheets.shutdown()
+    return process.returncode
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,118 @@
+'''Sheets Stub
+
+This module is a local stand-in for the Sheets API endpoints used by
+gs_interface.py (the values batchClear, batchUpdate, update, clear and
+append, and the spreadsheet get and batchUpdate that set the number
+formats). The requests are sent here when SHEETS_EMULATOR_HOST is set, the
+values are counted and dropped. The spreadsheets have the sheets passed
+to start_server as sheets={title: sheet id}
+'''
+import json
+
+from urllib.parse import unquote, urlparse
+
+from stub_server import StubHandler
+
+THROTTLING_ERROR = json.dumps({
+    'error': {
+        'code': 429,
+        'message': "Quota exceeded for quota metric 'Write requests' and limit 'Write requests per minute per user'",
+        'status': 'RESOURCE_EXHAUSTED',
+        },
+    }).encode('utf-8')
+
+UNAVAILABLE_ERROR = json.dumps({
+    'error': {'code': 503, 'message': 'The service is currently unavailable.', 'status': 'UNAVAILABLE'},
+    }).encode('utf-8')
+
+def value_counts(values):
+    '''
+    Returns (rows, cells) of a values array
+    '''
+    values = values or []
+    return len(values), sum(len(row) for row in values)
+
+class SheetsHandler(StubHandler):
+
+    def json_response(self, content, status=200):
+        self.send(status, json.dumps(content).encode('utf-8'), 'application/json; charset=UTF-8')
+
+    def route(self, method):
+        '''
+        Returns (operation, spreadsheet_id, range) of the request path
+        '''
+        parts = urlparse(self.path).path.strip('/').split('/')
+        # v4/spreadsheets/{spreadsheetId}[:batchUpdate], v4/spreadsheets/{spreadsheetId}/values:batchUpdate
+        # or v4/spreadsheets/{spreadsheetId}/values/{range}[:action]
+        if len(parts) == 3 and parts[:2] == ['v4', 'spreadsheets']:
+            spreadsheet_id, separator, action = unquote(parts[2]).partition(':')
+            if action == 'batchUpdate':
+                return 'spreadsheetBatchUpdate', spreadsheet_id, None
+            return ('spreadsheetGet' if not separator and method == 'GET' else None), spreadsheet_id, None
+        if len(parts) < 4 or parts[:2] != ['v4', 'spreadsheets']:
+            return None, None, None
+        spreadsheet_id = unquote(parts[2])
+        if parts[3].startswith('values:'):
+            return parts[3].split(':', 1)[1], spreadsheet_id, None
+        if parts[3] == 'values' and len(parts) >= 5:
+            range = unquote('/'.join(parts[4:]))
+            for action in ('clear', 'append'):
+                if range.endswith(':' + action):
+                    return action, spreadsheet_id, range[:-len(action) - 1]
+            return 'update' if method == 'PUT' else 'get', spreadsheet_id, range
+        return None, None, None
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def dispatch(self, method):
+        body = self.read_body()
+        content = json.loads(body) if body else {}
+        operation, spreadsheet_id, range = self.route(method)
+        stats = self.server.stats
+
+        def respond():
+            stats.count('request_bytes', len(body))
+            if operation == 'batchUpdate':
+                responses = []
+                for entry in content.get('data', []):
+                    rows, cells = value_counts(entry.get('values'))
+                    stats.count('rows_written', rows)
+                    stats.count('cells_written', cells)
+                    responses.append({'spreadsheetId': spreadsheet_id, 'updatedRange': entry['range'], 'updatedRows': rows, 'updatedCells': cells})
+                self.json_response({'spreadsheetId': spreadsheet_id, 'totalUpdatedRows': sum(item['updatedRows'] for item in responses), 'responses': responses})
+            elif operation == 'spreadsheetGet':
+                sheets = getattr(self.server, 'sheets', {})
+                self.json_response({'sheets': [{'properties': {'sheetId': sheet_id, 'title': title}} for title, sheet_id in sheets.items()]})
+            elif operation == 'spreadsheetBatchUpdate':
+                stats.count('format_requests', len(content.get('requests', [])))
+                self.json_response({'spreadsheetId': spreadsheet_id, 'replies': [{} for request in content.get('requests', [])]})
+            elif operation == 'batchClear':
+                stats.count('ranges_cleared', len(content.get('ranges', [])))
+                self.json_response({'spreadsheetId': spreadsheet_id, 'clearedRanges': content.get('ranges', [])})
+            elif operation == 'clear':
+                stats.count('ranges_cleared')
+                self.json_response({'spreadsheetId': spreadsheet_id, 'clearedRange': range})
+            elif operation in ('update', 'append'):
+                rows, cells = value_counts(content.get('values'))
+                stats.count('rows_written', rows)
+                stats.count('cells_written', cells)
+                updates = {'spreadsheetId': spreadsheet_id, 'updatedRange': range, 'updatedRows': rows, 'updatedCells': cells}
+                self.json_response({'spreadsheetId': spreadsheet_id, 'updates': updates} if operation == 'append' else updates)
+
+        if operation not in ('batchUpdate', 'batchClear', 'clear', 'update', 'append', 'spreadsheetGet', 'spreadsheetBatchUpdate'):
+            self.send(404, b'{"error": {"code": 404, "message": "Not Found"}}', 'application/json')
+            return
+
+        self.handle_call(
+            operation,
+            respond,
+            lambda: self.send(429, THROTTLING_ERROR, 'application/json; charset=UTF-8'),
+            lambda: self.send(503, UNAVAILABLE_ERROR, 'application/json; charset=UTF-8'),
+            )
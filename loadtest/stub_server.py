@@ -0,0 +1,141 @@
+'''Stub Server
+
+This module holds the parts shared by the local stand-ins of the Bing Ads
+and Sheets APIs: the injected latency, throttling and failures and the
+per operation statistics
+'''
+import math
+import time
+import random
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+def percentile(values, fraction):
+    '''
+    Returns the value below which the fraction of the values fall (nearest rank)
+    '''
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+class StubBehaviour:
+    '''
+    Latency (mean and jitter in milliseconds) and the fraction of the calls
+    that are throttled or fail with a transient error
+    '''
+
+    def __init__(self, latency_ms=50, jitter_ms=20, throttle_rate=0.0, failure_rate=0.0, seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.throttle_rate = throttle_rate
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def next_call(self):
+        '''
+        Returns (delay in seconds, outcome) for the next call, outcome is
+        'ok', 'throttled' or 'failed'
+        '''
+        with self._lock:
+            delay = max(0.0, self._random.gauss(self.latency_ms, self.jitter_ms)) / 1000.0
+            draw = self._random.random()
+        if draw < self.throttle_rate:
+            return delay, 'throttled'
+        if draw < self.throttle_rate + self.failure_rate:
+            return delay, 'failed'
+        return delay, 'ok'
+
+class StubStats:
+    '''
+    Handling time and outcome of every call, per operation
+    '''
+
+    def __init__(self):
+        self._calls = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def record(self, operation, seconds, outcome):
+        with self._lock:
+            self._calls.setdefault(operation, []).append((seconds, outcome))
+
+    def count(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def summary(self):
+        '''
+        Returns {'operations': {operation: {calls, throttled, failed, p50_ms, p90_ms, p99_ms}}, 'counters': {...}}
+        '''
+        with self._lock:
+            calls = {operation: list(entries) for operation, entries in self._calls.items()}
+            counters = dict(self._counters)
+
+        operations = {}
+        for operation, entries in sorted(calls.items()):
+            seconds = [entry[0] for entry in entries]
+            operations[operation] = {
+                'calls': len(entries),
+                'throttled': sum(1 for entry in entries if entry[1] == 'throttled'),
+                'failed': sum(1 for entry in entries if entry[1] == 'failed'),
+                'p50_ms': percentile(seconds, 0.50) * 1000,
+                'p90_ms': percentile(seconds, 0.90) * 1000,
+                'p99_ms': percentile(seconds, 0.99) * 1000,
+                }
+        return {'operations': operations, 'counters': counters}
+
+class StubHandler(BaseHTTPRequestHandler):
+    '''
+    Base request handler, the server carries the behaviour and the stats
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        # Keep the harness output readable
+        pass
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def send(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_call(self, operation, respond, throttled, failed, injected=True):
+        '''
+        Sleeps for the injected latency and sends the response of respond(),
+        throttled() or failed() depending on the drawn outcome
+        '''
+        started = time.monotonic()
+        delay, outcome = self.server.behaviour.next_call() if injected else (0.0, 'ok')
+        time.sleep(delay)
+        if outcome == 'throttled':
+            throttled()
+        elif outcome == 'failed':
+            failed()
+        else:
+            respond()
+        self.server.stats.record(operation, time.monotonic() - started, outcome)
+
+def start_server(handler_class, behaviour, host='127.0.0.1', port=0, **attributes):
+    '''
+    Starts the stub in a background thread and returns the server, its
+    address is server.server_address
+    '''
+    server = ThreadingHTTPServer((host, port), handler_class)
+    server.daemon_threads = True
+    server.behaviour = behaviour
+    server.stats = StubStats()
+    for name, value in attributes.items():
+        setattr(server, name, value)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -1,37 +1,37 @@
 import sys
-import pandas as pd
 import logging
 import logger
 import json
 import os
+import time
+import threading
 
-from bingads.service_client import ServiceClient
-from bingads.authorization import AuthorizationData, OAuthDesktopMobileAuthCodeGrant
-from currency_converter import CurrencyConverter
-from time import gmtime, strftime
-from suds import WebFault
-from urllib import parse
 from datetime import datetime, timedelta, timezone
-from bingads.v13 import *
-from bingads.v13.reporting import *
-from suds import WebFault
-from suds.client import Client
-from gs_interface import update_g_sheet 
-from cleanup import clear_folder 
+from concurrent.futures import ThreadPoolExecutor
+from metrics import configure_metrics, get_metrics
+
+# pandas, the Bing Ads SDK, suds and the google client are imported where they
+# are first needed, they account for most of the startup time
 
 script_start_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 # Get script path
 script_dir = os.path.dirname(os.path.abspath(__file__))
 
-logger.setup_logger(os.path.join(script_dir, "log/app.log"))
+# Folder the log, the downloaded reports, the report store and the caches are
+# written to, and the settings file (both can be moved for the load tests)
+work_dir = os.environ.get("BING_REPORT_WORK_DIR", script_dir)
+ENV_FILE = os.environ.get("BING_REPORT_ENV_FILE", os.path.join(script_dir, "credentials/env.json"))
+
+logger.setup_logger(os.path.join(work_dir, "log/app.log"))
 
 # Required
-with open(os.path.join(script_dir, "credentials/env.json"), 'r') as file:
+with open(ENV_FILE, 'r') as file:
     ENVIRONMENT_INFO = json.load(file)
 CLIENT_ID = ENVIRONMENT_INFO["CLIENT_ID"]
 DEVELOPER_TOKEN = ENVIRONMENT_INFO["DEVELOPER_TOKEN"]
 ENVIRONMENT = ENVIRONMENT_INFO["ENVIRONMENT"]
 REFRESH_TOKEN = os.path.join(script_dir, "credentials/refresh.txt")
+ACCESS_TOKEN_CACHE = os.path.join(script_dir, "credentials/access_token.json")
 
 # Optional
 CLIENT_STATE=None
@@ -42,33 +42,173 @@ CLIENT_STATE=None
 # logging.getLogger('suds.client').setLevel(logging.DEBUG)
 # logging.getLogger('suds.transport.http').setLevel(logging.DEBUG)
 
-def authenticate(authorization_data):
+def configure_request_limits():
+    '''
+    Applies the per API rate limits and retry settings of env.json
+    '''
+    from request_scheduler import configure_scheduler
 
-    customer_service=ServiceClient(
-        service='CustomerManagementService', 
-        version=13,
-        authorization_data=authorization_data, 
-        environment=ENVIRONMENT,
-    )
+    for api_name, settings in ENVIRONMENT_INFO.get("REQUEST_LIMITS", {}).items():
+        configure_scheduler(api_name, **settings)
 
+def authenticate(authorization_data):
     # You should authenticate for Bing Ads API service operations with a Microsoft Account.
     authenticate_with_oauth(authorization_data)
 
+    # Get the current authenticated Microsoft Advertising user and the accounts
+    # the user can access, from the account cache when it is fresh
+    accounts = get_account_feed(authorization_data).first_page()
+
+    # For this example we'll use the first account.
+    authorization_data.account_id=accounts[0]['Id']
+    authorization_data.customer_id=accounts[0]['ParentCustomerId']
+
+def account_user_key(refresh_token):
+    '''
+    Returns the key of the account list of the user behind the refresh
+    token, a consent of another Microsoft user gets another key
+    '''
+    import hashlib
+
+    token_hash = hashlib.sha256((refresh_token or '').strip().encode('utf-8')).hexdigest()[:16]
+    return f"{CLIENT_ID}:{ENVIRONMENT}:{token_hash}"
+
+def get_account_cache():
+    from credential_cache import AccountCache
+
+    return AccountCache(
+        os.path.join(work_dir, "cache/accounts.json"),
+        ttl_hours=ENVIRONMENT_INFO.get("ACCOUNT_CACHE_TTL_HOURS", 24),
+        )
+
+# AccountFeed of this run
+_account_feed = None
+
+def get_account_feed(authorization_data):
+    '''
+    Returns the AccountFeed of the accounts the user can access, each account
+    is a dict {'Id', 'Name', 'CurrencyCode', 'ParentCustomerId'}. GetUser and
+    SearchAccounts are called at most once per run and only when the account
+    cache is stale, the SearchAccounts pages are then fetched in the
+    background and reach the feed as they arrive
+    '''
+    from account_discovery import AccountFeed, discover_accounts
+    from service_clients import get_service_client
+    from request_scheduler import get_scheduler
+
+    global _account_feed
+    if _account_feed is not None:
+        return _account_feed
+
+    account_cache = get_account_cache()
+    # The cached list belongs to the application, environment and user it was fetched with
+    user_key = account_user_key(get_refresh_token())
+    cached = account_cache.load(user_key)
+    if cached is not None:
+        logger.log_message(f"using the cached account list: {len(cached['accounts'])} account(s)")
+        _account_feed = AccountFeed.from_accounts(cached['accounts'])
+        return _account_feed
+
+    customer_service=get_service_client('CustomerManagementService', authorization_data, ENVIRONMENT)
+
     # Set to an empty user identifier to get the current authenticated Microsoft Advertising user,
     # and then search for all accounts the user can access.
-    user=get_user_response=customer_service.GetUser(
+    get_user_response=get_scheduler('bing').call(
+        customer_service.GetUser,
         UserId=None
-    ).User
-    accounts=search_accounts_by_user_id(customer_service, user.Id)
-
-    # For this example we'll use the first account.
-    authorization_data.account_id=accounts['AdvertiserAccount'][0].Id
-    authorization_data.customer_id=accounts['AdvertiserAccount'][0].ParentCustomerId
+    )
+    user = get_user_response.User
+    # output_status_message("User:")
+    # output_user(user)
+    output_status_message("CustomerRoles:")
+    output_array_of_customerrole(get_user_response.CustomerRoles)
+
+    # The discovery span is a child of the caller's span (the run)
+    parent_span = get_metrics().current()
+    _account_feed = AccountFeed()
+
+    def discover():
+        from suds import WebFault
+
+        try:
+            with get_metrics().attach(parent_span), get_metrics().span('search_accounts') as span:
+                def search_page(page_index, page_size):
+                    # Each worker thread uses its own service client
+                    page_service = get_service_client('CustomerManagementService', authorization_data, ENVIRONMENT)
+                    with get_metrics().attach(span):
+                        page = search_accounts_by_user_id(page_service, user.Id, page_index, page_size)
+                    accounts = [
+                        {
+                            'Id': account.Id,
+                            'Name': account.Name,
+                            'CurrencyCode': str(account.CurrencyCode) if account.CurrencyCode is not None else None,
+                            'ParentCustomerId': account.ParentCustomerId,
+                        }
+                        for account in page
+                    ]
+                    span.add(rows=len(accounts))
+                    return accounts
+
+                discover_accounts(
+                    search_page,
+                    _account_feed,
+                    page_concurrency=ENVIRONMENT_INFO.get("ACCOUNT_PAGE_CONCURRENCY", 4),
+                    # The size of the last account list tells how many pages to request at once
+                    expected_accounts=account_cache.last_count(user_key),
+                    )
+            accounts = _account_feed.accounts()
+            logger.log_message(f"account discovery finished: {len(accounts)} account(s)")
+            account_cache.save(user_key, user.Id, accounts)
+        except WebFault as ex:
+            logger.log_message(ex, level=logging.ERROR)
+            output_webfault_errors(ex)
+        except Exception as ex:
+            logger.log_message(ex, level=logging.ERROR)
+            output_status_message(ex)
+
+    threading.Thread(target=discover, name="account-discovery", daemon=True).start()
+    return _account_feed
+
+def reset_account_feed():
+    '''
+    Drops the AccountFeed of the run once its discovery is over, the next
+    get_account_feed reads the account cache again (a long running process
+    calls it between runs so that the account list follows the cache ttl)
+    '''
+    global _account_feed
+    if _account_feed is not None and _account_feed.done:
+        _account_feed = None
 
 def authenticate_with_oauth(authorization_data):
+    from bingads.authorization import OAuthDesktopMobileAuthCodeGrant, OAuthTokens
+    from bingads.exceptions import OAuthTokenRequestException
+    from request_scheduler import get_scheduler
+    from service_clients import BING_ADS_EMULATOR_HOST
+    from credential_cache import TokenCache
+
+    if BING_ADS_EMULATOR_HOST:
+        # The local stand-in accepts any token
+        authorization_data.authentication=OAuthDesktopMobileAuthCodeGrant(
+            client_id=CLIENT_ID,
+            oauth_tokens=OAuthTokens('emulator', 3600, 'emulator'),
+            env=ENVIRONMENT
+        )
+        return
+
+    refresh_token=get_refresh_token()
+
+    # Reuse the access token of an earlier run until shortly before it expires,
+    # the SDK refreshes it with the refresh token when it expires during the run
+    cached_token = TokenCache(ACCESS_TOKEN_CACHE).load() if refresh_token is not None else None
+    oauth_tokens = None
+    if cached_token is not None:
+        access_token, seconds_left = cached_token
+        oauth_tokens = OAuthTokens(access_token, seconds_left, refresh_token)
+        logger.log_message(f"using the cached access token, expires in {seconds_left}s")
 
     authentication=OAuthDesktopMobileAuthCodeGrant(
         client_id=CLIENT_ID,
+        oauth_tokens=oauth_tokens,
         env=ENVIRONMENT
     )
 
@@ -83,12 +223,17 @@ def authenticate_with_oauth(authorization_data):
     # Uncomment this line if you want to store your refresh token. Be sure to save your refresh token securely.
     authorization_data.authentication.token_refreshed_callback=save_refresh_token
 
-    refresh_token=get_refresh_token()
+    if oauth_tokens is not None:
+        return
 
     try:
         # If we have a refresh token let's refresh it
         if refresh_token is not None:
-            authorization_data.authentication.request_oauth_tokens_by_refresh_token(refresh_token)
+            with get_metrics().span('oauth_refresh'):
+                get_scheduler('bing').call(
+                    authorization_data.authentication.request_oauth_tokens_by_refresh_token,
+                    refresh_token,
+                )
         else:
             request_user_consent(authorization_data)
     except OAuthTokenRequestException:
@@ -130,6 +275,9 @@ def request_user_consent(authorization_data):
     # Request access and refresh tokens using the URI that you provided manually during program execution.
     authorization_data.authentication.request_oauth_tokens_by_response_uri(response_uri=response_uri) 
 
+    # The consent may be of another user, whose accounts differ
+    get_account_cache().invalidate()
+
 def get_refresh_token():
     ''' 
     Returns a refresh token if found.
@@ -149,12 +297,23 @@ def save_refresh_token(oauth_tokens):
     ''' 
     Stores a refresh token locally. Be sure to save your refresh token securely.
     '''
+    from credential_cache import TokenCache
+
+    previous_refresh_token = get_refresh_token()
     with open(REFRESH_TOKEN,"w+") as file:
         file.write(oauth_tokens.refresh_token)
         file.close()
+    TokenCache(ACCESS_TOKEN_CACHE).save(oauth_tokens)
+    # A refreshed token belongs to the same user, its account list stays valid
+    get_account_cache().rekey(account_user_key(previous_refresh_token), account_user_key(oauth_tokens.refresh_token))
     return None
 
-def search_accounts_by_user_id(customer_service, user_id):
+def search_accounts_by_user_id(customer_service, user_id, page_index, page_size):
+    '''
+    Returns one page of the accounts the user can access
+    '''
+    from request_scheduler import get_scheduler
+
     predicates={
         'Predicate': [
             {
@@ -165,31 +324,18 @@ def search_accounts_by_user_id(customer_service, user_id):
         ]
     }
 
-    accounts=[]
-
-    page_index = 0
-    PAGE_SIZE=100
-    found_last_page = False
-
-    while (not found_last_page):
-        paging=set_elements_to_none(customer_service.factory.create('ns5:Paging'))
-        paging.Index=page_index
-        paging.Size=PAGE_SIZE
-        search_accounts_response = customer_service.SearchAccounts(
-            PageInfo=paging,
-            Predicates=predicates
-        )
-
-        if search_accounts_response is not None and hasattr(search_accounts_response, 'AdvertiserAccount'):
-            accounts.extend(search_accounts_response['AdvertiserAccount'])
-            found_last_page = PAGE_SIZE > len(search_accounts_response['AdvertiserAccount'])
-            page_index += 1
-        else:
-            found_last_page=True
+    paging=set_elements_to_none(customer_service.factory.create('ns5:Paging'))
+    paging.Index=page_index
+    paging.Size=page_size
+    search_accounts_response = get_scheduler('bing').call(
+        customer_service.SearchAccounts,
+        PageInfo=paging,
+        Predicates=predicates
+    )
 
-    return {
-        'AdvertiserAccount': accounts
-    }
+    if search_accounts_response is not None and hasattr(search_accounts_response, 'AdvertiserAccount'):
+        return search_accounts_response['AdvertiserAccount']
+    return []
 
 def set_elements_to_none(suds_object):
     for (element) in suds_object:
@@ -372,19 +518,23 @@ def output_user(data_object):
     output_array_of_keyvaluepairofstringstring(data_object.ForwardCompatibilityMap)
     output_status_message("* * * End output_user * * *")
 
-def get_ads_report(authorization_data,account_id,start_date,end_date,qry_type):
+def get_ads_report(authorization_data,account_id,start_date,end_date,qry_type,report_type=None):
+    '''
+    Builds the report request of the accounts and dates, report_type is an
+    entry of report_types (the ad performance report by default)
+    '''
+    from service_clients import get_service_client
+    from report_types import get_report_type, DEFAULT_REPORT_TYPE
+
+    report_type = report_type or get_report_type(DEFAULT_REPORT_TYPE)
+
     try:
         startDate = date_validation(start_date)
         dt = startDate+timedelta(1)
         week_number = dt.isocalendar()[1]
         endDate = date_validation(end_date)
 
-        reporting_service = ServiceClient(
-            service='ReportingService', 
-            version=13,
-            authorization_data=authorization_data, 
-            environment='production',
-            )
+        reporting_service = get_service_client('ReportingService', authorization_data, 'production')
 
         if qry_type in ["day","daily"]:
             aggregation = 'Daily'
@@ -408,7 +558,7 @@ def get_ads_report(authorization_data,account_id,start_date,end_date,qry_type):
         time.ReportTimeZone='PacificTimeUSCanadaTijuana'
         return_only_complete_data=False
         
-        report_request=reporting_service.factory.create('AdPerformanceReportRequest')
+        report_request=reporting_service.factory.create(report_type["request"])
         report_request.Aggregation=aggregation
         report_request.ExcludeColumnHeaders=exclude_column_headers
         report_request.ExcludeReportFooter=exclude_report_footer
@@ -416,30 +566,15 @@ def get_ads_report(authorization_data,account_id,start_date,end_date,qry_type):
         report_request.Format='Csv'
         report_request.ReturnOnlyCompleteData=return_only_complete_data
         report_request.Time=time    
-        report_request.ReportName="Ads Performance Report"
-        scope=reporting_service.factory.create('AccountThroughAdGroupReportScope')
+        report_request.ReportName=report_type["report_name"]
+        scope=reporting_service.factory.create(report_type["scope"])
         scope.AccountIds={'long': account_id }
         scope.Campaigns=None
         report_request.Scope=scope     
 
         # Primary columns required in the API
-        report_columns=reporting_service.factory.create('ArrayOfAdPerformanceReportColumn')
-        report_columns.AdPerformanceReportColumn.append([
-            # 'AccountId',
-            'AccountName',
-            'TimePeriod',
-            'CurrencyCode', 
-            'CampaignType', 
-            'Network', 
-            'DeviceType', 
-            'Clicks',
-            'Impressions',
-            'Ctr', 
-            'AverageCpc', 
-            'Spend', 
-            'Conversions',
-            'Revenue',
-            ])
+        report_columns=reporting_service.factory.create(report_type["column_array"])
+        getattr(report_columns, report_type["column_element"]).append(list(report_type["columns"]))
         report_request.Columns=report_columns
 
         #return campaign_performance_report_request
@@ -449,225 +584,762 @@ def get_ads_report(authorization_data,account_id,start_date,end_date,qry_type):
         print("\nMS_ADS_REPORT : report processing Failed : ", sys.exc_info())
 
 def date_validation(date_text):
+    '''
+    Returns the date of a yyyy-mm-dd text, raises ValueError for any other
+    text (the script may run unattended, so there is no prompt)
+    '''
     try:
-        while date_text != datetime.strptime(date_text, '%Y-%m-%d').strftime('%Y-%m-%d'):
-            date_text = input('Please Enter the date in YYYY-MM-DD format\t')
-        else:
-            return datetime.strptime(date_text,'%Y-%m-%d').date()
-    except:
-        logger.log_message("linkedin_campaign_processing : year does not match format yyyy-mm-dd", level=logging.ERROR)
-        raise Exception('linkedin_campaign_processing : year does not match format yyyy-mm-dd')
+        date = datetime.strptime(date_text, '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+        date = None
+    if date is None or date.strftime('%Y-%m-%d') != date_text:
+        logger.log_message(f"date_validation : {date_text!r} does not match format yyyy-mm-dd", level=logging.ERROR)
+        raise ValueError(f"{date_text!r} does not match format yyyy-mm-dd")
+    return date
+
+def download_report_file(report_request, authorization_data, start_date, end_date, result_file_name):
+    '''
+    Submits the report, waits for it and downloads it to the data folder,
+    returns the path of the csv file or None when the report has no rows
+    '''
+    from bingads.v13.reporting import ReportingServiceManager
+    from service_clients import suds_options
+    from request_scheduler import get_scheduler
+    from report_polling import get_polling_history, track_report
+
+    # Shards running at the same time may create the folder together
+    os.makedirs(os.path.join(work_dir, "data"), exist_ok=True)
+    startDate = date_validation(start_date)
+    endDate = date_validation(end_date)
+
+    #global reporting_service_manager
+    reporting_service_manager = ReportingServiceManager(
+        authorization_data=authorization_data, 
+        poll_interval_in_milliseconds=5000, 
+        environment=ENVIRONMENT,
+        **suds_options('ReportingService')
+    )
 
-def download_ads_report(report_request,authorization_data,start_date,end_date,qry_type):
-    try:
-        if not os.path.exists(os.path.join(script_dir, "data")):
-            os.makedirs(os.path.join(script_dir, "data"))
-        startDate = date_validation(start_date)
-        dt = startDate+timedelta(1)
-        week_number = dt.isocalendar()[1]
-        endDate = date_validation(end_date)
-        reporting_download_parameters = ReportingDownloadParameters(
-                report_request=report_request,
-                result_file_directory = os.path.join(script_dir, "data"), 
-                result_file_name = "ads_report_" + start_date + "_" + end_date + ".csv", 
-                overwrite_result_file = True, # Set this value true if you want to overwrite the same file.
-                timeout_in_milliseconds=3600000, # You may optionally cancel the download after a specified time interval.
+    # Submit the report and wait for it to be ready, polling around the
+    # completion time of similar reports
+    submitted_at = time.monotonic()
+    with get_metrics().span('report_submit'):
+        reporting_download_operation = get_scheduler('bing').call(reporting_service_manager.submit_download, report_request)
+    with get_metrics().span('report_poll'):
+        track_report(
+            reporting_download_operation,
+            report_type=f"{type(report_request).__name__}:{report_request.Aggregation}",
+            size=len(report_request.Scope.AccountIds['long']) * ((endDate - startDate).days + 1),
+            history=get_polling_history(os.path.join(work_dir, "cache/report_timings.json")),
+            submitted_at=submitted_at,
+            timeout_seconds=3600,
+            min_interval=ENVIRONMENT_INFO.get("REPORT_POLL_MIN_SECONDS", 1),
+            max_interval=ENVIRONMENT_INFO.get("REPORT_POLL_MAX_SECONDS", 60),
             )
-        
-        #global reporting_service_manager
-        reporting_service_manager = ReportingServiceManager(
-            authorization_data=authorization_data, 
-            poll_interval_in_milliseconds=5000, 
-            environment=ENVIRONMENT,
+    with get_metrics().span('report_download') as span:
+        result_file_path = get_scheduler('bing').call(
+            reporting_download_operation.download_result_file,
+            result_file_directory = os.path.join(work_dir, "data"), 
+            result_file_name = result_file_name, 
+            decompress = True,
+            overwrite = True, # Set this value true if you want to overwrite the same file.
+            timeout_in_milliseconds=3600000, # You may optionally cancel the download after a specified time interval.
         )
-        ads_analytics_data = []
-        report_container = reporting_service_manager.download_report(reporting_download_parameters)
-        columns = report_request.Columns.AdPerformanceReportColumn[0]
-
-        data_list = []
-        report_record_iterable = report_container.report_records
-
-        curr_converter = CurrencyConverter()
-
-        for record in report_record_iterable:
-            converted_spend_cost = record.value("Spend")
-            converted_avg_cpc = record.value("AverageCpc")
-            converted_conversions = record.value("Conversions")
-            if record.value("CurrencyCode") != "GBP":
-                converted_spend_cost = curr_converter.convert(converted_spend_cost, record.value("CurrencyCode"), "GBP")
-                converted_avg_cpc = curr_converter.convert(converted_avg_cpc, record.value("CurrencyCode"), "GBP")
-                converted_conversions = curr_converter.convert(converted_conversions, record.value("CurrencyCode"), "GBP")
-
-            tmp_dict = {
-                # "AccountId": record.value("AccountId"),
-                "AccountName": record.value("AccountName"),
-                "TimePeriod": record.value("TimePeriod"),
-                "CurrencyCode": record.value("CurrencyCode"),
-                "CampaignType": record.value("CampaignType"),
-                "Network": record.value("Network"),
-                "DeviceType": record.value("DeviceType"),
-                "Clicks": int(record.value("Clicks")),
-                "Impressions": int(record.value("Impressions")),
-                "Ctr": record.value("Ctr"),
-                "AverageCpc": float(record.value("AverageCpc")),
-                "Spend": float(record.value("Spend")),
-                "Conversions": float(record.value("Conversions")),
-                "Revenue": float(record.value("Revenue")),
-                "AverageCpc (converted)": float(converted_avg_cpc),  
-                "Cost (converted)": float(converted_spend_cost),  
-                "Total conv. value": float(converted_conversions),  
-            }
-            data_list.append(tmp_dict)
-           
-        ads_analytics_data = pd.DataFrame(data_list, columns=columns.append([
-            "AverageCpc (converted)", 
-            "Cost (converted)", 
-            "Total conv. value",
-        ]))
-        ads_analytics_data = ads_analytics_data.fillna('')
-        ads_analytics_data['Ctr'] = ads_analytics_data['Ctr'].str.rstrip('%').astype('float') / 100.0
-
-        # Sort data in descending order of date
-        ads_analytics_data = ads_analytics_data.sort_values(by=['AccountName'], ascending=[True])
-        #list comprehenser
-        groups = [group for name, group in ads_analytics_data.groupby("TimePeriod")]
-        # Concatenate the groups into a single DataFrame
-        ads_analytics_data = pd.concat(reversed(groups), ignore_index=True)
-
-        # Duplicate the dataframe and extact data for last day
-        ads_analytics_data_aggregated = ads_analytics_data[ads_analytics_data['TimePeriod'] == end_date]
-        ads_analytics_data_aggregated = ads_analytics_data_aggregated.groupby(['AccountName', 'CampaignType']).agg({
-            'TimePeriod': lambda x: x.iloc[0],
-            'Clicks': 'sum',
-            'Impressions': 'sum',
-            'Ctr': 'sum',
-            'AverageCpc': 'sum',
-            'Spend': 'sum',
-            'Conversions': 'sum',
-            'Revenue': 'sum',
-            'AverageCpc (converted)': 'sum',
-            'Cost (converted)': 'sum',
-            'Total conv. value': 'sum',
-        }).reset_index()
-
-        # Calculate totals of aggregated values
-        total_row = pd.DataFrame(ads_analytics_data_aggregated.sum(numeric_only=False)).transpose()
-        total_row.loc[0, "AccountName"] = "Grand Total"
-        total_row.loc[0, "CampaignType"] = " "
-        total_row.loc[0, "TimePeriod"] = " "
-        total_row.loc[0, "Ctr"] = (total_row.loc[0, "Clicks"]/total_row.loc[0, "Impressions"])
-        # total_row.loc[0, "Ctr"] = np.nan_to_num(ads_analytics_data_aggregated['CTR'], nan=0.0, posinf=0.0, neginf=0.0)
-        total_row.loc[0, "AverageCpc"] = (total_row.loc[0, "Spend"]/total_row.loc[0, "Clicks"])
-        # total_row.loc[0, "AverageCpc"] = np.nan_to_num(ads_analytics_data_aggregated['AverageCpc'], nan=0.0, posinf=0.0, neginf=0.0)
-        total_row.loc[0, "AverageCpc (converted)"] = (total_row.loc[0, "Cost (converted)"]/total_row.loc[0, "Clicks"])
-        # total_row.loc[0, "AverageCpc (converted)"] = np.nan_to_num(ads_analytics_data_aggregated['AverageCpc (converted)'], nan=0.0, posinf=0.0, neginf=0.0)
-
-        # Combine aggregated data and totals
-        ads_analytics_data_aggregated = pd.concat([ads_analytics_data_aggregated, total_row], ignore_index=True)
-
-        # Type cast to string to prevent auto-formatting 
-        columns_to_convert = [
-            'Impressions', 'Clicks', 'Ctr', 'AverageCpc', 'Spend',
-            'Conversions', 'Revenue', 'AverageCpc (converted)',
-            'Cost (converted)', 'Total conv. value'
-        ]
+        if result_file_path is not None:
+            span.add(bytes=os.path.getsize(result_file_path))
+
+    return result_file_path
+
+def get_currency_rates():
+    from currency_rates import get_rate_table
+
+    return get_rate_table(
+        os.path.join(work_dir, "cache/currency_rates.json"),
+        ttl_hours=ENVIRONMENT_INFO.get("CURRENCY_CACHE_TTL_HOURS", 24),
+        currency_file=ENVIRONMENT_INFO.get("CURRENCY_RATES_FILE"),
+        )
+
+def download_ads_report(report_request,authorization_data,start_date,end_date,qry_type,result_file_name=None,report_type=None,account_currencies=None):
+    '''
+    Downloads the report and reads it with the columns and dtypes of its
+    report type, account_currencies ({account id: currency code}) fills
+    the currency of the report types that have no currency column
+    '''
+    import pandas as pd
+    from report_parser import read_report_csv
+    from report_types import get_report_type, add_derived_columns, DEFAULT_REPORT_TYPE
 
-        ads_analytics_data_aggregated[columns_to_convert] = ads_analytics_data_aggregated[columns_to_convert].astype(str)
+    report_type = report_type or get_report_type(DEFAULT_REPORT_TYPE)
 
+    try:
+        if result_file_name is None:
+            result_file_name = "ads_report_" + start_date + "_" + end_date + ".csv"
+
+        result_file_path = download_report_file(report_request, authorization_data, start_date, end_date, result_file_name)
+
+        # The report has no rows
+        if result_file_path is None:
+            return pd.DataFrame()
 
+        # Read the csv straight into a typed frame
+        with get_metrics().span('parse') as span:
+            ads_analytics_data = read_report_csv(result_file_path, columns=report_type["columns"], dtypes=report_type["dtypes"])
+            add_derived_columns(ads_analytics_data, report_type, account_currencies)
+            span.add(rows=len(ads_analytics_data), bytes=os.path.getsize(result_file_path))
 
-        return ads_analytics_data, ads_analytics_data_aggregated
+        # The rows are kept in the report store and archive, not in the csv
+        if not ENVIRONMENT_INFO.get("KEEP_REPORT_FILES", False):
+            os.remove(result_file_path)
+
+        # Convert the cost columns to GBP with the rate of each row's date
+        with get_metrics().span('currency_conversion') as span:
+            get_currency_rates().convert_columns(ads_analytics_data, report_type["converted"])
+            span.add(rows=len(ads_analytics_data))
+
+        return ads_analytics_data
     except:
         logger.log_message(f"DOWNLOAD_ADS_REPORT : processing Failed : {sys.exc_info()}", level=logging.ERROR)
         print("\nDOWNLOAD_ADS_REPORT : processing Failed : ", sys.exc_info())
 
+def download_ads_report_file(report_request,authorization_data,start_date,end_date,qry_type,result_file_name=None):
+    '''
+    Downloads the report without reading it, returns the path of the csv
+    file, "" when the report has no rows and None when it failed
+    '''
+    try:
+        if result_file_name is None:
+            result_file_name = "ads_report_" + start_date + "_" + end_date + ".csv"
+        return download_report_file(report_request, authorization_data, start_date, end_date, result_file_name) or ""
+    except:
+        logger.log_message(f"DOWNLOAD_ADS_REPORT_FILE : processing Failed : {sys.exc_info()}", level=logging.ERROR)
+        print("\nDOWNLOAD_ADS_REPORT_FILE : processing Failed : ", sys.exc_info())
 
-def main(authorization_data):
+def split_report_shards(account_ids, start_date, end_date, shard_accounts=0, shard_days=0):
+    '''
+    Splits the accounts and the date range into (account_ids, start_date, end_date) shards,
+    a shard size of 0 keeps that dimension in a single shard
+    '''
+    if shard_accounts and shard_accounts > 0:
+        account_chunks = [account_ids[i:i + shard_accounts] for i in range(0, len(account_ids), shard_accounts)]
+    else:
+        account_chunks = [account_ids]
+
+    date_chunks = []
+    chunk_start = start_date
+    while chunk_start <= end_date:
+        if shard_days and shard_days > 0:
+            chunk_end = min(chunk_start + timedelta(days=shard_days - 1), end_date)
+        else:
+            chunk_end = end_date
+        date_chunks.append((chunk_start, chunk_end))
+        chunk_start = chunk_end + timedelta(days=1)
+
+    return [
+        (account_chunk, chunk_start, chunk_end)
+        for account_chunk in account_chunks
+        for chunk_start, chunk_end in date_chunks
+        ]
+
+def download_ads_report_sharded(authorization_data, account_batches, qry_type, file_prefix="ads_report", download=None, report_type=None):
+    '''
+    Submits one report per shard through a bounded worker pool and returns
+    a list of (shard, data) where data is None for the shards that failed
+
+    account_batches: iterable of (account_ids, start_date, end_date), the
+        shards of a batch are submitted as soon as the batch is produced
+    download: called like download_ads_report for every shard (the default),
+        download_ads_report_file leaves the rows in the csv files
+    report_type: entry of report_types requested for every shard (the ad
+        performance report by default)
+    '''
+    download = download or download_ads_report
+    shard_accounts = ENVIRONMENT_INFO.get("REPORT_SHARD_ACCOUNTS", 0)
+    shard_days = ENVIRONMENT_INFO.get("REPORT_SHARD_DAYS", 0)
+    max_workers = max(1, ENVIRONMENT_INFO.get("REPORT_MAX_CONCURRENCY", 4))
+
+    # The shard spans are children of the caller's span (the job)
+    parent_span = get_metrics().current()
+
+    def download_shard(shard_index, shard):
+        shard_account_ids, shard_start, shard_end = shard
+        shard_start_date = shard_start.strftime('%Y-%m-%d')
+        shard_end_date = shard_end.strftime('%Y-%m-%d')
+        with get_metrics().attach(parent_span), get_metrics().span('report_shard', shard=shard_index) as span:
+            report_request = get_ads_report(authorization_data, shard_account_ids, shard_start_date, shard_end_date, qry_type, report_type=report_type)
+            data = download(
+                report_request,
+                authorization_data,
+                shard_start_date,
+                shard_end_date,
+                qry_type,
+                result_file_name=f"{file_prefix}_{shard_start_date}_{shard_end_date}_{shard_index}.csv",
+                )
+            # download_ads_report_file returns the path of the csv file
+            if data is not None and not isinstance(data, str):
+                span.add(rows=len(data))
+            return data
+
+    shards = []
+    futures = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for account_ids, start_date, end_date in account_batches:
+            for shard in split_report_shards(account_ids, start_date, end_date, shard_accounts=shard_accounts, shard_days=shard_days):
+                futures.append(executor.submit(download_shard, len(shards), shard))
+                shards.append(shard)
+        logger.log_message(f"downloading report in {len(shards)} shard(s) with {min(max_workers, len(shards))} worker(s)")
+        results = [future.result() for future in futures]
+
+    failed_shards = sum(1 for result in results if result is None)
+    if failed_shards:
+        logger.log_message(f"{failed_shards} of {len(shards)} report shard(s) failed", level=logging.ERROR)
+
+    return list(zip(shards, results))
+
+def build_report_frames(ads_analytics_data, start_date, end_date, pivot_specs):
+    '''
+    Sorts the report rows and builds the configured pivots of the date window
+
+    Returns (sorted rows, [(pivot spec, pivot)])
+    '''
+    from pivot import build_pivots, sort_report_rows
 
     try:
-        # output_status_message("-----\nGetUser:")
-        get_user_response=customer_service.GetUser(
-            UserId=None
+        with get_metrics().span('aggregation') as span:
+            # Sort data in descending order of date
+            ads_analytics_data = sort_report_rows(ads_analytics_data)
+
+            pivots = build_pivots(
+                ads_analytics_data,
+                pivot_specs,
+                context={'start_date': start_date, 'end_date': end_date},
+                )
+
+            span.add(rows=len(ads_analytics_data))
+
+        return ads_analytics_data, pivots
+    except:
+        logger.log_message(f"BUILD_REPORT_FRAMES : processing Failed : {sys.exc_info()}", level=logging.ERROR)
+        print("\nBUILD_REPORT_FRAMES : processing Failed : ", sys.exc_info())
+
+
+def report_type_dir(folder, job, report_type=None):
+    '''
+    Returns the folder of the job's report type inside folder, the ad
+    performance report keeps the folder of the job
+    '''
+    from report_types import DEFAULT_REPORT_TYPE
+
+    directory = os.path.join(work_dir, folder, job["name"])
+    if report_type is not None and report_type["name"] != DEFAULT_REPORT_TYPE:
+        directory = os.path.join(directory, report_type["name"])
+    return directory
+
+def get_report_store(job, report_type=None):
+    from report_store import ReportStore, STORE_KEY
+
+    return ReportStore(
+        report_type_dir("store", job, report_type),
+        finalize_after_days=ENVIRONMENT_INFO.get("REPORT_STORE_FINALIZE_DAYS", 3),
+        retention_days=ENVIRONMENT_INFO.get("REPORT_STORE_RETENTION_DAYS", 90),
+        key_columns=report_type["key"] if report_type else STORE_KEY,
+        )
+
+def get_report_archive(job, report_type=None):
+    from report_archive import ReportArchive
+
+    return ReportArchive(
+        report_type_dir("archive", job, report_type),
+        retention_days=ENVIRONMENT_INFO.get("ARCHIVE_RETENTION_DAYS", 400),
+        buckets=ENVIRONMENT_INFO.get("ARCHIVE_ACCOUNT_BUCKETS", 16),
         )
-        user = get_user_response.User
-        customer_roles=get_user_response.CustomerRoles
-        # output_status_message("User:")
-        # output_user(user)
-        output_status_message("CustomerRoles:")
-        output_array_of_customerrole(customer_roles)
-
-        # Search for the accounts that the user can access.
-        # To retrieve more than 100 accounts, increase the page size up to 1,000.
-        # To retrieve more than 1,000 accounts you'll need to add paging.
-
-        accounts=search_accounts_by_user_id(customer_service, user.Id)
-
-        customer_ids=[]
-        customer_name=[]
-        for account in accounts['AdvertiserAccount']:
-            customer_ids.append(account.Id)
-            customer_name.append(account.Name)
-
-    except WebFault as ex:
-        logger.log_message(ex, level=logging.ERROR)
-        output_webfault_errors(ex)
-    except Exception as ex:
-        logger.log_message(ex, level=logging.ERROR)
-        output_status_message(ex)
 
-    current_date = datetime.now()
+def get_rollup_cube(job):
+    from rollup import RollupCube
+
+    return RollupCube(
+        os.path.join(work_dir, "rollup", job["name"]),
+        retention_days=ENVIRONMENT_INFO.get("ROLLUP_RETENTION_DAYS", 400),
+        )
+
+def fetch_report_window(job, report_type, authorization_data, account_feed, window_start, window_end):
+    '''
+    Downloads the days of the window that are not final in the report type's
+    store yet and returns (the stored rows of the window, job accounts,
+    number of report shards that failed)
+    '''
+    import pandas as pd
+    from functools import partial
+    from jobs import filter_accounts
+    from report_types import DEFAULT_REPORT_TYPE
+    from report_archive import Coverage
+
+    # Only request the days that are not final in the local store yet
+    store = get_report_store(job, report_type)
+    fetched = None
+
+    job_accounts = []
+    account_currencies = {}
+
+    def pending_batches():
+        # Every page of accounts is filtered and checked against the store as
+        # it arrives, so its report shards start before the discovery ends
+        for page in account_feed.pages():
+            page_accounts = filter_accounts([(account['Id'], account['Name']) for account in page], job["accounts"])
+            job_accounts.extend(page_accounts)
+            account_currencies.update((int(account['Id']), account.get('CurrencyCode')) for account in page)
+            if not page_accounts:
+                continue
+            pending = store.pending([account_id for account_id, account_name in page_accounts], window_start, window_end)
+            if pending is None:
+                continue
+            fetch_start, fetch_end, fetch_account_ids = pending
+            logger.log_message(f"fetching {report_type['name']} data for date range: {fetch_end.strftime('%Y-%m-%d')} to {fetch_start.strftime('%Y-%m-%d')} ({len(fetch_account_ids)} accounts)")
+            yield fetch_account_ids, fetch_start, fetch_end
+
+    # Generate and download the report requests
+    shard_results = download_ads_report_sharded(
+        authorization_data,
+        pending_batches(),
+        job["report"]["aggregation"],
+        file_prefix=f"{job['name']}_{report_type['name']}",
+        download=partial(download_ads_report, report_type=report_type, account_currencies=account_currencies),
+        report_type=report_type,
+        )
+    # Nothing is stored for a partial account list
+    account_feed.raise_error()
 
-    # Get todays date
-    current_date = current_date - timedelta(days=1)
-    formatted_date_today = current_date.strftime('%Y-%m-%d')
+    if not shard_results:
+        logger.log_message(f"{report_type['name']} date range {window_start.strftime('%Y-%m-%d')} to {window_end.strftime('%Y-%m-%d')} already final in report store")
+    else:
+        fetched_data = [data for shard, data in shard_results if data is not None]
+        coverage = [Coverage(*shard) for shard, data in shard_results if data is not None]
+        if fetched_data:
+            fetched = pd.concat(fetched_data, ignore_index=True)
+            store.merge(fetched, coverage)
+
+            # Every fetched day is kept once in the partitioned history
+            archive = get_report_archive(job, report_type)
+            archive.upsert(fetched, coverage)
+            archive.prune()
+
+    if report_type["name"] == DEFAULT_REPORT_TYPE:
+        # The per-day sums of the period pivots, built from the store the
+        # first time and then updated with the fetched days only
+        cube = get_rollup_cube(job)
+        if not cube.exists():
+            cube.rebuild(store.load())
+        elif fetched is not None:
+            cube.update(fetched, coverage)
+
+    account_ids = [account_id for account_id, account_name in job_accounts]
+    failed_shards = sum(1 for shard, data in shard_results if data is None)
+    return store.window(account_ids, window_start, window_end), job_accounts, failed_shards
+
+def start_report_fetches(job, report_types, authorization_data, account_feed, window_start, window_end):
+    '''
+    Starts fetch_report_window for every report type at the same time, so
+    their reports are submitted and polled together, and returns the futures
+    '''
+    # The report type spans are children of the caller's span (the job)
+    parent_span = get_metrics().current()
 
-    # Calculate the date and time 7 days ago
-    seven_days_ago = current_date - timedelta(days=6)
-    seven_days_ago = seven_days_ago.strftime('%Y-%m-%d')
+    def fetch(report_type):
+        with get_metrics().attach(parent_span), get_metrics().span('report_type', report_type=report_type["name"]):
+            return fetch_report_window(job, report_type, authorization_data, account_feed, window_start, window_end)
 
-    logger.log_message(f"fetching data for date range: {formatted_date_today} to {seven_days_ago}")
+    executor = ThreadPoolExecutor(max_workers=max(1, len(report_types)))
+    futures = [executor.submit(fetch, report_type) for report_type in report_types]
+    # The threads finish with their fetch, the caller waits on the futures
+    executor.shutdown(wait=False)
+    return futures
 
-    # Generate reprot_request object
-    report_request = get_ads_report(authorization_data, customer_ids, seven_days_ago, formatted_date_today, 'daily')
+def queue_extra_reports(job, report_fetches, sheets_session):
+    '''
+    Queues the rows of the job's extra report types for their ranges and
+    returns the ranges that failed or miss the rows of failed report shards
 
-    # Download report
-    ads_analytics_data, ads_analytics_data_aggregated = download_ads_report(report_request, authorization_data,seven_days_ago, formatted_date_today, 'daily')
+    report_fetches: list of (extra report of the job, future of its fetch)
+    '''
+    from pivot import sort_report_rows
+    from report_parser import sheet_rows
+    from gs_interface import sheet_values
+
+    failed_ranges = []
+    for report, future in report_fetches:
+        try:
+            data, job_accounts, failed_shards = future.result()
+            data = sheet_rows(data)
+            sheets_session.queue_update(
+                sheet_values(sort_report_rows(data)) if not data.empty else [],
+                {'script_start_time': script_start_time, 'timezone': timezone},
+                spreadsheet_id = job["spreadsheet_id"],
+                range = report["range"],
+                diff_mode = job["diff_mode"],
+                columns = list(data.columns),
+                job_name = job["name"],
+                )
+            if failed_shards:
+                failed_ranges.append(report["range"])
+        except Exception as ex:
+            logger.log_message(f"Error occured while updating '{report['range']}'", level=logging.ERROR)
+            logger.log_message(ex, level=logging.ERROR)
+            output_status_message(ex)
+            failed_ranges.append(report["range"])
+    return failed_ranges
+
+def build_job_period_pivots(job, job_accounts, window_start, window_end):
+    '''
+    Returns [(spec, pivot)] of the job's period pivots, built from the
+    rollup cube of the job's accounts, None when they could not be built
+    '''
+    from rollup import build_period_pivots
 
+    specs = [spec for spec in job["pivots"] if spec.get("period")]
+    if not specs:
+        return []
     try:
-        if not ads_analytics_data.empty:
-            logger.log_message("data pulled from bing ads api")
-    # print("\nads_analytics_data :\n", ads_analytics_data)
-    except:
-        pass    
+        with get_metrics().span('aggregation') as span:
+            pivots = build_period_pivots(
+                get_rollup_cube(job),
+                specs,
+                [account_id for account_id, account_name in job_accounts],
+                window_start,
+                window_end,
+                )
+            span.add(rows=sum(len(pivot) for spec, pivot in pivots))
+        return pivots
+    except Exception:
+        logger.log_message(f"BUILD_JOB_PERIOD_PIVOTS : processing Failed : {sys.exc_info()}", level=logging.ERROR)
+        print("\nBUILD_JOB_PERIOD_PIVOTS : processing Failed : ", sys.exc_info())
+        return None
+
+def period_pivots_or_failed(job, job_accounts, window_start, window_end, failed_ranges):
+    '''
+    Returns the job's period pivots, their ranges are added to failed_ranges
+    when they could not be built
+    '''
+    pivots = build_job_period_pivots(job, job_accounts, window_start, window_end)
+    if pivots is None:
+        failed_ranges += [spec["range"] for spec in job["pivots"] if spec.get("period")]
+        return []
+    return pivots
+
+def check_failed_ranges(job, failed_ranges):
+    '''
+    Returns False when some ranges were not written or miss rows, so the
+    run is not reused by the next invocation and the job is retried
+    '''
+    if not failed_ranges:
+        return True
+    logger.log_message(f"job '{job['name']}': {len(failed_ranges)} range(s) not written completely: {sorted(set(failed_ranges))}", level=logging.ERROR)
+    return False
+
+def run_job(job, authorization_data, account_feed, sheets_session):
+    '''
+    Downloads the reports of the job's accounts and date window and writes
+    them to the job's spreadsheet
+    '''
+    from jobs import job_window
+    from report_types import get_report_type, DEFAULT_REPORT_TYPE
+    from report_parser import sheet_rows
+    from gs_interface import sheet_values
+
+    window_start, window_end = job_window(job, datetime.now().date())
+    formatted_date_today = window_end.strftime('%Y-%m-%d')
+
+    # The ad performance report and the extra report types are fetched together
+    report_fetches = start_report_fetches(
+        job,
+        [get_report_type(DEFAULT_REPORT_TYPE)] + [get_report_type(report["type"]) for report in job["reports"]],
+        authorization_data,
+        account_feed,
+        window_start,
+        window_end,
+        )
+    window_data, job_accounts, failed_shards = report_fetches[0].result()
+    logger.log_message(f"job '{job['name']}': {len(job_accounts)} account(s)")
+    # The ranges written without all their rows, the run is then not reused
+    failed_ranges = [job["range"]] if failed_shards else []
+
+    missing_ids = set(str(account_id) for account_id in job["accounts"].get("ids", [])) - set(str(account_id) for account_id, account_name in job_accounts)
+    if missing_ids and account_feed.error is None:
+        # The account may have been added after the list was cached
+        logger.log_message(f"job '{job['name']}': account(s) {sorted(missing_ids)} not found, the account list is fetched again on the next run", level=logging.WARNING)
+        get_account_cache().invalidate()
+
+    ads_analytics_data, pivots = build_report_frames(
+        window_data,
+        window_start.strftime('%Y-%m-%d'),
+        formatted_date_today,
+        [spec for spec in job["pivots"] if not spec.get("period")],
+        )
+    if failed_shards:
+        # The pivots of the report rows miss the same rows
+        failed_ranges += [spec["range"] for spec, pivot in pivots]
+    pivots += period_pivots_or_failed(job, job_accounts, window_start, window_end, failed_ranges)
+    ads_analytics_data = sheet_rows(ads_analytics_data)
+
+    if not ads_analytics_data.empty:
+        logger.log_message("data pulled from bing ads api")
+
+    spreadsheet_id = job["spreadsheet_id"]
 
     try:
-        update_g_sheet(
-            ads_analytics_data.values.tolist(),
+        # Numbers are written as numbers, the sheet formats them
+        sheets_session.queue_update(
+            sheet_values(ads_analytics_data),
             {'script_start_time': script_start_time, 'timezone': timezone},
-            spreadsheet_id = ENVIRONMENT_INFO["DEFAULT_SPREADSHEET_ID"],
-            range = ENVIRONMENT_INFO["DEFAULT_SPREADSHEET_RANGE"],
+            spreadsheet_id = spreadsheet_id,
+            range = job["range"],
+            diff_mode = job["diff_mode"],
+            columns = list(ads_analytics_data.columns),
+            job_name = job["name"],
             )
     except Exception as ex:
-        logger.log_message("Error occured while updating 'tech' sheet", level=logging.ERROR)
+        logger.log_message(f"Error occured while updating '{job['range']}'", level=logging.ERROR)
         logger.log_message(ex, level=logging.ERROR)
         output_status_message(ex)
+        failed_ranges.append(job["range"])
+
+    for spec, pivot in pivots:
+        try:
+            sheets_session.queue_update(
+                data = [pivot.columns.values.tolist()] + sheet_values(pivot), 
+                meta = {'script_start_time': script_start_time, 'timezone': timezone},
+                spreadsheet_id = spreadsheet_id,
+                range = spec["range"],
+                diff_mode = job["diff_mode"],
+                columns = pivot.columns.values.tolist(),
+                job_name = job["name"],
+                )
+        except Exception as ex:
+            logger.log_message(f"Error occured while updating '{spec['range']}'", level=logging.ERROR)
+            logger.log_message(ex, level=logging.ERROR)
+            output_status_message(ex)    
+            failed_ranges.append(spec["range"])
+
+    failed_ranges += queue_extra_reports(job, list(zip(job["reports"], report_fetches[1:])), sheets_session)
 
     try:
-        update_g_sheet(
-            data = [ads_analytics_data_aggregated.columns.values.tolist()] + ads_analytics_data_aggregated.values.tolist(), 
-            meta = {'script_start_time': script_start_time, 'timezone': timezone},
-            spreadsheet_id = ENVIRONMENT_INFO["DEFAULT_SPREADSHEET_ID"],
-            range = 'Sheet6!A1:O',
-            )
+        # All ranges of the spreadsheet are sent together
+        sheets_session.flush(spreadsheet_id, job_name=job["name"])
     except Exception as ex:
-        logger.log_message("Error occured while updating sheet 'Sheet6'", level=logging.ERROR)
+        logger.log_message("Error occured while updating the google spreadsheet", level=logging.ERROR)
         logger.log_message(ex, level=logging.ERROR)
-        output_status_message(ex)    
+        output_status_message(ex)
+        # The job fails and its run is not reused by the next invocation
+        raise
+
+    return check_failed_ranges(job, failed_ranges)
+
+def run_job_streaming(job, authorization_data, account_feed, sheets_session):
+    '''
+    Streaming variant of run_job: the shard reports are downloaded to files
+    that are then read chunk by chunk, converted and written to the sheet
+    while the pivots are accumulated, so the memory does not depend on the
+    size of the report. The rows keep the order of the report and the
+    report store and archive are not used, the extra report types of the
+    job are fetched alongside as in run_job
+    '''
+    from jobs import filter_accounts, job_window
+    from pivot import PivotAccumulator
+    from rollup import cube_spec
+    from report_archive import Coverage
+    from report_parser import iter_report_csv, sheet_rows, REPORT_COLUMNS, CONVERTED_COLUMNS
+    from report_types import get_report_type, DEFAULT_REPORT_TYPE
+    from gs_interface import sheet_values
+
+    window_start, window_end = job_window(job, datetime.now().date())
+    start_date = window_start.strftime('%Y-%m-%d')
+    end_date = window_end.strftime('%Y-%m-%d')
+
+    report_fetches = start_report_fetches(
+        job,
+        [get_report_type(report["type"]) for report in job["reports"]],
+        authorization_data,
+        account_feed,
+        window_start,
+        window_end,
+        )
+
+    job_accounts = []
+
+    def account_batches():
+        for page in account_feed.pages():
+            page_accounts = filter_accounts([(account['Id'], account['Name']) for account in page], job["accounts"])
+            job_accounts.extend(page_accounts)
+            if page_accounts:
+                yield [account_id for account_id, account_name in page_accounts], window_start, window_end
+
+    logger.log_message(f"fetching data for date range: {end_date} to {start_date} (streaming)")
+    shard_results = download_ads_report_sharded(
+        authorization_data,
+        account_batches(),
+        job["report"]["aggregation"],
+        file_prefix=job["name"],
+        download=download_ads_report_file,
+        )
+    def remove_report_files():
+        if not ENVIRONMENT_INFO.get("KEEP_REPORT_FILES", False):
+            for shard, result_file_path in shard_results:
+                if result_file_path and os.path.exists(result_file_path):
+                    os.remove(result_file_path)
+
+    # The range is not cleared and rewritten with a partial account list
+    if account_feed.error is not None:
+        remove_report_files()
+        account_feed.raise_error()
+    logger.log_message(f"job '{job['name']}': {len(job_accounts)} account(s)")
+
+    report_type = get_report_type(DEFAULT_REPORT_TYPE)
+    rate_table = get_currency_rates()
+    pivots = [PivotAccumulator(spec, context={'start_date': start_date, 'end_date': end_date}) for spec in job["pivots"] if not spec.get("period")]
+    # The per-day sums of the window replace the window in the rollup cube
+    cube_rows = PivotAccumulator(cube_spec())
+    stream = {'finished': False}
+
+    def report_rows():
+        # One chunk of one report file is in memory at a time
+        for shard, result_file_path in shard_results:
+            if not result_file_path:
+                continue
+            chunks = iter_report_csv(
+                result_file_path,
+                chunk_rows=ENVIRONMENT_INFO.get("STREAMING_CHUNK_ROWS", 50000),
+                columns=report_type["columns"],
+                dtypes=report_type["dtypes"],
+                )
+            while True:
+                with get_metrics().span('parse') as span:
+                    data = next(chunks, None)
+                    if data is not None:
+                        span.add(rows=len(data))
+                if data is None:
+                    break
+                with get_metrics().span('currency_conversion') as span:
+                    rate_table.convert_columns(data, CONVERTED_COLUMNS)
+                    span.add(rows=len(data))
+                for accumulator in pivots + [cube_rows]:
+                    accumulator.add(data)
+                yield from sheet_values(sheet_rows(data))
+            if not ENVIRONMENT_INFO.get("KEEP_REPORT_FILES", False):
+                os.remove(result_file_path)
+        stream['finished'] = True
+
+    spreadsheet_id = job["spreadsheet_id"]
+    try:
+        sheets_session.write_stream(spreadsheet_id, job["range"], report_rows(), columns=REPORT_COLUMNS + list(CONVERTED_COLUMNS))
+    finally:
+        # The files of the shards a failed stream did not get to
+        remove_report_files()
+    # The sums of a partly read stream would replace whole days of the cube
+    if not stream['finished']:
+        raise RuntimeError(f"job '{job['name']}': the report rows were not all written to '{job['range']}'")
+
+    get_rollup_cube(job).update(cube_rows.result(), [Coverage(*shard) for shard, result_file_path in shard_results if result_file_path is not None])
+
+    # The report rows and pivots miss the rows of the failed shards
+    failed_ranges = []
+    if any(result_file_path is None for shard, result_file_path in shard_results):
+        failed_ranges += [job["range"]] + [accumulator.spec["range"] for accumulator in pivots]
+
+    # The period pivots come from the cube, the others from their accumulator
+    job_pivots = [(accumulator.spec, accumulator) for accumulator in pivots]
+    job_pivots += period_pivots_or_failed(job, job_accounts, window_start, window_end, failed_ranges)
+
+    for spec, pivot in job_pivots:
+        try:
+            if isinstance(pivot, PivotAccumulator):
+                with get_metrics().span('aggregation'):
+                    pivot = pivot.result()
+            sheets_session.queue_update(
+                data = [pivot.columns.values.tolist()] + sheet_values(pivot),
+                meta = {'script_start_time': script_start_time, 'timezone': timezone},
+                spreadsheet_id = spreadsheet_id,
+                range = spec["range"],
+                diff_mode = job["diff_mode"],
+                columns = pivot.columns.values.tolist(),
+                job_name = job["name"],
+                )
+        except Exception as ex:
+            logger.log_message(f"Error occured while updating '{spec['range']}'", level=logging.ERROR)
+            logger.log_message(ex, level=logging.ERROR)
+            output_status_message(ex)
+            failed_ranges.append(spec["range"])
+
+    failed_ranges += queue_extra_reports(job, list(zip(job["reports"], report_fetches)), sheets_session)
+
+    sheets_session.flush(spreadsheet_id, job_name=job["name"])
+
+    return check_failed_ranges(job, failed_ranges)
+
+def get_run_coordinator():
+    from coordination import RunCoordinator
+
+    return RunCoordinator(
+        os.path.join(work_dir, "cache/runs"),
+        ttl_minutes=ENVIRONMENT_INFO.get("RUN_RESULT_TTL_MINUTES", 15),
+        wait_minutes=ENVIRONMENT_INFO.get("RUN_WAIT_MINUTES", 75),
+        )
+
+def run_job_span(job, authorization_data, account_feed, sheets_session, force=False):
+    '''
+    Runs the job unless another invocation is running the same window (its
+    result is waited for) or ran it within RUN_RESULT_TTL_MINUTES
+
+    force: run even if a recent result exists
+
+    Returns how the result was obtained: 'ran', 'attached' or 'reused',
+    raises when the run did not succeed
+    '''
+    from coordination import run_key
+    from jobs import job_window
+
+    window_start, window_end = job_window(job, datetime.now().date())
+
+    def run():
+        with get_metrics().span('job', job=job["name"]):
+            if job["streaming"]:
+                return run_job_streaming(job, authorization_data, account_feed, sheets_session)
+            return run_job(job, authorization_data, account_feed, sheets_session)
+
+    outcome, result = get_run_coordinator().run(job["name"], run_key(job, window_start, window_end), run, force=force)
+    if not result['succeeded']:
+        raise RuntimeError(f"job '{job['name']}' did not succeed")
+    return outcome
+
+def get_sheets_session():
+    from gs_interface import get_session
+
+    return get_session(
+        chunk_rows=ENVIRONMENT_INFO.get("SHEETS_CHUNK_ROWS", 5000),
+        chunk_bytes=ENVIRONMENT_INFO.get("SHEETS_CHUNK_BYTES", 1000000),
+        upload_concurrency=ENVIRONMENT_INFO.get("SHEETS_UPLOAD_CONCURRENCY", 2),
+        upload_retries=ENVIRONMENT_INFO.get("SHEETS_UPLOAD_RETRIES", 3),
+        )
+
+def main(authorization_data, force=False):
+    from jobs import load_jobs, run_jobs
+
+    # The accounts the user can access, started by authenticate() and shared
+    # by all the jobs, each job reads the pages as they arrive
+    account_feed = get_account_feed(authorization_data)
+
+    sheets_session = get_sheets_session()
+
+    jobs = load_jobs(ENVIRONMENT_INFO)
+    results = run_jobs(
+        jobs,
+        lambda job: run_job_span(job, authorization_data, account_feed, sheets_session, force=force),
+        concurrency=ENVIRONMENT_INFO.get("JOB_CONCURRENCY", 2),
+        )
+    logger.log_message(f"jobs finished: {sum(results.values())} of {len(results)} succeeded")
+    return all(results.values())
 
 # Main execution
 if __name__ == '__main__':
 
-    print("Loading the web service client proxies...")
+    from bingads.authorization import AuthorizationData
 
     authorization_data=AuthorizationData(
         account_id=None,
@@ -676,26 +1348,34 @@ if __name__ == '__main__':
         authentication=None,
     )
 
-    customer_service=ServiceClient(
-        service='CustomerManagementService', 
-        version=13,
-        authorization_data=authorization_data, 
-        environment=ENVIRONMENT,
-    )
-
-
-    if datetime.now().day == 1:
-        folder_to_clear = 'data'
-        folder_path = os.path.join(script_dir, "data")
-        # Call the function to clear the folder
-        logger.log_message(clear_folder(folder_path))
-
     date_time_formatted = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     timezone = datetime.now(timezone.utc).tzinfo
     logger.log_message(f"-+-+-+-BEGIN for {date_time_formatted} {timezone}")
 
-    authenticate(authorization_data)
+    configure_request_limits()
+
+    # python3 main.py --refresh-accounts fetches the account list again
+    if '--refresh-accounts' in sys.argv[1:]:
+        get_account_cache().invalidate()
+
+    # Stage timings are written as json lines and as a Prometheus textfile,
+    # relative paths are inside the work folder and null turns the output off
+    metrics = configure_metrics(*(
+        os.path.join(work_dir, path) if path else None
+        for path in (
+            ENVIRONMENT_INFO.get("METRICS_LOG", "log/metrics.jsonl"),
+            ENVIRONMENT_INFO.get("METRICS_TEXTFILE", "metrics/bing_ads_report.prom"),
+            )
+        ))
+    run_started = time.monotonic()
+    success = False
+    try:
+        with metrics.span('run'):
+            authenticate(authorization_data)
 
-    main(authorization_data)
+            # python3 main.py --force runs the jobs even if a recent run wrote the same window
+            success = main(authorization_data, force='--force' in sys.argv[1:])
+    finally:
+        metrics.write_textfile(success, time.monotonic() - run_started)
 
     logger.log_message("-+-+-+-END")
@@ -0,0 +1,206 @@
+'''Metrics
+
+This module times the stages of a run in spans recording rows, bytes and
+retries. Every span is written as a json line to the metrics log and the
+totals of the run per stage are written as a Prometheus textfile that
+node_exporter can scrape
+'''
+import os
+import json
+import time
+import threading
+
+from contextlib import contextmanager
+
+from file_utils import write_text
+
+METRIC_PREFIX = "bing_ads_report"
+
+# (name, help, span total it is read from)
+STAGE_METRICS = [
+    ("stage_duration_seconds", "Time spent in the stage during the last run", "seconds"),
+    ("stage_max_duration_seconds", "Longest single span of the stage during the last run", "max_seconds"),
+    ("stage_spans", "Number of spans of the stage during the last run", "spans"),
+    ("stage_rows", "Rows processed by the stage during the last run", "rows"),
+    ("stage_bytes", "Bytes processed by the stage during the last run", "bytes"),
+    ("stage_retries", "Retried API calls of the stage during the last run", "retries"),
+    ("stage_errors", "Spans of the stage that raised during the last run", "errors"),
+    ]
+
+class Span:
+    '''
+    One timed stage, add() may be called from the threads the stage spreads to
+    '''
+
+    def __init__(self, stage, labels):
+        self.stage = stage
+        self.labels = labels
+        self.rows = 0
+        self.bytes = 0
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def add(self, rows=0, bytes=0, retries=0):
+        with self._lock:
+            self.rows += rows
+            self.bytes += bytes
+            self.retries += retries
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class MetricsRecorder:
+
+    def __init__(self, json_log_path=None, textfile_path=None):
+        '''
+        json_log_path: file the spans are appended to as json lines, None to not write them
+        textfile_path: Prometheus textfile written by write_textfile, None to not write it
+        '''
+        self.json_log_path = json_log_path
+        self.textfile_path = textfile_path
+        self._totals = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self):
+        if not hasattr(self._local, 'spans'):
+            self._local.spans = []
+        return self._local.spans
+
+    def current(self):
+        '''
+        Returns the innermost span of the current thread, None outside of a span
+        '''
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    @contextmanager
+    def span(self, stage, **labels):
+        '''
+        Times the block as a span of the stage, yields the span
+        '''
+        stack = self._stack()
+        # Labels of the enclosing span (the job for example) are inherited
+        span = Span(stage, {**(stack[-1].labels if stack else {}), **labels})
+        stack.append(span)
+        started_at = time.time()
+        started = time.perf_counter()
+        error = None
+        try:
+            yield span
+        except BaseException as ex:
+            error = type(ex).__name__
+            raise
+        finally:
+            stack.pop()
+            self._record(span, started_at, time.perf_counter() - started, error)
+
+    @contextmanager
+    def attach(self, span):
+        '''
+        Makes the span the current span of this thread (for work a stage
+        hands to a thread pool) without timing it again
+        '''
+        stack = self._stack()
+        if span is not None:
+            stack.append(span)
+        try:
+            yield span
+        finally:
+            if span is not None:
+                stack.pop()
+
+    def add(self, rows=0, bytes=0, retries=0):
+        '''
+        Adds to the current span of the thread, nothing happens outside of a span
+        '''
+        span = self.current()
+        if span is not None:
+            span.add(rows=rows, bytes=bytes, retries=retries)
+
+    def _record(self, span, started_at, seconds, error):
+        record = {
+            'time': started_at,
+            'stage': span.stage,
+            'seconds': round(seconds, 6),
+            'rows': span.rows,
+            'bytes': span.bytes,
+            'retries': span.retries,
+            'error': error,
+            **span.labels,
+            }
+        with self._lock:
+            totals = self._totals.setdefault(span.stage, {
+                'seconds': 0.0, 'max_seconds': 0.0, 'spans': 0, 'rows': 0, 'bytes': 0, 'retries': 0, 'errors': 0,
+                })
+            totals['seconds'] += seconds
+            totals['max_seconds'] = max(totals['max_seconds'], seconds)
+            totals['spans'] += 1
+            totals['rows'] += span.rows
+            totals['bytes'] += span.bytes
+            totals['retries'] += span.retries
+            totals['errors'] += 1 if error else 0
+
+            if self.json_log_path:
+                log_dir = os.path.dirname(self.json_log_path)
+                if log_dir and not os.path.exists(log_dir):
+                    os.makedirs(log_dir)
+                with open(self.json_log_path, 'a') as file:
+                    file.write(json.dumps(record, default=str) + "\n")
+
+    def reset_totals(self):
+        '''
+        Starts the totals of a new run (a long running process records many)
+        '''
+        with self._lock:
+            self._totals = {}
+
+    def totals(self):
+        '''
+        Returns {stage: totals} of the spans recorded so far
+        '''
+        with self._lock:
+            return {stage: dict(totals) for stage, totals in self._totals.items()}
+
+    def write_textfile(self, success, run_seconds):
+        '''
+        Writes the totals of the run in the Prometheus text format, the file
+        is replaced atomically so that a scrape never reads half of it
+        '''
+        if not self.textfile_path:
+            return
+
+        lines = []
+        totals = self.totals()
+        for name, help, field in STAGE_METRICS:
+            lines.append(f"# HELP {METRIC_PREFIX}_{name} {help}")
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} gauge")
+            for stage in sorted(totals):
+                lines.append(f'{METRIC_PREFIX}_{name}{{stage="{escape_label(stage)}"}} {totals[stage][field]}')
+
+        for name, help, value in (
+            ("run_duration_seconds", "Duration of the last run", run_seconds),
+            ("run_success", "1 if the last run succeeded", 1 if success else 0),
+            ("last_run_timestamp_seconds", "Time the last run finished", time.time()),
+            ):
+            lines.append(f"# HELP {METRIC_PREFIX}_{name} {help}")
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} gauge")
+            lines.append(f"{METRIC_PREFIX}_{name} {value}")
+
+        write_text(self.textfile_path, "\n".join(lines) + "\n")
+
+_metrics = MetricsRecorder()
+
+def configure_metrics(json_log_path=None, textfile_path=None):
+    '''
+    Sets where the process wide recorder writes the spans and the textfile
+    '''
+    _metrics.json_log_path = json_log_path
+    _metrics.textfile_path = textfile_path
+    return _metrics
+
+def get_metrics():
+    '''
+    Returns the process wide metrics recorder
+    '''
+    return _metrics
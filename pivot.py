@@ -0,0 +1,150 @@
+'''Pivot
+
+This module computes the summary pivots written next to the raw report
+rows from declarative specs, every pivot is a single vectorized groupby
+'''
+import pandas as pd
+
+# The previous day summary written to Sheet6, per account and campaign type
+DEFAULT_PIVOT = {
+    "name": "summary",
+    # Row filter, "end_date"/"start_date" are replaced by the job's window
+    "filter": {"TimePeriod": "end_date"},
+    "group_by": ["AccountName", "CampaignType"],
+    # Columns taken from the first row of each group
+    "first": ["TimePeriod"],
+    # "sum" or {"ratio": [numerator, denominator]} computed from the summed columns
+    "metrics": {
+        "Clicks": "sum",
+        "Impressions": "sum",
+        "Ctr": {"ratio": ["Clicks", "Impressions"]},
+        "AverageCpc": {"ratio": ["Spend", "Clicks"]},
+        "Spend": "sum",
+        "Conversions": "sum",
+        "Revenue": "sum",
+        "AverageCpc (converted)": {"ratio": ["Cost (converted)", "Clicks"]},
+        "Cost (converted)": "sum",
+        "Total conv. value": "sum",
+    },
+    # Grand total row appended below the groups, null for none
+    "totals": {"label": "Grand Total"},
+    "sort": True,
+}
+
+def resolve_spec(spec):
+    '''
+    Returns the spec with the missing fields taken from DEFAULT_PIVOT
+    '''
+    return {**DEFAULT_PIVOT, **spec}
+
+def summed_columns(spec):
+    '''
+    Returns the columns that have to be summed for the spec, in order
+    '''
+    columns = []
+    for metric, aggregation in spec["metrics"].items():
+        needed = [metric] if aggregation == "sum" else aggregation["ratio"]
+        for column in needed:
+            if column not in columns:
+                columns.append(column)
+    return columns
+
+def apply_ratios(frame, spec):
+    '''
+    Computes the ratio metrics from the summed columns, 0 when the denominator is 0
+    '''
+    for metric, aggregation in spec["metrics"].items():
+        if aggregation == "sum":
+            continue
+        numerator, denominator = aggregation["ratio"]
+        denominator_values = frame[denominator].astype('float64')
+        frame[metric] = (frame[numerator] / denominator_values.where(denominator_values != 0)).fillna(0.0)
+    return frame
+
+def filter_rows(data, spec, context):
+    '''
+    Returns the rows matching the spec's filter
+    '''
+    mask = None
+    for column, value in (spec.get("filter") or {}).items():
+        values = [context.get(item, item) for item in (value if isinstance(value, list) else [value])]
+        condition = data[column].isin(values)
+        mask = condition if mask is None else mask & condition
+    return data[mask] if mask is not None else data
+
+def group_rows(rows, spec):
+    '''
+    Returns the first and summed columns of every group, the same call
+    combines the groups of several chunks
+    '''
+    aggregations = {column: (column, "first") for column in spec["first"]}
+    aggregations.update({column: (column, "sum") for column in summed_columns(spec)})
+    return (
+        rows
+        .groupby(spec["group_by"], sort=spec["sort"], observed=True)
+        .agg(**aggregations)
+        .reset_index()
+        )
+
+def finish_pivot(pivot, spec):
+    '''
+    Adds the ratio metrics and the totals row to the grouped rows
+    '''
+    sums = summed_columns(spec)
+    pivot = apply_ratios(pivot, spec)
+
+    if spec.get("totals"):
+        total_row = {column: " " for column in spec["group_by"] + spec["first"]}
+        total_row[spec["group_by"][0]] = spec["totals"].get("label", "Grand Total")
+        total_row.update({column: pivot[column].sum() for column in sums})
+        total_row = apply_ratios(pd.DataFrame([total_row]), spec)
+        pivot = pd.concat([pivot, total_row], ignore_index=True)
+
+    columns = spec["group_by"] + spec["first"] + list(spec["metrics"])
+    return pivot[columns]
+
+def build_pivot(data, spec, context=None):
+    '''
+    Returns the pivot of the data described by the spec, context holds the
+    values substituted in the filter (for example {"end_date": "2024-01-31"})
+    '''
+    spec = resolve_spec(spec)
+    return finish_pivot(group_rows(filter_rows(data, spec, context or {}), spec), spec)
+
+class PivotAccumulator:
+    '''
+    Builds the pivot of a spec from chunks of rows, only the groups are kept
+    between chunks so the memory does not grow with the number of rows
+    '''
+
+    def __init__(self, spec, context=None):
+        self.spec = resolve_spec(spec)
+        self.context = context or {}
+        self._groups = None
+
+    def add(self, data):
+        groups = group_rows(filter_rows(data, self.spec, self.context), self.spec)
+        if self._groups is not None:
+            groups = group_rows(pd.concat([self._groups, groups], ignore_index=True), self.spec)
+        self._groups = groups
+
+    def result(self):
+        if self._groups is None:
+            return finish_pivot(group_rows(pd.DataFrame(columns=self.spec["group_by"] + self.spec["first"] + summed_columns(self.spec)), self.spec), self.spec)
+        return finish_pivot(self._groups, self.spec)
+
+def build_pivots(data, specs, context=None):
+    '''
+    Returns [(spec, pivot)] for every spec
+    '''
+    return [(resolve_spec(spec), build_pivot(data, spec, context)) for spec in specs]
+
+def sort_report_rows(data):
+    '''
+    Sorts the report rows by date (newest first), then by account name
+    '''
+    return data.sort_values(
+        by=['TimePeriod', 'AccountName'],
+        ascending=[False, True],
+        kind='stable',
+        ).reset_index(drop=True)
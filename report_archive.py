@@ -0,0 +1,289 @@
+'''Report Archive
+
+This module keeps the history of the downloaded report rows as Parquet
+files partitioned by day and account bucket
+(archive/<job>/date=YYYY-MM-DD/bucket=<account id % buckets>/). A fetch
+replaces the rows of the (day, account) pairs it covers, so a day that is
+fetched on several runs is stored once, and a read only opens the
+partitions of the days and accounts it asks for
+
+Usage: python3 report_archive.py query <archive folder> <start yyyy-mm-dd> <end yyyy-mm-dd>
+           [--accounts 123 456] [--columns AccountName Spend] [--output rows.csv]
+       python3 report_archive.py compact <archive folder>
+'''
+import os
+import sys
+import json
+import uuid
+import shutil
+import logger
+import argparse
+import threading
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from report_parser import ACCOUNT_ID_COLUMN
+from file_utils import replace_file, write_json
+
+PART_PREFIX = "part-"
+PART_SUFFIX = ".parquet"
+
+# The (day, account) pairs a fetch covers, one for every report that was
+# downloaded successfully. The report store, the archive and the rollup cube
+# replace the rows of every covered pair with the downloaded rows, so a
+# covered pair without downloaded rows is left without rows
+Coverage = namedtuple('Coverage', ['account_ids', 'start_date', 'end_date'])
+
+def format_day(day):
+    return day if isinstance(day, str) else day.strftime('%Y-%m-%d')
+
+def covered_days(coverage):
+    '''
+    Returns {day: set of account ids} of the pairs covered by a list of Coverage
+    '''
+    covered = {}
+    for account_ids, start_date, end_date in coverage:
+        day = start_date
+        while day <= end_date:
+            covered.setdefault(format_day(day), set()).update(int(account_id) for account_id in account_ids)
+            day += timedelta(days=1)
+    return covered
+
+def partition_value(name):
+    '''
+    Returns the value of a key=value partition folder name, None for other names
+    '''
+    key, separator, value = name.partition('=')
+    return value if separator else None
+
+class ReportArchive:
+
+    def __init__(self, archive_dir, retention_days=400, buckets=16):
+        '''
+        archive_dir: folder holding the date=/bucket= partitions
+        retention_days: partitions of days older than this are removed by prune(),
+            None keeps everything
+        buckets: number of account buckets per day, fixed when the archive
+            is created (a folder per account would mean thousands of tiny files)
+        '''
+        self.archive_dir = archive_dir
+        self.retention_days = retention_days
+        self.settings_path = os.path.join(archive_dir, "archive.json")
+        self._lock = threading.Lock()
+
+        try:
+            with open(self.settings_path, 'r') as file:
+                self.buckets = json.load(file)['buckets']
+        except (IOError, ValueError, KeyError):
+            self.buckets = max(1, buckets)
+
+    def bucket(self, account_id):
+        return int(account_id) % self.buckets
+
+    def _partition_dir(self, day, bucket):
+        return os.path.join(self.archive_dir, f"date={format_day(day)}", f"bucket={bucket}")
+
+    @staticmethod
+    def _parts(directory):
+        '''
+        Returns the part files of the partition, oldest first
+        '''
+        if not os.path.isdir(directory):
+            return []
+        return sorted(
+            (name for name in os.listdir(directory) if name.startswith(PART_PREFIX) and name.endswith(PART_SUFFIX)),
+            key=lambda name: os.path.getmtime(os.path.join(directory, name)),
+            )
+
+    def _read_partition(self, directory):
+        import pyarrow.parquet as pq
+
+        parts = self._parts(directory)
+        if not parts:
+            return None
+        # The newest part is the whole partition, older ones are left over by an interrupted write
+        return pq.read_table(os.path.join(directory, parts[-1])).to_pandas()
+
+    def _write_partition(self, directory, rows):
+        '''
+        Writes the rows as the only part of the partition, the new part is
+        in place before the old ones are removed
+        '''
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        old_parts = self._parts(directory)
+        if rows is not None and len(rows):
+            if not os.path.exists(self.settings_path):
+                write_json(self.settings_path, {'buckets': self.buckets})
+
+            os.makedirs(directory, exist_ok=True)
+            # Categories are stored as plain strings so every part has the same schema,
+            # rows sorted by account let readers skip row groups of other accounts
+            rows = rows.astype({column: str for column in rows.columns if rows[column].dtype.name == 'category'})
+            rows = rows.sort_values(ACCOUNT_ID_COLUMN, kind='stable')
+            path = os.path.join(directory, f"{PART_PREFIX}{uuid.uuid4().hex}{PART_SUFFIX}")
+            table = pa.Table.from_pandas(rows, preserve_index=False)
+            replace_file(path, lambda tmp_path: pq.write_table(table, tmp_path))
+
+        for name in old_parts:
+            os.remove(os.path.join(directory, name))
+        if os.path.isdir(directory) and not os.listdir(directory):
+            os.rmdir(directory)
+
+    def upsert(self, data, coverage):
+        '''
+        Replaces the archived rows of the pairs covered by the fetch with
+        the downloaded rows
+
+        coverage: list of Coverage
+        '''
+        import pandas as pd
+
+        covered = covered_days(coverage)
+
+        if not data.empty:
+            data_by_partition = {
+                (day, bucket): rows
+                for (day, bucket), rows in data.groupby([data['TimePeriod'].astype(str), data[ACCOUNT_ID_COLUMN] % self.buckets], sort=False)
+                }
+        else:
+            data_by_partition = {}
+
+        partitions = 0
+        with self._lock:
+            for day, day_account_ids in covered.items():
+                for bucket in sorted(set(self.bucket(account_id) for account_id in day_account_ids)):
+                    directory = self._partition_dir(day, bucket)
+                    stored = self._read_partition(directory)
+                    if stored is not None:
+                        stored = stored[~stored[ACCOUNT_ID_COLUMN].isin(day_account_ids)]
+                    fetched = data_by_partition.get((day, bucket))
+                    kept = [rows for rows in (stored, fetched) if rows is not None and len(rows)]
+                    self._write_partition(directory, pd.concat(kept, ignore_index=True) if kept else None)
+                    partitions += 1
+
+        logger.log_message(f"report archive updated: {len(data)} rows in {partitions} partition(s)")
+
+    def files(self, start_date, end_date, account_ids=None):
+        '''
+        Returns the part files of the days in the window, only of the buckets
+        of the given accounts when account_ids is not None
+        '''
+        if not os.path.isdir(self.archive_dir):
+            return []
+        start_day, end_day = format_day(start_date), format_day(end_date)
+        wanted = None if account_ids is None else set(str(self.bucket(account_id)) for account_id in account_ids)
+
+        files = []
+        for date_name in sorted(os.listdir(self.archive_dir)):
+            day = partition_value(date_name)
+            if day is None or day < start_day or day > end_day:
+                continue
+            date_dir = os.path.join(self.archive_dir, date_name)
+            for bucket_name in sorted(os.listdir(date_dir)):
+                if wanted is not None and partition_value(bucket_name) not in wanted:
+                    continue
+                parts = self._parts(os.path.join(date_dir, bucket_name))
+                if parts:
+                    files.append(os.path.join(date_dir, bucket_name, parts[-1]))
+        return files
+
+    def read(self, start_date, end_date, account_ids=None, columns=None):
+        '''
+        Returns the archived rows of the window as a DataFrame, the part files
+        are memory mapped and only the requested columns are read
+        '''
+        import pandas as pd
+        import pyarrow.dataset as ds
+        from pyarrow import fs
+
+        files = self.files(start_date, end_date, account_ids)
+        if not files:
+            return pd.DataFrame(columns=columns or [])
+
+        dataset = ds.dataset(files, format='parquet', filesystem=fs.LocalFileSystem(use_mmap=True))
+        account_filter = None
+        if account_ids is not None:
+            account_filter = ds.field(ACCOUNT_ID_COLUMN).isin([int(account_id) for account_id in account_ids])
+        return dataset.to_table(columns=columns, filter=account_filter).to_pandas()
+
+    def prune(self, today=None):
+        '''
+        Removes the partitions of the days past the retention period
+        '''
+        if self.retention_days is None or not os.path.isdir(self.archive_dir):
+            return 0
+        today = today or datetime.now().date()
+        oldest = format_day(today - timedelta(days=self.retention_days))
+
+        removed = 0
+        with self._lock:
+            for date_name in os.listdir(self.archive_dir):
+                day = partition_value(date_name)
+                if day is not None and day < oldest:
+                    shutil.rmtree(os.path.join(self.archive_dir, date_name))
+                    removed += 1
+        if removed:
+            logger.log_message(f"report archive pruned: {removed} day(s) older than {oldest}")
+        return removed
+
+    def compact(self):
+        '''
+        Drops the parts and temporary files left over by interrupted writes
+        and rewrites every partition into a single file sorted by account
+        '''
+        if not os.path.isdir(self.archive_dir):
+            return 0
+
+        compacted = 0
+        with self._lock:
+            for date_name in sorted(os.listdir(self.archive_dir)):
+                date_dir = os.path.join(self.archive_dir, date_name)
+                if partition_value(date_name) is None or not os.path.isdir(date_dir):
+                    continue
+                for bucket_name in os.listdir(date_dir):
+                    directory = os.path.join(date_dir, bucket_name)
+                    for name in os.listdir(directory):
+                        if name.endswith(".tmp"):
+                            os.remove(os.path.join(directory, name))
+                    if len(self._parts(directory)) > 1:
+                        self._write_partition(directory, self._read_partition(directory))
+                        compacted += 1
+                    elif not os.listdir(directory):
+                        os.rmdir(directory)
+                if not os.listdir(date_dir):
+                    os.rmdir(date_dir)
+
+        logger.log_message(f"report archive compacted: {compacted} partition(s) rewritten")
+        return compacted
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reads or compacts a report archive")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    query = commands.add_parser('query', help="writes the archived rows of a date window as csv")
+    query.add_argument('archive_dir')
+    query.add_argument('start_date')
+    query.add_argument('end_date')
+    query.add_argument('--accounts', nargs='+', help="account ids, all accounts when omitted")
+    query.add_argument('--columns', nargs='+', help="columns to read, all columns when omitted")
+    query.add_argument('--output', help="csv file the rows are written to (default stdout)")
+
+    compact = commands.add_parser('compact', help="drops the parts left over by interrupted writes")
+    compact.add_argument('archive_dir')
+
+    args = parser.parse_args(argv)
+    archive = ReportArchive(args.archive_dir)
+
+    if args.command == 'compact':
+        archive.compact()
+        return 0
+
+    rows = archive.read(args.start_date, args.end_date, account_ids=args.accounts, columns=args.columns)
+    rows.to_csv(args.output or sys.stdout, index=False)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
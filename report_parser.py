@@ -0,0 +1,132 @@
+'''Report Parser
+
+This module reads the report csv files downloaded from the Bing Ads
+Reporting API straight into typed DataFrames
+'''
+import csv
+import pandas as pd
+
+# Columns requested in the ads performance report, in order
+REPORT_COLUMNS = [
+    'AccountName',
+    'TimePeriod',
+    'CurrencyCode',
+    'CampaignType',
+    'Network',
+    'DeviceType',
+    'Clicks',
+    'Impressions',
+    'Ctr',
+    'AverageCpc',
+    'Spend',
+    'Conversions',
+    'Revenue',
+    ]
+
+# Requested with every report type, the stored, archived and rolled up rows
+# are keyed on the account id since account names can change and are not
+# unique. It is not written to the sheets
+ACCOUNT_ID_COLUMN = 'AccountId'
+
+REPORT_DTYPES = {
+    'AccountId': 'int64',
+    'AccountName': 'category',
+    'TimePeriod': 'str',
+    'CurrencyCode': 'category',
+    'CampaignType': 'category',
+    'Network': 'category',
+    'DeviceType': 'category',
+    'Clicks': 'int64',
+    'Impressions': 'int64',
+    # Parsed from "1.23%" after reading
+    'Ctr': 'str',
+    'AverageCpc': 'float64',
+    'Spend': 'float64',
+    'Conversions': 'float64',
+    'Revenue': 'float64',
+    }
+
+# Columns converted to GBP and the report columns they are converted from
+CONVERTED_COLUMNS = {
+    "AverageCpc (converted)": "AverageCpc",
+    "Cost (converted)": "Spend",
+    "Total conv. value": "Conversions",
+    }
+
+# Lines of the report header scanned for the column header row
+MAX_HEADER_LINES = 50
+
+def read_report_header(file_path, first_column):
+    '''
+    Returns (header_row, row_count) where header_row is the line index of the
+    column headers and row_count the number of data rows declared in the
+    report header (None when the report header was excluded)
+    '''
+    row_count = None
+    with open(file_path, 'r', encoding='utf-8-sig', newline='') as file:
+        for line_index, line in enumerate(file):
+            if line_index >= MAX_HEADER_LINES:
+                break
+            fields = next(csv.reader([line]), [])
+            if not fields:
+                continue
+            if fields[0] == first_column:
+                return line_index, row_count
+            if fields[0].startswith('Rows:'):
+                row_count = int(fields[0].split(':', 1)[1].strip().replace(',', ''))
+
+    raise ValueError(f"column header '{first_column}' not found in report file '{file_path}'")
+
+def read_report_csv(file_path, columns=REPORT_COLUMNS, dtypes=REPORT_DTYPES):
+    '''
+    Reads a downloaded csv report into a typed DataFrame, the report header
+    and footer are skipped using the row count declared in the header
+    '''
+    header_row, row_count = read_report_header(file_path, columns[0])
+
+    data = pd.read_csv(
+        file_path,
+        skiprows=header_row,
+        nrows=row_count,
+        usecols=columns,
+        dtype=dtypes,
+        thousands=',',
+        encoding='utf-8-sig',
+        )[columns]
+
+    return parse_ctr(data)
+
+def iter_report_csv(file_path, chunk_rows=50000, columns=REPORT_COLUMNS, dtypes=REPORT_DTYPES):
+    '''
+    Yields the rows of a downloaded csv report as typed DataFrames of at
+    most chunk_rows rows, so a report of any size is read in bounded memory
+    '''
+    header_row, row_count = read_report_header(file_path, columns[0])
+    if row_count == 0:
+        return
+
+    chunks = pd.read_csv(
+        file_path,
+        skiprows=header_row,
+        nrows=row_count,
+        usecols=columns,
+        dtype=dtypes,
+        thousands=',',
+        encoding='utf-8-sig',
+        chunksize=chunk_rows,
+        )
+    with chunks:
+        for data in chunks:
+            yield parse_ctr(data[columns])
+
+def sheet_rows(data):
+    '''
+    Returns the report rows without the columns that are not written to the sheets
+    '''
+    return data.drop(columns=[ACCOUNT_ID_COLUMN], errors='ignore')
+
+def parse_ctr(data):
+    # "1.23%" -> 0.0123
+    if 'Ctr' in data.columns:
+        data['Ctr'] = data['Ctr'].str.rstrip('%').astype('float64') / 100.0
+    return data
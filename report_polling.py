@@ -0,0 +1,139 @@
+'''Report Polling
+
+This module waits for submitted reports to be ready. The completion times
+of past reports are recorded per report type and size, status polls are
+sent often around the predicted completion time and back off
+exponentially otherwise
+'''
+import json
+import math
+import time
+import logging
+import logger
+import threading
+
+from statistics import median
+
+from request_scheduler import get_scheduler
+from file_utils import write_json
+
+class PollingHistory:
+
+    def __init__(self, history_path, max_samples=50):
+        '''
+        history_path: json file the completion times are kept in
+        max_samples: number of completion times kept per report type
+        '''
+        self.history_path = history_path
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        self._history = self._load()
+
+    def _load(self):
+        try:
+            with open(self.history_path, 'r') as file:
+                return json.load(file)
+        except (IOError, ValueError):
+            return {}
+
+    def _save(self):
+        write_json(self.history_path, self._history)
+
+    def record(self, report_type, size, seconds):
+        '''
+        Records the completion time of a report of the given type and size
+        (number of accounts x number of days)
+        '''
+        with self._lock:
+            samples = self._history.setdefault(report_type, [])
+            samples.append({'size': size, 'seconds': seconds})
+            del samples[:-self.max_samples]
+            self._save()
+
+    def predict(self, report_type, size):
+        '''
+        Returns the expected completion time in seconds, None without history
+        '''
+        with self._lock:
+            samples = list(self._history.get(report_type, []))
+        if not samples:
+            return None
+
+        # Reports of a similar size (within a factor of 2)
+        similar = [
+            sample['seconds'] for sample in samples
+            if abs(math.log(max(sample['size'], 1)) - math.log(max(size, 1))) <= math.log(2)
+            ]
+        if similar:
+            return median(similar)
+
+        # Otherwise scale the typical time per unit of size
+        return median(sample['seconds'] / max(sample['size'], 1) for sample in samples) * max(size, 1)
+
+def next_poll_delay(elapsed, predicted, backoff, min_interval, max_interval, window=0.25):
+    '''
+    Returns (delay, next_backoff), the time to wait before the next status
+    poll. Polls every min_interval seconds within window (as a fraction)
+    of the predicted completion time and backs off exponentially outside
+    of it without stepping over the start of the window
+    '''
+    if predicted is not None:
+        window_start = predicted * (1 - window)
+        window_end = predicted * (1 + window)
+        if window_start <= elapsed <= window_end:
+            return min_interval, min_interval
+        if elapsed < window_start:
+            return max(min_interval, min(backoff, window_start - elapsed)), min(backoff * 2, max_interval)
+    return backoff, min(backoff * 2, max_interval)
+
+def track_report(
+    reporting_download_operation,
+    report_type,
+    size,
+    history,
+    submitted_at,
+    timeout_seconds=3600,
+    min_interval=1.0,
+    max_interval=60.0,
+    ):
+    '''
+    Polls the status of the submitted report until it is ready, records
+    its completion time and returns the final status
+    '''
+    predicted = history.predict(report_type, size)
+    logger.log_message(f"tracking {report_type} (size {size}), predicted completion: {predicted if predicted is None else round(predicted, 1)}s")
+
+    backoff = min_interval
+    polls = 0
+    while True:
+        elapsed = time.monotonic() - submitted_at
+        if elapsed > timeout_seconds:
+            raise TimeoutError(f"{report_type} not ready after {timeout_seconds}s")
+
+        delay, backoff = next_poll_delay(elapsed, predicted, backoff, min_interval, max_interval)
+        time.sleep(min(delay, max(0, timeout_seconds - elapsed)))
+
+        status = get_scheduler('bing').call(reporting_download_operation.get_status)
+        polls += 1
+        if status.status == 'Pending':
+            continue
+        if status.status != 'Success':
+            logger.log_message(f"{report_type} failed with status {status.status}", level=logging.ERROR)
+            raise Exception(f"report status: {status.status}")
+
+        seconds = time.monotonic() - submitted_at
+        history.record(report_type, size, seconds)
+        logger.log_message(f"{report_type} ready after {round(seconds, 1)}s and {polls} status poll(s)")
+        return status
+
+_histories = {}
+_histories_lock = threading.Lock()
+
+def get_polling_history(history_path):
+    '''
+    Returns the process wide polling history for the history file
+    '''
+    with _histories_lock:
+        if history_path not in _histories:
+            _histories[history_path] = PollingHistory(history_path)
+        return _histories[history_path]
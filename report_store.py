@@ -0,0 +1,169 @@
+'''Report Store
+
+This module keeps a local copy of the downloaded report rows so that
+days which are already final do not have to be requested from the
+Bing Ads Reporting API again on every run
+'''
+import os
+import csv
+import json
+import logging
+import logger
+import pandas as pd
+
+from datetime import datetime, timedelta
+
+from report_parser import ACCOUNT_ID_COLUMN
+from report_archive import covered_days
+from file_utils import replace_file, write_json
+
+# A row is uniquely identified by these columns
+STORE_KEY = [ACCOUNT_ID_COLUMN, 'TimePeriod', 'CampaignType', 'Network', 'DeviceType']
+
+class ReportStore:
+
+    def __init__(self, store_dir, finalize_after_days=3, retention_days=90, key_columns=STORE_KEY):
+        '''
+        store_dir: folder holding the stored rows and the manifest
+        finalize_after_days: a day is considered final (no more revisions
+            from the API) once it is older than this many days at fetch time
+        retention_days: stored rows older than this are dropped on merge
+        key_columns: the columns identifying a row of the stored report type
+        '''
+        self.store_dir = store_dir
+        self.key_columns = key_columns
+        self.finalize_after_days = finalize_after_days
+        self.retention_days = retention_days
+        self.data_path = os.path.join(store_dir, "ads_report_store.csv")
+        self.manifest_path = os.path.join(store_dir, "manifest.json")
+
+        os.makedirs(store_dir, exist_ok=True)
+
+        self.manifest = self._load_manifest()
+        self._check_layout()
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_path, 'r') as file:
+                return json.load(file)
+        except (IOError, ValueError):
+            return {'finalized': {}}
+
+    def _save_manifest(self):
+        write_json(self.manifest_path, self.manifest)
+
+    def _check_layout(self):
+        '''
+        Starts the store over when its rows were stored before they were
+        keyed on the account id, the window is then downloaded again
+        '''
+        try:
+            with open(self.data_path, 'r', newline='') as file:
+                header = next(csv.reader(file), [])
+        except IOError:
+            return
+        if header and ACCOUNT_ID_COLUMN not in header:
+            logger.log_message(f"report store '{self.store_dir}' has no {ACCOUNT_ID_COLUMN} column, starting it over", level=logging.WARNING)
+            os.remove(self.data_path)
+            self.manifest = {'finalized': {}}
+            self._save_manifest()
+
+    def load(self):
+        '''
+        Returns all the stored rows as a DataFrame
+        '''
+        if not os.path.exists(self.data_path):
+            return pd.DataFrame()
+        try:
+            return pd.read_csv(
+                self.data_path,
+                dtype={**{column: str for column in self.key_columns + ['CurrencyCode']}, ACCOUNT_ID_COLUMN: 'int64'},
+                keep_default_na=False,
+                )
+        except pd.errors.EmptyDataError:
+            return pd.DataFrame()
+
+    def pending(self, account_ids, start_date, end_date):
+        '''
+        Returns (fetch_start, fetch_end, fetch_account_ids) covering every
+        (account, day) of the window that is not final yet, or None when
+        the whole window can be served from the store
+        '''
+        finalized = self.manifest['finalized']
+        missing_dates = []
+        missing_accounts = set()
+
+        day = start_date
+        while day <= end_date:
+            done = set(finalized.get(day.strftime('%Y-%m-%d'), []))
+            missing = [account_id for account_id in account_ids if str(account_id) not in done]
+            if missing:
+                missing_dates.append(day)
+                missing_accounts.update(missing)
+            day += timedelta(days=1)
+
+        if not missing_dates:
+            return None
+
+        return (
+            min(missing_dates),
+            max(missing_dates),
+            [account_id for account_id in account_ids if account_id in missing_accounts],
+            )
+
+    def merge(self, data, coverage):
+        '''
+        Replaces the stored rows of the pairs covered by the fetch with the
+        freshly downloaded ones and marks the days that are now final
+
+        coverage: list of report_archive.Coverage
+        '''
+        stored = self.load()
+
+        if not stored.empty:
+            replaced = pd.Series(False, index=stored.index)
+            for account_ids, start_date, end_date in coverage:
+                replaced |= (
+                    (stored['TimePeriod'] >= start_date.strftime('%Y-%m-%d'))
+                    & (stored['TimePeriod'] <= end_date.strftime('%Y-%m-%d'))
+                    & stored[ACCOUNT_ID_COLUMN].isin([int(account_id) for account_id in account_ids])
+                    )
+            stored = stored[~replaced]
+
+            # Drop rows past the retention period
+            oldest = (datetime.now().date() - timedelta(days=self.retention_days)).strftime('%Y-%m-%d')
+            stored = stored[stored['TimePeriod'] >= oldest]
+
+        merged = pd.concat([stored, data], ignore_index=True) if not stored.empty else data
+
+        replace_file(self.data_path, lambda tmp_path: merged.to_csv(tmp_path, index=False))
+
+        # Days old enough to not be revised anymore are final
+        last_final_day = (datetime.now().date() - timedelta(days=self.finalize_after_days + 1)).strftime('%Y-%m-%d')
+        finalized = self.manifest['finalized']
+        for day, account_ids in covered_days(coverage).items():
+            if day <= last_final_day:
+                finalized[day] = sorted(set(finalized.get(day, [])) | set(str(account_id) for account_id in account_ids))
+
+        oldest = (datetime.now().date() - timedelta(days=self.retention_days)).strftime('%Y-%m-%d')
+        for stale_date in [stale_date for stale_date in finalized if stale_date < oldest]:
+            del finalized[stale_date]
+
+        self._save_manifest()
+        logger.log_message(f"report store updated: {len(data)} rows merged from {len(coverage)} report(s)")
+
+    def window(self, account_ids, start_date, end_date):
+        '''
+        Returns the stored rows of the given accounts inside the date window
+        '''
+        stored = self.load()
+        if stored.empty:
+            logger.log_message("report store is empty", level=logging.WARNING)
+            return stored
+
+        in_window = (
+            (stored['TimePeriod'] >= start_date.strftime('%Y-%m-%d'))
+            & (stored['TimePeriod'] <= end_date.strftime('%Y-%m-%d'))
+            & stored[ACCOUNT_ID_COLUMN].isin([int(account_id) for account_id in account_ids])
+            )
+        return stored[in_window].reset_index(drop=True)
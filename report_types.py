@@ -0,0 +1,102 @@
+'''Report Types
+
+This module lists the Bing Ads performance reports the script can request.
+Each entry declares the request, column and scope classes of the Reporting API,
+the columns and their dtypes, the columns that identify a row, and the
+columns derived after parsing, so one code path requests, parses and
+converts every type
+'''
+from report_parser import REPORT_COLUMNS, REPORT_DTYPES, CONVERTED_COLUMNS, ACCOUNT_ID_COLUMN
+
+DEFAULT_REPORT_TYPE = "ad"
+
+# Dtypes of the columns the ad performance report does not have
+EXTRA_DTYPES = {
+    'CampaignName': 'str',
+    'AdGroupName': 'str',
+    'Keyword': 'str',
+    'SearchQuery': 'str',
+    'DeliveredMatchType': 'category',
+    }
+
+METRIC_COLUMNS = ['Clicks', 'Impressions', 'Ctr', 'AverageCpc', 'Spend', 'Conversions', 'Revenue']
+
+REPORT_TYPES = {
+    "ad": {
+        "request": "AdPerformanceReportRequest",
+        "column_array": "ArrayOfAdPerformanceReportColumn",
+        "column_element": "AdPerformanceReportColumn",
+        "report_name": "Ads Performance Report",
+        "scope": "AccountThroughAdGroupReportScope",
+        "columns": REPORT_COLUMNS + [ACCOUNT_ID_COLUMN],
+        "key": [ACCOUNT_ID_COLUMN, 'TimePeriod', 'CampaignType', 'Network', 'DeviceType'],
+        "converted": CONVERTED_COLUMNS,
+        "derived": {},
+    },
+    "campaign": {
+        "request": "CampaignPerformanceReportRequest",
+        "column_array": "ArrayOfCampaignPerformanceReportColumn",
+        "column_element": "CampaignPerformanceReportColumn",
+        "report_name": "Campaign Performance Report",
+        "scope": "AccountThroughCampaignReportScope",
+        "columns": ['AccountName', 'TimePeriod', 'CurrencyCode', 'CampaignName', 'CampaignType', 'Network', 'DeviceType'] + METRIC_COLUMNS + [ACCOUNT_ID_COLUMN],
+        "key": [ACCOUNT_ID_COLUMN, 'TimePeriod', 'CampaignName', 'CampaignType', 'Network', 'DeviceType'],
+        "converted": CONVERTED_COLUMNS,
+        "derived": {},
+    },
+    "keyword": {
+        "request": "KeywordPerformanceReportRequest",
+        "column_array": "ArrayOfKeywordPerformanceReportColumn",
+        "column_element": "KeywordPerformanceReportColumn",
+        "report_name": "Keyword Performance Report",
+        "scope": "AccountThroughAdGroupReportScope",
+        "columns": ['AccountName', 'TimePeriod', 'CurrencyCode', 'CampaignName', 'AdGroupName', 'Keyword', 'DeliveredMatchType', 'Network', 'DeviceType'] + METRIC_COLUMNS + [ACCOUNT_ID_COLUMN],
+        "key": [ACCOUNT_ID_COLUMN, 'TimePeriod', 'CampaignName', 'AdGroupName', 'Keyword', 'DeliveredMatchType', 'Network', 'DeviceType'],
+        "converted": CONVERTED_COLUMNS,
+        "derived": {},
+    },
+    "search_query": {
+        "request": "SearchQueryPerformanceReportRequest",
+        "column_array": "ArrayOfSearchQueryPerformanceReportColumn",
+        "column_element": "SearchQueryPerformanceReportColumn",
+        "report_name": "Search Query Performance Report",
+        "scope": "AccountThroughAdGroupReportScope",
+        "columns": ['AccountName', 'TimePeriod', 'CampaignName', 'AdGroupName', 'SearchQuery', 'Keyword', 'DeliveredMatchType', 'DeviceType'] + METRIC_COLUMNS + [ACCOUNT_ID_COLUMN],
+        "key": [ACCOUNT_ID_COLUMN, 'TimePeriod', 'CampaignName', 'AdGroupName', 'SearchQuery', 'Keyword', 'DeliveredMatchType', 'DeviceType'],
+        "converted": CONVERTED_COLUMNS,
+        # The report has no currency column, it is the currency of the account
+        "derived": {"CurrencyCode": "account_currency"},
+    },
+}
+
+def get_report_type(name):
+    '''
+    Returns the registry entry of the report type, raises ValueError for an unknown type
+    '''
+    if name not in REPORT_TYPES:
+        raise ValueError(f"unknown report type '{name}', expected one of {sorted(REPORT_TYPES)}")
+    report_type = {"name": name, **REPORT_TYPES[name]}
+    report_type["dtypes"] = report_dtypes(report_type)
+    return report_type
+
+def report_dtypes(report_type):
+    '''
+    Returns the dtypes of the report type's columns
+    '''
+    dtypes = {**REPORT_DTYPES, **EXTRA_DTYPES}
+    return {column: dtypes[column] for column in report_type["columns"]}
+
+def add_derived_columns(data, report_type, account_currencies=None):
+    '''
+    Adds the columns the report type derives after parsing, in place and
+    after TimePeriod like the report columns of the other types
+
+    account_currencies: {account id: currency code} of the accounts
+    '''
+    for column, source in report_type["derived"].items():
+        if source == "account_currency":
+            values = data[ACCOUNT_ID_COLUMN].map(account_currencies or {}).astype('category')
+        else:
+            raise ValueError(f"unknown derived column source '{source}'")
+        data.insert(data.columns.get_loc('TimePeriod') + 1, column, values)
+    return data
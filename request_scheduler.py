@@ -0,0 +1,221 @@
+'''Request Scheduler
+
+This module rate limits the outbound calls made to the Bing Ads and Google
+Sheets APIs and retries them with exponential backoff when they are
+throttled or fail with a transient error
+'''
+import time
+import random
+import socket
+import logging
+import logger
+import threading
+
+from metrics import get_metrics
+
+# HTTP status codes worth retrying
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+# HTTP status codes telling us to slow down
+THROTTLED_STATUS_CODES = {429}
+
+# Bing Ads error codes returned when a call is throttled (117: CallRateExceeded)
+THROTTLING_ERROR_CODES = {'117', 'CallRateExceeded'}
+
+# Bing Ads error codes of transient service side failures (0: InternalError)
+TRANSIENT_ERROR_CODES = {'0', 'InternalError'}
+
+# Where the error codes are found in a Bing Ads WebFault detail
+WEBFAULT_ERROR_PATHS = (
+    ["AdApiFaultDetail", "Errors", "AdApiError"],
+    ["ApiFault", "OperationErrors", "OperationError"],
+    ["ApiFaultDetail", "OperationErrors", "OperationError"],
+    ["ApiFaultDetail", "BatchErrors", "BatchError"],
+)
+
+class TokenBucket:
+    '''
+    Allows rate requests per second on average with bursts of up to burst requests
+    '''
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+def webfault_error_codes(error):
+    '''
+    Returns the error codes found in a suds WebFault
+    '''
+    codes = set()
+    detail = getattr(getattr(error, 'fault', None), 'detail', None)
+    if detail is None:
+        return codes
+    for path in WEBFAULT_ERROR_PATHS:
+        api_errors = detail
+        for field in path:
+            api_errors = getattr(api_errors, field, None)
+        if api_errors is None:
+            continue
+        if not isinstance(api_errors, list):
+            api_errors = [api_errors]
+        for api_error in api_errors:
+            for field in ('Code', 'ErrorCode'):
+                if getattr(api_error, field, None) is not None:
+                    codes.add(str(getattr(api_error, field)))
+    return codes
+
+def classify_error(error):
+    '''
+    Returns (retryable, throttled, retry_after_seconds) for an exception
+    raised by an outbound call
+    '''
+    status = None
+    retry_after = None
+
+    # googleapiclient.errors.HttpError
+    response = getattr(error, 'resp', None)
+    if response is not None and hasattr(response, 'status'):
+        status = int(response.status)
+        retry_after = response.get('retry-after') if hasattr(response, 'get') else None
+
+    # requests.HTTPError raised by the report file download
+    response = getattr(error, 'response', None)
+    if status is None and response is not None and hasattr(response, 'status_code'):
+        status = int(response.status_code)
+        retry_after = response.headers.get('Retry-After')
+
+    # suds.transport.TransportError
+    if status is None and getattr(error, 'httpcode', None) is not None:
+        status = int(error.httpcode)
+
+    if status is not None:
+        try:
+            retry_after = float(retry_after) if retry_after is not None else None
+        except ValueError:
+            retry_after = None
+        return status in RETRYABLE_STATUS_CODES, status in THROTTLED_STATUS_CODES, retry_after
+
+    # suds.WebFault raised by the Bing Ads services
+    codes = webfault_error_codes(error)
+    if codes:
+        throttled = bool(codes & THROTTLING_ERROR_CODES)
+        return throttled or bool(codes & TRANSIENT_ERROR_CODES), throttled, None
+
+    # Connection level failures
+    if isinstance(error, (ConnectionError, socket.timeout, TimeoutError)):
+        return True, False, None
+    if type(error).__name__ in ('ConnectionError', 'Timeout', 'ReadTimeout', 'ConnectTimeout', 'URLError'):
+        return True, False, None
+
+    return False, False, None
+
+class RequestScheduler:
+    '''
+    Sends the calls of one API through a token bucket, caps the number of
+    calls in flight and retries the retryable failures with exponential
+    backoff and jitter. A throttled call pauses every caller of the API
+    so that throttling does not turn into a retry storm
+    '''
+
+    def __init__(
+        self,
+        name,
+        rate_per_second=5.0,
+        burst=10,
+        max_in_flight=8,
+        max_retries=5,
+        base_delay=1.0,
+        max_delay=60.0,
+        ):
+        self.name = name
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._bucket = TokenBucket(rate_per_second, burst)
+        self._in_flight = threading.BoundedSemaphore(max(1, max_in_flight))
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+        self.retry_count = 0
+
+    def _wait_for_pause(self):
+        while True:
+            with self._lock:
+                wait = self._paused_until - time.monotonic()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def call(self, fn, *args, **kwargs):
+        '''
+        Calls fn(*args, **kwargs) through the scheduler
+        '''
+        return self.call_with_retries(self.max_retries, fn, *args, **kwargs)
+
+    def call_with_retries(self, max_retries, fn, *args, **kwargs):
+        attempt = 0
+        while True:
+            self._wait_for_pause()
+            self._bucket.acquire()
+            with self._in_flight:
+                try:
+                    return fn(*args, **kwargs)
+                except Exception as error:
+                    retryable, throttled, retry_after = classify_error(error)
+                    if not retryable or attempt >= max_retries:
+                        raise
+                    last_error = error
+
+            attempt += 1
+            delay = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+            # Full jitter keeps the callers from retrying in lockstep
+            delay = random.uniform(0, delay)
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+            if throttled:
+                with self._lock:
+                    self._paused_until = max(self._paused_until, time.monotonic() + delay)
+
+            with self._lock:
+                self.retry_count += 1
+            get_metrics().add(retries=1)
+            logger.log_message(
+                f"{self.name} call {getattr(fn, '__name__', fn)} failed ({last_error}), retry {attempt}/{max_retries} in {delay:.1f}s",
+                level=logging.WARNING,
+                )
+            time.sleep(delay)
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+def configure_scheduler(name, **settings):
+    '''
+    Creates the scheduler of the API with the given settings, replacing the existing one
+    '''
+    with _schedulers_lock:
+        _schedulers[name] = RequestScheduler(name, **settings)
+        return _schedulers[name]
+
+def get_scheduler(name):
+    '''
+    Returns the process wide scheduler of the API, created with the default
+    settings when it was not configured
+    '''
+    with _schedulers_lock:
+        if name not in _schedulers:
+            _schedulers[name] = RequestScheduler(name)
+        return _schedulers[name]
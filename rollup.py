@@ -0,0 +1,279 @@
+'''Rollup
+
+This module keeps a rollup cube of the ad performance report: the additive
+metrics summed per day at the (account, campaign type, network, device)
+grain, one Parquet file per day (rollup/<job>/date=YYYY-MM-DD.parquet).
+Only the days of a fetch are rewritten, and the period pivots (every day
+of the window, week to date, week over week) are built from the handful of
+pre-aggregated rows instead of the raw report rows
+'''
+import os
+import shutil
+import logger
+import threading
+
+from datetime import datetime, timedelta
+
+from file_utils import read_json, replace_file, write_json
+from report_parser import ACCOUNT_ID_COLUMN
+from report_archive import covered_days, format_day, partition_value
+
+# The rows of an account are replaced by its id, the name is kept for the pivots
+ROLLUP_GRAIN = [ACCOUNT_ID_COLUMN, 'AccountName', 'CampaignType', 'Network', 'DeviceType']
+
+# The additive columns of the report, ratios are computed from them
+ROLLUP_MEASURES = ['Clicks', 'Impressions', 'Spend', 'Conversions', 'Revenue', 'Cost (converted)', 'Total conv. value']
+
+# "daily": every day of the window, "week_to_date": Monday to the window end,
+# "week_over_week": week to date next to the same days of the previous week
+PERIODS = ("daily", "week_to_date", "week_over_week")
+
+PREVIOUS_SUFFIX = " (previous week)"
+CHANGE_SUFFIX = " (change)"
+
+def cube_spec():
+    '''
+    Returns the pivot spec that sums the report rows into cube rows
+    '''
+    return {
+        "filter": None,
+        "group_by": ['TimePeriod'] + ROLLUP_GRAIN,
+        "first": [],
+        "metrics": {column: "sum" for column in ROLLUP_MEASURES},
+        "totals": None,
+        "sort": False,
+        }
+
+def check_period_spec(spec):
+    '''
+    Raises ValueError when the period pivot spec cannot be answered from the cube
+    '''
+    from pivot import summed_columns
+
+    if spec.get("period") not in PERIODS:
+        raise ValueError(f"unknown pivot period '{spec.get('period')}', expected one of {list(PERIODS)}")
+    spec = resolve_period_spec(spec)
+    columns = set(spec["group_by"]) | set(summed_columns(spec)) | set((spec.get("filter") or {}))
+    missing = columns - set(ROLLUP_GRAIN + ROLLUP_MEASURES) - {'TimePeriod'}
+    if missing or spec["first"]:
+        raise ValueError(f"{spec['period']} pivot uses columns that are not in the rollup cube: {sorted(missing | set(spec['first']))}")
+
+def as_strings(rows):
+    '''
+    Returns the rows with the day and the grain as plain strings (not
+    categories) so every day has the same schema, the account id stays a number
+    '''
+    return rows.astype({column: str for column in ['TimePeriod'] + ROLLUP_GRAIN if column != ACCOUNT_ID_COLUMN})
+
+def resolve_period_spec(spec):
+    '''
+    Returns the period spec with the missing fields taken from DEFAULT_PIVOT,
+    without its end_date filter and first columns
+    '''
+    from pivot import DEFAULT_PIVOT
+
+    return {**DEFAULT_PIVOT, "filter": None, "first": [], **spec}
+
+class RollupCube:
+
+    def __init__(self, cube_dir, retention_days=400):
+        '''
+        cube_dir: folder holding the date= files of the cube
+        retention_days: days older than this are removed by prune(), None
+            keeps everything
+        '''
+        self.cube_dir = cube_dir
+        self.retention_days = retention_days
+        self.settings_path = os.path.join(cube_dir, "cube.json")
+        self._lock = threading.Lock()
+
+    def _day_path(self, day):
+        return os.path.join(self.cube_dir, f"date={format_day(day)}.parquet")
+
+    def exists(self):
+        '''
+        Returns True when the cube was built with the current grain, a cube
+        of another grain has to be rebuilt
+        '''
+        settings = read_json(self.settings_path)
+        return bool(settings) and settings.get('grain') == ROLLUP_GRAIN
+
+    def _start_over(self):
+        '''
+        Removes a cube of another grain and records the grain of the new one
+        '''
+        if os.path.isdir(self.cube_dir):
+            if self.exists():
+                return
+            shutil.rmtree(self.cube_dir)
+        write_json(self.settings_path, {'grain': ROLLUP_GRAIN})
+
+    def days(self):
+        '''
+        Returns the days of the cube, oldest first
+        '''
+        if not os.path.isdir(self.cube_dir):
+            return []
+        days = (partition_value(name[:-len(".parquet")]) for name in os.listdir(self.cube_dir) if name.endswith(".parquet"))
+        return sorted(day for day in days if day is not None)
+
+    def _read_day(self, day):
+        import pyarrow.parquet as pq
+
+        path = self._day_path(day)
+        return pq.read_table(path).to_pandas() if os.path.exists(path) else None
+
+    def _write_day(self, day, rows):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        path = self._day_path(day)
+        if rows is None or not len(rows):
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        table = pa.Table.from_pandas(as_strings(rows), preserve_index=False)
+        replace_file(path, lambda tmp_path: pq.write_table(table, tmp_path))
+
+    @staticmethod
+    def aggregate(data):
+        '''
+        Returns the report rows summed per day and grain
+        '''
+        from pivot import group_rows
+
+        return group_rows(as_strings(data), cube_spec())
+
+    def update(self, data, coverage):
+        '''
+        Replaces the cube rows of the pairs covered by the fetch with the
+        sums of the downloaded rows, only the days of the fetch are read and
+        written
+
+        coverage: list of report_archive.Coverage
+        '''
+        import pandas as pd
+
+        covered = covered_days(coverage)
+
+        fetched_by_day = {}
+        if not data.empty:
+            fetched_by_day = {day: rows for day, rows in self.aggregate(data).groupby('TimePeriod', sort=False)}
+
+        with self._lock:
+            self._start_over()
+            for day, account_ids in covered.items():
+                stored = self._read_day(day)
+                if stored is not None:
+                    stored = stored[~stored[ACCOUNT_ID_COLUMN].isin(account_ids)]
+                kept = [rows for rows in (stored, fetched_by_day.get(day)) if rows is not None and len(rows)]
+                self._write_day(day, pd.concat(kept, ignore_index=True) if kept else None)
+
+        logger.log_message(f"rollup cube updated: {len(covered)} day(s) from {len(data)} rows")
+        self.prune()
+
+    def rebuild(self, data):
+        '''
+        Replaces the whole cube with the sums of the report rows
+        '''
+        with self._lock:
+            if os.path.isdir(self.cube_dir):
+                shutil.rmtree(self.cube_dir)
+            self._start_over()
+            if not data.empty:
+                for day, rows in self.aggregate(data).groupby('TimePeriod', sort=False):
+                    self._write_day(day, rows)
+        logger.log_message(f"rollup cube rebuilt: {len(self.days())} day(s) from {len(data)} rows")
+
+    def read(self, start_date, end_date, account_ids=None):
+        '''
+        Returns the cube rows of the days in the window, of the given accounts
+        when account_ids is not None
+        '''
+        import pandas as pd
+
+        start_day, end_day = format_day(start_date), format_day(end_date)
+        frames = [self._read_day(day) for day in self.days() if start_day <= day <= end_day]
+        frames = [frame for frame in frames if frame is not None]
+        if not frames:
+            return pd.DataFrame(columns=['TimePeriod'] + ROLLUP_GRAIN + ROLLUP_MEASURES)
+        rows = pd.concat(frames, ignore_index=True)
+        if account_ids is not None:
+            rows = rows[rows[ACCOUNT_ID_COLUMN].isin([int(account_id) for account_id in account_ids])]
+        return rows.reset_index(drop=True)
+
+    def prune(self, today=None):
+        '''
+        Removes the days past the retention period
+        '''
+        if self.retention_days is None:
+            return 0
+        today = today or datetime.now().date()
+        oldest = format_day(today - timedelta(days=self.retention_days))
+
+        removed = 0
+        with self._lock:
+            for day in self.days():
+                if day < oldest:
+                    os.remove(self._day_path(day))
+                    removed += 1
+        return removed
+
+def build_period_pivot(cube, spec, account_ids, start_date, end_date):
+    '''
+    Returns the pivot of the period spec for the window start_date..end_date
+    (dates) from the cube rows of the accounts
+    '''
+    from pivot import filter_rows, group_rows, finish_pivot, summed_columns
+
+    spec = resolve_period_spec(spec)
+    context = {'start_date': format_day(start_date), 'end_date': format_day(end_date)}
+
+    def grouped(period_spec, period_start, period_end):
+        rows = filter_rows(cube.read(period_start, period_end, account_ids), period_spec, context)
+        return group_rows(rows, period_spec)
+
+    if spec["period"] == "daily":
+        daily_spec = {**spec, "group_by": ['TimePeriod'] + spec["group_by"]}
+        groups = grouped(daily_spec, start_date, end_date)
+        if spec["sort"]:
+            # Newest day first like the report rows
+            groups = groups.sort_values('TimePeriod', ascending=False, kind='stable')
+        return finish_pivot(groups.reset_index(drop=True), daily_spec)
+
+    week_start = end_date - timedelta(days=end_date.weekday())
+    if spec["period"] == "week_to_date":
+        groups = grouped(spec, week_start, end_date)
+        groups.insert(0, 'WeekStart', format_day(week_start))
+        return finish_pivot(groups, {**spec, "group_by": ['WeekStart'] + spec["group_by"]})
+
+    # week_over_week: the same weekdays of both weeks, side by side
+    sums = summed_columns(spec)
+    current = grouped(spec, week_start, end_date)
+    previous = grouped(spec, week_start - timedelta(days=7), end_date - timedelta(days=7))
+    merged = (
+        current.astype({column: str for column in spec["group_by"]})
+        .merge(previous.astype({column: str for column in spec["group_by"]}), on=spec["group_by"], how='outer', suffixes=('', PREVIOUS_SUFFIX), sort=spec["sort"])
+        )
+    for column in sums:
+        merged[column] = merged[column].fillna(0)
+        merged[column + PREVIOUS_SUFFIX] = merged[column + PREVIOUS_SUFFIX].fillna(0)
+
+    current_pivot = finish_pivot(merged[spec["group_by"] + sums].copy(), spec)
+    previous_pivot = finish_pivot(
+        merged[spec["group_by"] + [column + PREVIOUS_SUFFIX for column in sums]]
+        .rename(columns={column + PREVIOUS_SUFFIX: column for column in sums}),
+        spec,
+        )
+    pivot = current_pivot[spec["group_by"]].copy()
+    for metric in spec["metrics"]:
+        pivot[metric] = current_pivot[metric]
+        pivot[metric + PREVIOUS_SUFFIX] = previous_pivot[metric]
+        pivot[metric + CHANGE_SUFFIX] = current_pivot[metric] - previous_pivot[metric]
+    return pivot
+
+def build_period_pivots(cube, specs, account_ids, start_date, end_date):
+    '''
+    Returns [(spec, pivot)] for every period spec
+    '''
+    return [(resolve_period_spec(spec), build_period_pivot(cube, spec, account_ids, start_date, end_date)) for spec in specs]
@@ -0,0 +1,125 @@
+'''Service Clients
+
+This module builds the Bing Ads SOAP service clients once per process and
+thread and keeps the parsed WSDL documents in a versioned on-disk cache. The
+clients of a thread that ends are handed to the next threads, so the worker
+pools of a long running process do not build them again
+'''
+import os
+import threading
+
+from suds.cache import ObjectCache
+
+# Get script path
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Folder the caches are written to, the work folder of main.py
+work_dir = os.environ.get("BING_REPORT_WORK_DIR", script_dir)
+
+# Parsed WSDL documents are kept for this many days
+WSDL_CACHE_DAYS = 30
+
+# host:port of a local stand-in for the Bing Ads services (see loadtest/), the
+# SOAP calls are sent there instead of the addresses in the WSDL documents
+BING_ADS_EMULATOR_HOST = os.environ.get("BING_ADS_EMULATOR_HOST")
+
+class WsdlCache(ObjectCache):
+    '''
+    Pickled WSDL cache on disk with an in memory layer so that every client
+    of the process shares the same parsed documents
+    '''
+
+    def __init__(self, location, **duration):
+        ObjectCache.__init__(self, location, **duration)
+        self._memory = {}
+        self._memory_lock = threading.Lock()
+
+    def get(self, id):
+        with self._memory_lock:
+            if id in self._memory:
+                return self._memory[id]
+        cached = ObjectCache.get(self, id)
+        if cached is not None:
+            with self._memory_lock:
+                self._memory[id] = cached
+        return cached
+
+    def put(self, id, object):
+        with self._memory_lock:
+            self._memory[id] = object
+        return ObjectCache.put(self, id, object)
+
+    def purge(self, id):
+        with self._memory_lock:
+            self._memory.pop(id, None)
+        ObjectCache.purge(self, id)
+
+def bingads_version():
+    try:
+        from importlib.metadata import version
+        return version('bingads')
+    except Exception:
+        return 'unknown'
+
+_wsdl_cache = None
+_wsdl_cache_lock = threading.Lock()
+_clients = threading.local()
+# Clients of ended threads by key, a new thread takes one before building one
+_idle_clients = {}
+_idle_clients_lock = threading.RLock()
+
+class ThreadClients(dict):
+    '''
+    The service clients of a thread by key, returned to the idle clients
+    when the thread ends and its thread local data is dropped
+    '''
+
+    def __del__(self):
+        with _idle_clients_lock:
+            for key, client in self.items():
+                _idle_clients.setdefault(key, []).append(client)
+
+def get_wsdl_cache(cache_days=WSDL_CACHE_DAYS):
+    '''
+    Returns the process wide WSDL cache, a new SDK version gets a new cache folder
+    '''
+    global _wsdl_cache
+    with _wsdl_cache_lock:
+        if _wsdl_cache is None:
+            location = os.path.join(work_dir, "cache/wsdl", "bingads-" + bingads_version())
+            _wsdl_cache = WsdlCache(location, days=cache_days)
+        return _wsdl_cache
+
+def suds_options(service=None):
+    '''
+    Options passed to every suds client built by the Bing Ads SDK
+    '''
+    options = {'cache': get_wsdl_cache()}
+    if BING_ADS_EMULATOR_HOST and service:
+        options['location'] = f"http://{BING_ADS_EMULATOR_HOST}/{service}"
+    return options
+
+def get_service_client(service, authorization_data, environment):
+    '''
+    Returns the service client of the current thread, suds clients are not
+    safe to share between threads
+    '''
+    from bingads.service_client import ServiceClient
+
+    if not hasattr(_clients, 'by_key'):
+        _clients.by_key = ThreadClients()
+    key = (service, id(authorization_data), environment)
+    if key not in _clients.by_key:
+        with _idle_clients_lock:
+            idle = _idle_clients.get(key)
+            if idle:
+                _clients.by_key[key] = idle.pop()
+                return _clients.by_key[key]
+        _clients.by_key[key] = ServiceClient(
+            service=service,
+            version=13,
+            authorization_data=authorization_data,
+            environment=environment,
+            **suds_options(service)
+        )
+    return _clients.by_key[key]